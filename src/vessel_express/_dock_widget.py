@@ -1,26 +1,60 @@
-from qtpy.QtWidgets import QComboBox, QLabel, QSizePolicy, QToolBox, QLineEdit
+from qtpy.QtWidgets import QComboBox, QLabel, QSizePolicy, QToolBox, QLineEdit, QCheckBox, QTableWidget, QTableWidgetItem
+from qtpy.QtWidgets import QListWidget, QListWidgetItem, QListView
 from inspect import CORO_CLOSED
 import napari
 from napari_plugin_engine import napari_hook_implementation
 from qtpy.QtWidgets import QWidget, QPushButton, QSlider, QHBoxLayout, QVBoxLayout, QScrollArea, QFileDialog, QMessageBox
-from qtpy.QtCore import Qt
+from qtpy.QtCore import Qt, QConcatenateTablesProxyModel, QStringListModel, QTimer, QSize
+from qtpy.QtGui import QIcon, QImage, QPixmap
 from napari.layers import Image
-from tifffile import imread
 
 # packages required by processing functions
-from .utils import vesselness_filter
+from .utils import PRECISIONS, normalize_spacing, array_fingerprint
+from .resample import isotropic_zoom
+from .profiling import StepProfiler
+from .pipeline import STEPS, skeleton_network, provenance, layer_id, build_pipeline, save_pipeline, load_pipeline, run_pipeline, preset_pipeline, combine_pipelines
+from .scheduler import run_dag, process_pool, execute
+from .memory import MemoryManager, in_memory, spill_to_disk
+from .layer_model import LayerListModel
+from .preview import preview_step
+from .lazy import lazy_step, run_lazy
+from .review import QC_METRICS, Prefetcher, ReviewIndex, compute_review, load_pair, qc_columns, raw_path, review_order
+from .sweep import sweep, agreement, mask_statistics
+from .blocks import default_workers
+from .graph import network_statistics
+from .measure import measure_network, save_table
+from .export import append_records, write_table
+from .mesh import decimate, mask_mesh, save_mesh
+from .streaming import split_pipeline, stream_directory
+from .progressive import coarse_params, coarse_pipeline, coarse_transform, downsample
+from concurrent.futures import ThreadPoolExecutor
 import os
 import numpy as np
 from glob import glob
-from aicssegmentation.core.pre_processing_utils import  edge_preserving_smoothing_3d
-from skimage.morphology import remove_small_objects, binary_closing, cube
-from aicssegmentation.core.utils import topology_preserving_thinning
 
 
 class ParameterTuning(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
+        self.profiler = StepProfiler()
+        self.process_pool = None
+        self.placeholder_cache = {}
+        self.refine_executor = ThreadPoolExecutor(max_workers = 1)
+        self.refinements = []
+        self.refine_timer = QTimer(self)
+        self.refine_timer.setInterval(100)
+        self.refine_timer.timeout.connect(lambda: self._apply_refinements())
+        # the mask, graph and parameters of the last skeleton, reused for measuring its branches
+        self.network = None
+        # the stack streamed from a folder while it is acquired, see _stream
+        self.stream_executor = ThreadPoolExecutor(max_workers = 1)
+        self.stream_future = None
+        self.stream_stop = False
+        self.stream_progress = (0, 0)
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setInterval(500)
+        self.stream_timer.timeout.connect(self._update_stream)
 
         # Labels
         self.l_preset_layer = QLabel("Select Layer")
@@ -36,6 +70,10 @@ class ParameterTuning(QWidget):
         self.l_8 = QLabel("post-hole-removing:")
         self.l_9 = QLabel("skeletonization:")
         self.l_10 = QLabel("voxel size (in micron):")
+        self.l_iterations = QLabel("iterations")
+        self.l_time_step = QLabel("time step")
+        self.l_tolerance = QLabel("tolerance")
+        self.l_memory_budget = QLabel("memory budget [GB]")
         self.l_scale = QLabel("scale")
         self.l_sigma = QLabel("- sigma")
         self.l_gamma = QLabel("- gamma")
@@ -59,7 +97,10 @@ class ParameterTuning(QWidget):
             "You may not need this step if (1) your image has little noise "
             "and (2) the segmentation results are accurate enough.<br><br>\n \n"
             "Parameters: \n"
-            "\t<p style='margin-left: 40px'>No parameters are needed.</p>\n \n"
+            "\t<p style='margin-left: 40px'>iterations: More iterations give more smoothing.<br>\n"
+            "\ttime step: The time step of each iteration, do not go above 0.0625.<br>\n"
+            "\ttolerance: If set, stop early once an iteration changes the image by less than this fraction of its intensity range.<br>\n"
+            "\tblockwise: Smooth the image in blocks in parallel, to save memory and time on large images.</p>\n \n"
             "Instruction: \n"
             "\t<p style='margin-left: 40px'>Select the image to smooth and click \"Run\".</p>"
         )
@@ -121,7 +162,32 @@ class ParameterTuning(QWidget):
         self.l_7.setToolTip("Any segmented objects smaller than min_size will be removed to clean up your result.")
         self.l_8.setToolTip("remove small holes in the segmentation to avoid loops in skeleton")
         self.l_9.setToolTip("show skeleton")
-        #TODO: add tooltip for l_10 (voxel)
+        self.l_prune = QLabel("prune branches shorter than")
+        self.l_prune.setToolTip(
+            "Side branches (ending freely on one side) shorter than this length (in voxels) are removed "
+            "from the skeleton. Leave empty to keep all branches."
+        )
+        self.l_max_radius = QLabel("largest radius")
+        self.l_max_radius.setToolTip(
+            "The radius of the vessels is measured as the distance of the skeleton to the background. "
+            "With a largest radius (in voxels), larger radii are clipped to it and the distances are "
+            "computed block by block in parallel. Leave empty for exact distances."
+        )
+        self.li_max_radius = QLineEdit()
+        self.li_max_radius.setPlaceholderText("exact")
+        self.l_network = QLabel("")
+        self.l_network.setWordWrap(True)
+        voxel_size_tip = (
+            "The physical size of a voxel along X, Y and Z (e.g., in micron).<br><br>\n\n"
+            "If all three values are set, smoothing, vesselness, closing and thinning take the "
+            "anisotropic voxel size into account directly, so the image does not need to be "
+            "made isotropic first. Sizes (sigma, kernel size, etc.) are then measured in voxels "
+            "along the finest axis.<br><br>\n\n"
+            "Instruction: \n"
+            "\t<p style='margin-left: 40px'>Enter the voxel size. Optionally, select an image and click "
+            "\"Make Isotropic\" to resample it.</p>"
+        )
+        self.l_10.setToolTip(voxel_size_tip)
         
         core_thresh_scale_tip = (
             "Larger value will result in higher threshold value,\n"
@@ -146,16 +212,40 @@ class ParameterTuning(QWidget):
         self.l_thin.setToolTip("How many pixels to thin your vessels by.")
         self.l_min_size.setToolTip("The minimum size of segmented objects to keep.")
         self.l_max_hole_size.setToolTip("the maximum size of holes to be filled")
+        self.l_iterations.setToolTip("The number of smoothing iterations.")
+        self.l_time_step.setToolTip("The time step of each iteration, important for numerical stability.")
+        self.l_tolerance.setToolTip("Leave empty to always run all iterations.")
+        self.l_memory_budget.setToolTip(
+            "The memory a preset may use for its results. Beyond it, results which are\n"
+            "not needed right now are moved to temporary files on disk.\n"
+            "Leave empty to use 80% of the available memory."
+        )
 
         # Line Edits
         self.li_x = QLineEdit()
         self.li_y = QLineEdit()
         self.li_z = QLineEdit()
+        self.li_tolerance = QLineEdit()
+        self.li_tolerance.setPlaceholderText("off")
+        self.li_memory_budget = QLineEdit()
+        self.li_memory_budget.setPlaceholderText("auto")
+        self.li_prune = QLineEdit()
+        self.li_prune.setPlaceholderText("off")
 
         # Call Function on pressing enter in the LineEdit
         # self.li_readable.returnPressed.connect(self._readable_test)
 
         # Sliders
+        self.s_iterations = QSlider()
+        self.s_iterations.setRange(1,50)
+        self.s_iterations.setValue(10)
+        self.s_iterations.setOrientation(Qt.Horizontal)
+        self.s_iterations.setPageStep(5)
+        self.s_time_step = QSlider()    # x10000 TO MAKE INT WORK
+        self.s_time_step.setRange(1,625)
+        self.s_time_step.setValue(625)
+        self.s_time_step.setOrientation(Qt.Horizontal)
+        self.s_time_step.setPageStep(25)
         self.s_scale = QSlider()    # DOUBLED TO MAKE INT WORK
         self.s_scale.setRange(0,50)
         self.s_scale.setValue(0)
@@ -198,6 +288,10 @@ class ParameterTuning(QWidget):
         self.s_max_hole_size.setPageStep(2)
 
         # Numeric Labels
+        self.n_iterations = QLabel()
+        self.n_iterations.setText("10")
+        self.n_time_step = QLabel()
+        self.n_time_step.setText("0.0625")
         self.n_scale = QLabel()
         self.n_scale.setText("0")
         self.n_sigma = QLabel()
@@ -216,6 +310,8 @@ class ParameterTuning(QWidget):
         self.n_max_hole_size.setText("10")
 
         # Link sliders and numeric labels
+        self.s_iterations.valueChanged.connect(self._update_iterations)
+        self.s_time_step.valueChanged.connect(self._update_time_step)
         self.s_scale.valueChanged.connect(self._update_scale)
         self.s_sigma.valueChanged.connect(self._update_sigma)
         self.s_gamma.valueChanged.connect(self._update_gamma)
@@ -225,8 +321,46 @@ class ParameterTuning(QWidget):
         self.s_min_size.valueChanged.connect(self._update_min_size)
         self.s_max_hole_size.valueChanged.connect(self._update_max_hole_size)
 
+        # Live preview: re-run the step whose parameter changed, debounced
+        self.preview_step = None
+        self.preview_statistics = {}
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(150)
+        self.preview_timer.timeout.connect(self._update_preview)
+        for slider, step in [
+            (self.s_iterations, "smoothing"),
+            (self.s_time_step, "smoothing"),
+            (self.s_scale, "threshold"),
+            (self.s_sigma, "vesselness"),
+            (self.s_gamma, "vesselness"),
+            (self.s_kernel_size, "closing"),
+            (self.s_min_thick, "thinning"),
+            (self.s_thin, "thinning"),
+            (self.s_min_size, "cleaning"),
+            (self.s_max_hole_size, "hole_removal"),
+        ]:
+            slider.valueChanged.connect(lambda value, step = step: self._request_preview(step))
+        self.viewer.dims.events.current_step.connect(lambda event: self._request_preview())
+
         # Buttons
         self.btn_preset = QPushButton("Run Preset")
+        self.btn_compare = QPushButton("Compare all Presets")
+        self.btn_compare.setToolTip(
+            "Run every preset on the selected layer and show the final masks side by side.\n"
+            "Steps the presets have in common are run only once."
+        )
+        self.btn_stream = QPushButton("Stream from folder")
+        self.btn_stream.setToolTip(
+            "Run the selected preset on a stack while it is acquired, one TIFF file per z-plane.\n"
+            "Planes are filtered as soon as their neighbors have arrived. The stack ends when no\n"
+            "plane arrived for a minute; click again to end it with the planes so far."
+        )
+        self.l_stream = QLabel("")
+        self.btn_config = QPushButton("Generate Config file")
+        self.btn_config.setToolTip("Save the steps and parameters that produced the selected layer as a config file.")
+        self.btn_apply_config = QPushButton("Apply Config file")
+        self.btn_apply_config.setToolTip("Run the steps of a config file on the selected layer.")
         self.btn_smoothing = QPushButton("Run")
         self.btn_isotropic = QPushButton("Make Isotropic")
         self.btn_threshold = QPushButton("Run")
@@ -237,9 +371,18 @@ class ParameterTuning(QWidget):
         self.btn_cleaning = QPushButton("Run")
         self.btn_hole = QPushButton("Run")
         self.btn_skeleton = QPushButton("Run")
+        self.btn_export_trace = QPushButton("Export JSON")
+        self.btn_clear_trace = QPushButton("Clear")
+        self.btn_sweep = QPushButton("Run Sweep")
+        self.btn_sweep_add = QPushButton("Add selected masks")
+        self.btn_sweep_add.setToolTip("Run the steps of the selected rows and add their results as layers.")
 
         # Add functions to buttons
         self.btn_preset.clicked.connect(self._run_preset)
+        self.btn_compare.clicked.connect(self._compare_presets)
+        self.btn_stream.clicked.connect(self._stream)
+        self.btn_config.clicked.connect(self._generate_config)
+        self.btn_apply_config.clicked.connect(self._apply_config)
         self.btn_smoothing.clicked.connect(self._smoothing)
         self.btn_isotropic.clicked.connect(self._isotropic)
         self.btn_threshold.clicked.connect(self._threshold)
@@ -250,6 +393,12 @@ class ParameterTuning(QWidget):
         self.btn_cleaning.clicked.connect(self._cleaning)
         self.btn_hole.clicked.connect(self._hole_removal)
         self.btn_skeleton.clicked.connect(self._skeleton)
+        self.btn_measure = QPushButton("Measure branches")
+        self.btn_measure.clicked.connect(self._measure)
+        self.btn_export_trace.clicked.connect(self._export_trace)
+        self.btn_clear_trace.clicked.connect(self._clear_trace)
+        self.btn_sweep.clicked.connect(self._run_sweep)
+        self.btn_sweep_add.clicked.connect(self._add_sweep_masks)
 
         # Horizontal lines
         self.line_1 = QWidget()
@@ -296,9 +445,66 @@ class ParameterTuning(QWidget):
         self.c_preset.addItem("Muscle")
         self.c_preset.addItem("Spinal Cord")
         self.c_preset.addItem("Tongue")
+        self.c_retention = QComboBox()
+        self.c_retention.addItem("show final result only")
+        self.c_retention.addItem("show final result, cache others on disk")
+        self.c_retention.addItem("show all results")
+        self.c_retention.setToolTip(
+            "Which results of a preset are added as layers.\n"
+            "The other results are added as hidden placeholder layers, which are\n"
+            "computed again (or loaded from the disk cache) once they are made visible."
+        )
+        self.c_scheduler = QComboBox()
+        self.c_scheduler.addItem("branches in parallel (threads)")
+        self.c_scheduler.addItem("branches in parallel (processes)")
+        self.c_scheduler.addItem("one step after another")
+        self.c_scheduler.setToolTip(
+            "How the independent threshold and vesselness branches of a preset are run.\n"
+            "Processes always run in parallel but take a few seconds to start the first time."
+        )
         self.c_preset_input = QComboBox()
         self.c_smoothing = QComboBox()
+        self.cb_blockwise = QCheckBox("blockwise (parallel)")
+        self.cb_blockwise.setToolTip("Smooth the image in blocks in parallel threads.")
         self.c_isotropic = QComboBox()
+        self.c_isotropic_target = QComboBox()
+        self.c_isotropic_target.addItem("upsample to finest axis")
+        self.c_isotropic_target.addItem("downsample to coarsest axis")
+        self.c_isotropic_target.setToolTip("Whether to resample all axes to the smallest or to the largest voxel size.")
+        self.cb_preview = QCheckBox("live preview on the current slice")
+        self.cb_preview.setToolTip(
+            "Run the step whose parameters are changed on the displayed slice only, as a 'preview' layer.\n"
+            "Draw a rectangle in a shapes layer named 'ROI' to preview only that region.\n"
+            "Press Run to process the whole volume."
+        )
+        self.cb_preview.toggled.connect(self._toggle_preview)
+        self.l_precision = QLabel("precision")
+        self.c_precision = QComboBox()
+        self.c_precision.addItems(list(PRECISIONS))
+        self.c_precision.setCurrentText("float32")
+        self.c_precision.setToolTip(
+            "The data type of continuous results (smoothed and resampled images).\n"
+            "float16 halves their memory; it is computed in float32 and only used for images within the float16 range."
+        )
+        self.l_progressive = QLabel("first results")
+        self.c_progressive = QComboBox()
+        self.c_progressive.addItem("full resolution")
+        self.c_progressive.addItem("coarse (2x) first")
+        self.c_progressive.addItem("coarse (4x) first")
+        self.c_progressive.setToolTip(
+            "Run steps and presets on a downsampled image first, with scaled parameters, and show that result at once.\n"
+            "The full resolution result is computed in the background and replaces it in place."
+        )
+        self.cb_lazy = QCheckBox("lazy (dask, chunked)")
+        self.cb_lazy.setToolTip(
+            "Run presets and config files chunk by chunk with dask.\n"
+            "Results are computed when they are displayed, only for the chunks under the current slice.\n"
+            "Thresholds and vesselness cutoffs need their whole input, which is computed and kept in memory first.\n"
+            "Steps on connected components (hole removal, thinning, cleaning, skeleton) are computed at once,\n"
+            "so all presets compute their final result completely."
+        )
+        self.cb_anti_aliasing = QCheckBox("anti-aliasing")
+        self.cb_anti_aliasing.setToolTip("Apply a Gaussian filter before downsampling to avoid aliasing artifacts.")
         self.c_threshold = QComboBox()
         self.c_vesselness = QComboBox()
         self.c_operation_dim = QComboBox()
@@ -309,6 +515,7 @@ class ParameterTuning(QWidget):
         self.c_cutoff_method.addItem("threshold_li")
         self.c_cutoff_method.addItem("threshold_triangle")
         self.c_cutoff_method.addItem("threshold_otsu")
+        self.c_cutoff_method.currentIndexChanged.connect(lambda index: self._request_preview("vesselness"))
         self.c_merge_1 = QComboBox()
         self.c_merge_2 = QComboBox()
         self.c_merge_3 = QComboBox()
@@ -317,6 +524,9 @@ class ParameterTuning(QWidget):
         self.c_cleaning = QComboBox()
         self.c_hole = QComboBox()
         self.c_skeleton = QComboBox()
+        self.c_sweep = QComboBox()
+        self.c_sweep_reference = QComboBox()
+        self.c_mesh = QComboBox()
         self.list_comboboxes = [
             self.c_preset_input,
             self.c_smoothing,
@@ -330,15 +540,19 @@ class ParameterTuning(QWidget):
             self.c_thinning,
             self.c_cleaning,
             self.c_hole,
-            self.c_skeleton
+            self.c_skeleton,
+            self.c_sweep,
+            self.c_sweep_reference,
+            self.c_mesh
         ]
 
-        # Add content to layer selecting comboboxes
-        self._update_layer_lists()
-        self.viewer.layers.events.inserted.connect(self._update_layer_lists)
-        self.viewer.layers.events.removed.connect(self._update_layer_lists)
-        self.viewer.layers.events.reordered.connect(self._update_layer_lists)
-        self.viewer.layers.events.changed.connect(self._update_layer_lists)
+        # Add content to layer selecting comboboxes: all of them view one shared model
+        self.layer_model = LayerListModel(self.viewer, parent = self)
+        self.merge_3_model = QConcatenateTablesProxyModel(self)
+        self.merge_3_model.addSourceModel(QStringListModel(["N/A"], self))
+        self.merge_3_model.addSourceModel(self.layer_model)
+        for box in self.list_comboboxes:
+            box.setModel(self.merge_3_model if box in (self.c_merge_3, self.c_sweep_reference) else self.layer_model)
 
         # Zone 0 (Preset Zone)
 
@@ -354,7 +568,27 @@ class ParameterTuning(QWidget):
         self.zone_0.setLayout(QVBoxLayout())
         self.zone_0.layout().addWidget(self.h_0_1)
         self.zone_0.layout().addWidget(self.h_0_2)
+        self.h_0_3 = QWidget()
+        self.h_0_3.setLayout(QHBoxLayout())
+        self.h_0_3.layout().addWidget(self.l_memory_budget)
+        self.h_0_3.layout().addWidget(self.li_memory_budget)
+        self.zone_0.layout().addWidget(self.c_retention)
+        self.zone_0.layout().addWidget(self.c_scheduler)
+        self.zone_0.layout().addWidget(self.h_0_3)
+        self.zone_0.layout().addWidget(self.cb_lazy)
         self.zone_0.layout().addWidget(self.btn_preset)
+        self.zone_0.layout().addWidget(self.btn_compare)
+        self.zone_0.layout().addWidget(self.btn_stream)
+        self.zone_0.layout().addWidget(self.l_stream)
+        self.l_compare = QLabel("")
+        self.t_compare = QTableWidget(0, 4)
+        self.t_compare.setHorizontalHeaderLabels(["preset", "foreground [%]", "components", "Dice with majority"])
+        self.t_compare.setToolTip("The final mask of each preset, compared with the voxels most presets agree on.")
+        self.t_compare.setVisible(False)
+        self.zone_0.layout().addWidget(self.l_compare)
+        self.zone_0.layout().addWidget(self.t_compare)
+        self.zone_0.layout().addWidget(self.btn_config)
+        self.zone_0.layout().addWidget(self.btn_apply_config)
 
         # Zone 1 (Smoothing)
         self.h_1 = QWidget()
@@ -362,9 +596,27 @@ class ParameterTuning(QWidget):
         self.h_1.layout().addWidget(self.l_1)
         self.h_1.layout().addWidget(self.c_smoothing)
         self.h_1.layout().addWidget(self.btn_smoothing)
+        self.h_1_2 = QWidget()
+        self.h_1_2.setLayout(QHBoxLayout())
+        self.h_1_2.layout().addWidget(self.l_iterations)
+        self.h_1_2.layout().addWidget(self.s_iterations)
+        self.h_1_2.layout().addWidget(self.n_iterations)
+        self.h_1_3 = QWidget()
+        self.h_1_3.setLayout(QHBoxLayout())
+        self.h_1_3.layout().addWidget(self.l_time_step)
+        self.h_1_3.layout().addWidget(self.s_time_step)
+        self.h_1_3.layout().addWidget(self.n_time_step)
+        self.h_1_4 = QWidget()
+        self.h_1_4.setLayout(QHBoxLayout())
+        self.h_1_4.layout().addWidget(self.l_tolerance)
+        self.h_1_4.layout().addWidget(self.li_tolerance)
+        self.h_1_4.layout().addWidget(self.cb_blockwise)
         self.zone_1 = QWidget()
         self.zone_1.setLayout(QVBoxLayout())
         self.zone_1.layout().addWidget(self.h_1)
+        self.zone_1.layout().addWidget(self.h_1_2)
+        self.zone_1.layout().addWidget(self.h_1_3)
+        self.zone_1.layout().addWidget(self.h_1_4)
 
         # Zone 2 (Core-Threshold)
         self.h_2_1 = QWidget()
@@ -509,9 +761,21 @@ class ParameterTuning(QWidget):
         self.h_9_1.layout().addWidget(self.l_9)
         self.h_9_1.layout().addWidget(self.c_skeleton)
         self.h_9_1.layout().addWidget(self.btn_skeleton)
+        self.h_9_2 = QWidget()
+        self.h_9_2.setLayout(QHBoxLayout())
+        self.h_9_2.layout().addWidget(self.l_prune)
+        self.h_9_2.layout().addWidget(self.li_prune)
         self.zone_9 = QWidget()
         self.zone_9.setLayout(QVBoxLayout())
         self.zone_9.layout().addWidget(self.h_9_1)
+        self.zone_9.layout().addWidget(self.h_9_2)
+        self.h_9_3 = QWidget()
+        self.h_9_3.setLayout(QHBoxLayout())
+        self.h_9_3.layout().addWidget(self.l_max_radius)
+        self.h_9_3.layout().addWidget(self.li_max_radius)
+        self.h_9_3.layout().addWidget(self.btn_measure)
+        self.zone_9.layout().addWidget(self.h_9_3)
+        self.zone_9.layout().addWidget(self.l_network)
 
         # Zone 10 (Voxel)
         self.h_10_1 = QWidget()
@@ -533,6 +797,8 @@ class ParameterTuning(QWidget):
         self.zone_10.layout().addWidget(self.h_10_1)
         self.zone_10.layout().addWidget(self.h_10_2)
         self.zone_10.layout().addWidget(self.h_10_3)
+        self.zone_10.layout().addWidget(self.c_isotropic_target)
+        self.zone_10.layout().addWidget(self.cb_anti_aliasing)
         self.zone_10.layout().addWidget(self.btn_isotropic)
 
         # Merge zones
@@ -562,17 +828,111 @@ class ParameterTuning(QWidget):
         #self.zone_post.layout().addWidget(self.line_7)
         #self.zone_post.layout().addWidget(self.zone_9)
 
+        # Zone 12 (Parameter sweep)
+        self.l_sweep = QLabel("Select Layer")
+        self.l_sweep_reference = QLabel("reference mask")
+        self.cb_sweep_smoothing = QCheckBox("smooth first (pre-processing parameters)")
+        self.l_sweep_scale = QLabel("- threshold scales")
+        self.li_sweep_scale = QLineEdit("2, 3, 4")
+        self.l_sweep_sigma = QLabel("- vesselness sigmas")
+        self.li_sweep_sigma = QLineEdit("1, 2")
+        self.l_sweep_gamma = QLabel("- vesselness gammas")
+        self.li_sweep_gamma = QLineEdit("5")
+        self.l_sweep_cutoff = QLabel("- cutoff-methods")
+        self.li_sweep_cutoff = QLineEdit("threshold_li, threshold_otsu, threshold_triangle")
+        for line_edit in (self.li_sweep_scale, self.li_sweep_sigma, self.li_sweep_gamma, self.li_sweep_cutoff):
+            line_edit.setToolTip("Comma separated values, leave empty to skip.")
+        self.t_sweep = QTableWidget(0, 8)
+        self.t_sweep.setHorizontalHeaderLabels(
+            ["step", "parameters", "cutoff", "foreground [%]", "Dice", "Jaccard", "precision", "recall"]
+        )
+        self.t_sweep.setSelectionBehavior(QTableWidget.SelectRows)
+        self.t_sweep.setToolTip(
+            "One row per parameter combination. The agreement columns compare with the reference mask.\n"
+            "Select rows and add their masks as layers."
+        )
+        self.sweep_rows = []
+        self.sweep_input = None
+        self.zone_12 = QWidget()
+        self.zone_12.setLayout(QVBoxLayout())
+        for label, widget in [
+            (self.l_sweep, self.c_sweep),
+            (self.l_sweep_reference, self.c_sweep_reference),
+            (self.l_sweep_scale, self.li_sweep_scale),
+            (self.l_sweep_sigma, self.li_sweep_sigma),
+            (self.l_sweep_gamma, self.li_sweep_gamma),
+            (self.l_sweep_cutoff, self.li_sweep_cutoff),
+        ]:
+            row = QWidget()
+            row.setLayout(QHBoxLayout())
+            row.layout().addWidget(label)
+            row.layout().addWidget(widget)
+            self.zone_12.layout().addWidget(row)
+        self.zone_12.layout().addWidget(self.cb_sweep_smoothing)
+        self.zone_12.layout().addWidget(self.btn_sweep)
+        self.zone_12.layout().addWidget(self.t_sweep)
+        self.zone_12.layout().addWidget(self.btn_sweep_add)
+
+        # Zone 13 (Surface mesh)
+        self.l_mesh = QLabel("Select Layer")
+        self.l_mesh_faces = QLabel("triangle budget")
+        self.li_mesh_faces = QLineEdit("200000")
+        self.li_mesh_faces.setToolTip("The mesh is simplified to at most this many triangles. Leave empty to keep all triangles.")
+        self.btn_mesh = QPushButton("Show surface")
+        self.btn_mesh.setToolTip("Show the surface of the selected mask as a mesh, much faster to render in 3D than the voxels.")
+        self.btn_mesh.clicked.connect(self._mesh)
+        self.btn_mesh_save = QPushButton("Save mesh")
+        self.btn_mesh_save.clicked.connect(self._save_mesh)
+        self.zone_13 = QWidget()
+        self.zone_13.setLayout(QVBoxLayout())
+        for widgets in [(self.l_mesh, self.c_mesh), (self.l_mesh_faces, self.li_mesh_faces), (self.btn_mesh, self.btn_mesh_save)]:
+            row = QWidget()
+            row.setLayout(QHBoxLayout())
+            for widget in widgets:
+                row.layout().addWidget(widget)
+            self.zone_13.layout().addWidget(row)
+
+        # Zone 11 (Profiling)
+        self.t_profiling = QTableWidget(0, 7)
+        self.t_profiling.setHorizontalHeaderLabels(
+            ["step", "wall [s]", "CPU [s]", "peak memory [MB]", "input", "output", "MVoxel/s"]
+        )
+        self.t_profiling.setToolTip(
+            "Time and memory used by each step that was run.\n"
+            "Peak memory covers NumPy arrays but not memory used inside ITK filters."
+        )
+        self.profiler.callbacks.append(self._add_profiling_row)
+        self.h_11 = QWidget()
+        self.h_11.setLayout(QHBoxLayout())
+        self.h_11.layout().addWidget(self.btn_export_trace)
+        self.h_11.layout().addWidget(self.btn_clear_trace)
+        self.zone_11 = QWidget()
+        self.zone_11.setLayout(QVBoxLayout())
+        self.zone_11.layout().addWidget(self.t_profiling)
+        self.zone_11.layout().addWidget(self.h_11)
+
         # Putting zones in collapsible toolbox areas
         self.t_collapse = QToolBox()
         self.t_collapse.addItem(self.zone_pre, "pre-processing")
         self.t_collapse.addItem(self.zone_core, "core-segmentation")
         self.t_collapse.addItem(self.zone_post, "post-processing")
         self.t_collapse.addItem(self.zone_0, "presets")
+        self.t_collapse.addItem(self.zone_12, "parameter sweep")
+        self.t_collapse.addItem(self.zone_13, "surface mesh")
+        self.t_collapse.addItem(self.zone_11, "profiling")
 
         # Layouting
         self.content = QWidget()
         self.content.setLayout(QVBoxLayout())
         self.content.layout().addWidget(self.l_title)
+        self.content.layout().addWidget(self.cb_preview)
+        self.h_progressive = QWidget()
+        self.h_progressive.setLayout(QHBoxLayout())
+        self.h_progressive.layout().addWidget(self.l_progressive)
+        self.h_progressive.layout().addWidget(self.c_progressive)
+        self.h_progressive.layout().addWidget(self.l_precision)
+        self.h_progressive.layout().addWidget(self.c_precision)
+        self.content.layout().addWidget(self.h_progressive)
         self.content.layout().addWidget(self.t_collapse)
         self.content.layout().addWidget(self.zone_9)
         self.no_scroll_area = QWidget()
@@ -588,6 +948,12 @@ class ParameterTuning(QWidget):
     #    print('The LineEdit reads "' + self.li_readable.displayText() + '"')
 
     # Slider update functions
+    def _update_iterations(self):
+        self.n_iterations.setText(str(self.s_iterations.value()))
+
+    def _update_time_step(self):
+        self.n_time_step.setText(str(self.s_time_step.value()/10000))
+
     def _update_scale(self):
         self.n_scale.setText(str(self.s_scale.value()/2))
 
@@ -612,10 +978,113 @@ class ParameterTuning(QWidget):
     def _update_max_hole_size(self):
         self.n_max_hole_size.setText(str(self.s_max_hole_size.value()))
 
+    def _get_spacing(self):
+        """
+        read the voxel size from the line edits
+
+        Return
+        -------------
+        tuple or None
+            the relative voxel spacing in ZYX order, or None if the voxel size is not (fully) set
+        """
+        try:
+            spacing = (
+                float(self.li_z.displayText()),
+                float(self.li_y.displayText()),
+                float(self.li_x.displayText())
+            )
+        except ValueError:
+            return None
+        return normalize_spacing(spacing)
+
+    def _provenance_id(self, data):
+        """
+        get the provenance id of the layer holding the given data, None if there is no such layer
+        """
+        for layer in self.viewer.layers:
+            if type(layer) == Image and layer.data is data:
+                return layer_id(layer)
+        return None
+
+    def _run_step(self, step, name, inputs, params, metadata = None, **kwargs):
+        """
+        run a pipeline step on the input arrays and add the result as a new layer
+
+        The new layer records (in its metadata) the step, its parameters and its input layers.
+
+        Parameters:
+        -------------
+        step: str
+            the name of the step, see vessel_express.pipeline.STEPS
+        name: str
+            the name of the new layer
+        inputs: list
+            the input arrays
+        params: dict
+            the parameters of the step
+        metadata: dict
+            additional metadata of the new layer
+        kwargs:
+            passed on to viewer.add_image
+        Return
+        -------------
+        np.ndarray or dask.array.Array
+            dask arrays as inputs give a lazily computed dask array. With coarse first
+            results, the coarse result; the full result replaces it in the layer later.
+        """
+        inputs = [self._input_data(data) for data in inputs]
+        layer_metadata = provenance(step, params, [self._provenance_id(data) for data in inputs])
+        layer_metadata.update(metadata or {})
+        factor = self._coarse_factor()
+        if factor > 1 and step != "isotropic" and not any(hasattr(data, "dask") for data in inputs):
+            coarse_inputs = [downsample(data, factor) for data in inputs]
+            coarse = coarse_params(step, params, factor)
+            with self.profiler.profile("coarse_" + step, *coarse_inputs, params = coarse) as record:
+                out = STEPS[step](*coarse_inputs, **coarse)
+                record.output(out)
+            layer = self._add_coarse(out, name, layer_metadata, factor, inputs[0].shape, **kwargs)
+            self._refine(
+                lambda: execute(step, params, inputs),
+                lambda result: self._replace_coarse(layer, result[0], result[1])
+            )
+            return out
+        with self.profiler.profile(step, *inputs, params = params) as record:
+            if any(hasattr(data, "dask") for data in inputs):
+                out = lazy_step(step, *inputs, **params)
+            else:
+                out = STEPS[step](*inputs, **params)
+            record.output(out)
+        self.viewer.add_image(data = out, name = name, metadata = layer_metadata, **kwargs)
+        return out
+
     # Button onclick functions
-    def _smoothing(self, preset = False, data = ""):
+    def _smoothing(self, preset = False, data = "", spacing = None, n_iter = 10, time_step = 0.0625, tolerance = None, blockwise = False, precision = "float32"):
         """
         perform edge preserving smoothing
+
+        The result is tagged (layer metadata) with the parameters and a fingerprint
+        of the input, so that smoothing the same data with the same parameters again,
+        e.g., when running several presets, reuses the existing layer.
+
+        Parameters:
+        -------------
+        data: np.ndarray
+            the image to be smoothed
+        spacing: tuple
+            the relative voxel spacing in ZYX order, None for isotropic voxels
+        n_iter: int
+            the number of smoothing iterations
+        time_step: float
+            the time step of each iteration
+        tolerance: float
+            stop early once an iteration changes the image less than this (relative), None to run all iterations
+        blockwise: bool
+            whether to smooth in blocks in parallel threads
+        precision: str
+            the data type of the result, see vessel_express.utils.precision_dtypes
+        Return
+        -------------
+        np.ndarray
         """
 
         if not preset:
@@ -624,13 +1093,37 @@ class ParameterTuning(QWidget):
                 if layer.name == selected_layer and type(layer) == Image:
                     data = layer.data
                     break
-        out = edge_preserving_smoothing_3d(data)
-        self.viewer.add_image(data = out, name = "smoothed_Image")
+            spacing = self._get_spacing()
+            n_iter = self.s_iterations.value()
+            time_step = self.s_time_step.value()/10000
+            try:
+                tolerance = float(self.li_tolerance.displayText())
+            except ValueError:
+                tolerance = None
+            blockwise = self.cb_blockwise.isChecked()
+            precision = self.c_precision.currentText()
+        params = {"spacing": spacing, "n_iter": n_iter, "time_step": time_step, "tolerance": tolerance, "blockwise": blockwise, "precision": precision}
+        fingerprint = array_fingerprint(data)
+        for layer in self.viewer.layers:
+            if (
+                type(layer) == Image
+                and not layer.metadata.get("placeholder")
+                and not layer.metadata.get("coarse")
+                and layer.metadata.get("step") == "smoothing"
+                and layer.metadata.get("params") == params
+                and layer.metadata.get("fingerprint") == fingerprint
+            ):
+                out = layer.data
+                break
+        else:
+            out = self._run_step("smoothing", "smoothed_Image", [data], params, metadata = {"fingerprint": fingerprint})
         if preset:
             return out
 
     def _isotropic(self):
-        from skimage.transform import rescale
+        """
+        resample the selected image to isotropic voxels, block by block in parallel
+        """
         selected_layer = self.c_isotropic.currentText()
         for layer in self.viewer.layers:
             if layer.name == selected_layer and type(layer) == Image:
@@ -639,9 +1132,9 @@ class ParameterTuning(QWidget):
         x = float(self.li_x.displayText())
         y = float(self.li_y.displayText())
         z = float(self.li_z.displayText())
-        largest_dim = max(1/x, 1/y, 1/z)
-        out = rescale(image, scale=(z * largest_dim, y * largest_dim, x * largest_dim), order=1)
-        self.viewer.add_image(data = out, name = f"isotropic_{x}_{y}_{z}", blending="additive")
+        target = ["finest", "coarsest"][self.c_isotropic_target.currentIndex()]
+        params = {"zoom": isotropic_zoom((z, y, x), target), "anti_aliasing": self.cb_anti_aliasing.isChecked(), "precision": self.c_precision.currentText()}
+        self._run_step("isotropic", f"isotropic_{x}_{y}_{z}", [image], params, blending="additive")
 
     def _threshold(self, preset = False, image = "", scale = 0):   # HALVE VALUE
         """
@@ -665,14 +1158,11 @@ class ParameterTuning(QWidget):
                     image = layer.data
                     break
             scale = self.s_scale.value()/2
-        thresh = image.mean() + scale * image.std()
-        out = image > thresh
-        out = 1 * out       # convert from bool to int
-        self.viewer.add_image(data = out, name = f"threshold_{scale}", blending="additive")
+        out = self._run_step("threshold", f"threshold_{scale}", [image], {"scale": scale}, blending="additive")
         if preset:
             return out
 
-    def _vesselness(self, preset = False, image = "", sigma = 0, gamma = 5, dim = 3, cutoff_method = ""):  # HALVE VALUE
+    def _vesselness(self, preset = False, image = "", sigma = 0, gamma = 5, dim = 3, cutoff_method = "", spacing = None):  # HALVE VALUE
         """
         apply vesselness filter on images
         Parameters:
@@ -685,6 +1175,8 @@ class ParameterTuning(QWidget):
             the kernal size of the vesselness filter
         cutoff_method: str
             the method to use for binarization
+        spacing: tuple
+            the relative voxel spacing in ZYX order, None for isotropic voxels
         Return
         -------------
         np.ndarray
@@ -700,9 +1192,9 @@ class ParameterTuning(QWidget):
             sigma = self.s_sigma.value()/2
             gamma = self.s_gamma.value()
             cutoff_method = self.c_cutoff_method.currentText()
-        out = vesselness_filter(image, dim, sigma, gamma, cutoff_method)
-        out = 1 * out
-        self.viewer.add_image(data = out, name = f"ves_{sigma}_{gamma}_{cutoff_method}", blending="additive")
+            spacing = self._get_spacing()
+        params = {"sigma": sigma, "gamma": gamma, "dim": dim, "cutoff_method": cutoff_method, "spacing": spacing}
+        out = self._run_step("vesselness", f"ves_{sigma}_{gamma}_{cutoff_method}", [image], params, blending="additive")
         if preset:
             return out
 
@@ -713,28 +1205,20 @@ class ParameterTuning(QWidget):
                 self.c_merge_2.currentText(),
                 self.c_merge_3.currentText()
             ]
-            counter = 0
+            inputs = []
             for layer in self.viewer.layers:
                 if layer.name in layer_list and type(layer) == Image:
-                    image = layer.data
-                    if counter == 0:
-                        seg = image > 0
-                    else:
-                        seg = np.logical_or(seg, image > 0)
-                    counter += 1
-                    if counter == 3:
+                    inputs.append(layer.data)
+                    if len(inputs) == 3:
                         break
         else:
-            seg = data1 > 0
-            seg = np.logical_or(seg, data2 > 0)
-            if layers == 3:
-                seg = np.logical_or(seg, data3 > 0)
-        self.viewer.add_image(data = seg, name = "merged_segmentation", blending="additive")
+            inputs = [data1, data2, data3][:max(layers, 2)]
+        seg = self._run_step("merge", "merged_segmentation", inputs, {}, blending="additive")
         if preset:
             return seg
         
 
-    def _closing(self, preset = False, image = "", kernel = 0):
+    def _closing(self, preset = False, image = "", kernel = 0, spacing = None):
         """
         perform morphological closing to remove small gaps in segmentation
         Parameters:
@@ -743,6 +1227,8 @@ class ParameterTuning(QWidget):
             the image to be applied on
         scale: int
             the kernal size of the closing operation
+        spacing: tuple
+            the relative voxel spacing in ZYX order, None for isotropic voxels
         Return
         -------------
         np.ndarray
@@ -755,34 +1241,8 @@ class ParameterTuning(QWidget):
                     image = layer.data
                     break
             kernel = self.s_kernel_size.value()
-        out = binary_closing(image, cube(kernel))
-        self.viewer.add_image(data = out, name = f"closing_{kernel}", blending="additive")
-        if preset:
-            return out
-    
-    def _hole_removal(self, preset = False, image = "", max_size = 0):
-        """
-        remove small holes in segmentation
-        Parameters:
-        -------------
-        image: np.ndarray
-            the image to be applied on
-        max_size: int
-            the max hole size to remove
-        Return
-        -------------
-        np.ndarray
-        """
-        from aicssegmentation.core.utils import hole_filling
-        if not preset:
-            selected_layer = self.c_hole.currentText()
-            for layer in self.viewer.layers:
-                if layer.name == selected_layer and type(layer) == Image:
-                    image = layer.data
-                    break
-            max_size = self.s_max_hole_size.value()
-        out = hole_filling(image, hole_min=1, hole_max=max_size, fill_2d=True)
-        self.viewer.add_image(data = out, name = f"hole_filled_{max_size}", blending="additive")
+            spacing = self._get_spacing()
+        out = self._run_step("closing", f"closing_{kernel}", [image], {"kernel": kernel, "spacing": spacing}, blending="additive")
         if preset:
             return out
     
@@ -799,7 +1259,6 @@ class ParameterTuning(QWidget):
         -------------
         np.ndarray
         """
-        from aicssegmentation.core.utils import hole_filling
         if not preset:
             selected_layer = self.c_hole.currentText()
             for layer in self.viewer.layers:
@@ -807,12 +1266,11 @@ class ParameterTuning(QWidget):
                     image = layer.data
                     break
             max_size = self.s_max_hole_size.value()
-        out = hole_filling(image, hole_min=1, hole_max=max_size, fill_2d=True)
-        self.viewer.add_image(data = out, name = "filled_holes_seg", blending="additive")
+        out = self._run_step("hole_removal", "filled_holes_seg", [image], {"max_size": max_size}, blending="additive")
         if preset:
             return out
 
-    def _thinning(self, preset = False, image ="", min_thickness = 0, thin = 0):    # HALVE ONE VALUE
+    def _thinning(self, preset = False, image ="", min_thickness = 0, thin = 0, spacing = None):    # HALVE ONE VALUE
         """
         perform topology preserving thinning
         Parameters:
@@ -823,6 +1281,8 @@ class ParameterTuning(QWidget):
             the minimal thickness to kept without breaking
         thin: int
             the amount of thinning
+        spacing: tuple
+            the relative voxel spacing in ZYX order, None for isotropic voxels
         Return
         -------------
         np.ndarray
@@ -836,9 +1296,9 @@ class ParameterTuning(QWidget):
                     break
             min_thickness = self.s_min_thick.value()/2
             thin = self.s_thin.value()
-        out = topology_preserving_thinning(image > 0, min_thickness, thin)
-
-        self.viewer.add_image(data = out, name = f"thinned_{min_thickness}_{thin}", blending="additive")
+            spacing = self._get_spacing()
+        params = {"min_thickness": min_thickness, "thin": thin, "spacing": spacing}
+        out = self._run_step("thinning", f"thinned_{min_thickness}_{thin}", [image], params, blending="additive")
         if preset:
             return out
 
@@ -863,81 +1323,571 @@ class ParameterTuning(QWidget):
                     image = layer.data
                     break
             min_size = self.s_min_size.value()
-        out = remove_small_objects(image > 0, min_size)
-        self.viewer.add_image(data = out, name = f"cleaned_{min_size}", blending="additive")
+        out = self._run_step("cleaning", f"cleaned_{min_size}", [image], {"min_size": min_size}, blending="additive")
         if preset:
             return out
 
-    def _skeleton(self, preset = False, image =""):    # HALVE ONE VALUE
+    def _skeleton(self, preset = False, image ="", min_branch_length = 0, spacing = None):    # HALVE ONE VALUE
         """
         perform skeletonization
 
+        The skeleton is shown as a points layer of its voxels instead of a (mostly
+        empty) image, and summarized as a vessel network (see vessel_express.graph).
+
         Parameters:
         -------------
         image: np.ndarray
             the image to be applied on
+        min_branch_length: float
+            the length of the shortest side branches to keep, 0 to keep all branches
+        spacing: tuple
+            the relative voxel spacing in ZYX order, None for isotropic voxels
 
         Return
         -------------
         np.ndarray
         """
-        from skimage.morphology import skeletonize_3d
         if not preset:
             selected_layer = self.c_skeleton.currentText()
             for layer in self.viewer.layers:
                 if layer.name == selected_layer and type(layer) == Image:
                     image = layer.data
                     break
-        out = skeletonize_3d(image > 0)
-
-        self.viewer.add_image(data = out, name = "skeleton", blending="additive")
+            try:
+                min_branch_length = float(self.li_prune.displayText())
+            except ValueError:
+                min_branch_length = 0
+            spacing = self._get_spacing()
+        image = self._input_data(image)
+        params = {"min_branch_length": min_branch_length, "spacing": spacing} if min_branch_length else {}
+        layer_metadata = provenance("skeleton", params, [self._provenance_id(image)])
+        with self.profiler.profile("skeleton", image, params = params) as record:
+            out, graph = skeleton_network(np.asarray(image), min_branch_length, spacing)
+            record.output(out)
+        self.network = (image, graph, (min_branch_length, spacing))
+        statistics = network_statistics(graph)
+        layer_metadata["network"] = statistics
+        self.viewer.add_points(graph.coordinates, name = "skeleton", size = 1, face_color = "yellow", metadata = layer_metadata)
+        self.l_network.setText(
+            f"length {statistics['length']:.1f}, {statistics['branches']} branches, {statistics['junctions']} junctions, "
+            f"{statistics['end_points']} end points, mean tortuosity {statistics['tortuosity']:.3f}"
+        )
         if preset:
             return out
 
-    def _skeleton(self, preset = False, image =""):    # HALVE ONE VALUE
+    def _measure(self):
         """
-        perform skeletonization
+        measure radius, length and volume of each branch of the skeleton of the
+        selected mask (see vessel_express.measure) and save them as a table
+        """
+        selected_layer = self.c_skeleton.currentText()
+        data = None
+        for layer in self.viewer.layers:
+            if layer.name == selected_layer and type(layer) == Image:
+                data = self._input_data(layer.data)
+                break
+        if data is None:
+            return
+        try:
+            min_branch_length = float(self.li_prune.displayText())
+        except ValueError:
+            min_branch_length = 0
+        try:
+            max_radius = float(self.li_max_radius.displayText())
+        except ValueError:
+            max_radius = None
+        spacing = self._get_spacing()
+        graph = None
+        if self.network is not None and self.network[0] is data and self.network[2] == (min_branch_length, spacing):
+            graph = self.network[1]
+        with self.profiler.profile("measure", data, params = {"max_radius": max_radius}):
+            table = measure_network(np.asarray(data), spacing, min_branch_length, max_radius, graph)
+        radius = table["mean_radius"][table["voxels"] > 0]
+        self.l_network.setText(
+            f"{len(table['branch'])} branches measured, total volume {table['volume'].sum():.1f}, "
+            f"median radius {np.median(radius) if len(radius) else float('nan'):.2f}"
+        )
+        filename = QFileDialog.getSaveFileName(self, caption = "Save branch measurements", filter = "*.csv;;*.parquet")
+        if filename[0]:
+            try:
+                save_table(table, filename[0])
+            except ImportError as e:
+                msg = QMessageBox()
+                msg.setText(str(e))
+                msg.exec()
+
+    # Surface mesh functions
+    def _mesh_of_selection(self):
+        """
+        the decimated surface mesh of the selected mask (see vessel_express.mesh), None without a selected mask
+        """
+        selected_layer = self.c_mesh.currentText()
+        for layer in self.viewer.layers:
+            if layer.name == selected_layer and type(layer) == Image:
+                data = self._input_data(layer.data)
+                break
+        else:
+            return None
+        try:
+            max_faces = int(self.li_mesh_faces.displayText())
+        except ValueError:
+            max_faces = None
+        with self.profiler.profile("mesh", data, params = {"max_faces": max_faces}) as record:
+            vertices, faces = mask_mesh(data, self._get_spacing())
+            if max_faces is not None:
+                vertices, faces = decimate(vertices, faces, max_faces)
+            record.output(vertices, faces)
+        return selected_layer, vertices, faces
+
+    def _mesh(self):
+        mesh = self._mesh_of_selection()
+        if mesh is None:
+            return
+        name, vertices, faces = mesh
+        # the vertices are in voxels along the finest axis: place them like the (unscaled) image
+        scale = self._get_spacing()
+        scale = (1, 1, 1) if scale is None else tuple(min(scale) / np.asarray(scale))
+        self.viewer.add_surface((vertices, faces), name = f"surface_{name}", colormap = "magenta", scale = scale)
+
+    def _save_mesh(self):
+        mesh = self._mesh_of_selection()
+        if mesh is None:
+            return
+        filename = QFileDialog.getSaveFileName(self, caption = "Save mesh", filter = "*.ply;;*.obj")
+        if filename[0]:
+            save_mesh(filename[0], mesh[1], mesh[2])
+
+    # Pipeline export functions
+    def _stream(self):
+        """
+        run the selected preset on a stack while its planes are written to a folder (see vessel_express.streaming),
+        or end a running stream
+        """
+        if self.stream_future is not None:
+            self.stream_stop = True
+            return
+        directory = QFileDialog.getExistingDirectory(self, caption = "Select the folder the planes are written to")
+        if not directory:
+            return
+        store = QFileDialog.getExistingDirectory(self, caption = "Select an empty folder for the results")
+        if not store:
+            return
+        preset = self.c_preset.currentText()
+        head, tail = split_pipeline(preset_pipeline(preset, spacing = self._get_spacing(), precision = self.c_precision.currentText()))
+
+        def progress(stream):
+            self.stream_progress = (stream.n_planes, stream.processed)
+
+        def run():
+            result = stream_directory(directory, head, store, stop = lambda: self.stream_stop, on_planes = progress).read()
+            # the steps on connected components need the whole mask
+            return result if tail is None else run_pipeline(tail, result)
+
+        self.stream_stop = False
+        self.stream_progress = (0, 0)
+        self.stream_name = f"{preset}_{os.path.basename(directory)}"
+        self.stream_future = self.stream_executor.submit(run)
+        self.btn_stream.setText("End stream")
+        self.stream_timer.start()
+
+    def _update_stream(self):
+        """
+        show the progress of the stream, and its result once it is done
+        """
+        received, processed = self.stream_progress
+        self.l_stream.setText(f"{received} planes received, {processed} filtered")
+        if not self.stream_future.done():
+            return
+        self.stream_timer.stop()
+        future, self.stream_future = self.stream_future, None
+        self.btn_stream.setText("Stream from folder")
+        try:
+            result = future.result()
+        except (OSError, ValueError) as e:
+            msg = QMessageBox()
+            msg.setText(str(e))
+            msg.exec()
+            return
+        self.l_stream.setText(f"{received} planes segmented")
+        self.viewer.add_image(data = result, name = self.stream_name, blending = "additive")
+
+    def _generate_config(self):
+        """
+        save the minimal pipeline producing the selected layer as a config file
+        """
+        final = self.viewer.layers.selection.active
+        if final is None or "step" not in final.metadata:
+            msg = QMessageBox()
+            msg.setText("Please select the layer with your final segmentation result.")
+            msg.exec()
+            return
+        try:
+            config = build_pipeline(self.viewer.layers, final)
+        except ValueError as e:
+            msg = QMessageBox()
+            msg.setText(str(e))
+            msg.exec()
+            return
+        filename = QFileDialog.getSaveFileName(self, caption = "Save config file", filter = "*.json")
+        if filename[0]:
+            save_pipeline(config, filename[0])
+
+    def _apply_config(self):
+        """
+        run a saved pipeline on the layer selected for the presets
+        """
+        filename = QFileDialog.getOpenFileName(self, caption = "Open config file", filter = "*.json")
+        if not filename[0]:
+            return
+        config = load_pipeline(filename[0])
+        selected_layer = self.c_preset_input.currentText()
+        for layer in self.viewer.layers:
+            if layer.name == selected_layer and type(layer) == Image:
+                image = layer.data
+                break
+        image = self._input_data(image)
+        with self.profiler.profile("pipeline", image, params = {"config": filename[0]}) as record:
+            if self.cb_lazy.isChecked():
+                out = run_lazy(config, image, compute = False)
+            else:
+                out = run_pipeline(config, image)
+            record.output(out)
+        final_step = config["nodes"][-1]["step"]
+        self.viewer.add_image(data = out, name = f"{final_step}_{os.path.basename(filename[0])}", metadata = {"config": filename[0]}, blending="additive")
+
+    # Profiling functions
+    def _add_profiling_row(self, record):
+        def describe(arrays):
+            return ", ".join(f"{'x'.join(map(str, a['shape']))} {a['dtype']}" for a in arrays)
+
+        row = self.t_profiling.rowCount()
+        self.t_profiling.insertRow(row)
+        values = [
+            record.step,
+            f"{record.wall_time:.2f}",
+            f"{record.cpu_time:.2f}",
+            f"{record.peak_memory / 1024 ** 2:.1f}",
+            describe(record.inputs),
+            describe(record.outputs),
+            f"{record.throughput / 1e6:.2f}",
+        ]
+        for column, value in enumerate(values):
+            self.t_profiling.setItem(row, column, QTableWidgetItem(value))
+
+    def _export_trace(self):
+        filename = QFileDialog.getSaveFileName(self, caption = "Export profiling trace", filter = "*.json;;*.parquet")
+        if not filename[0]:
+            return
+        if not filename[0].endswith(".parquet"):
+            self.profiler.export_json(filename[0])
+            return
+        try:
+            write_table(self.profiler.to_columns(), filename[0])
+        except ImportError as e:
+            msg = QMessageBox()
+            msg.setText(str(e))
+            msg.exec()
+
+    def _clear_trace(self):
+        self.profiler.clear()
+        self.t_profiling.setRowCount(0)
+
+    # Sweep functions
+    def _run_sweep(self):
+        """
+        run the threshold and vesselness steps on a grid of parameters and list the results
+        """
+        def values(line_edit, convert = float):
+            return [convert(value.strip()) for value in line_edit.displayText().split(",") if value.strip()]
+
+        selected_layer = self.c_sweep.currentText()
+        for layer in self.viewer.layers:
+            if layer.name == selected_layer and type(layer) == Image:
+                image = self._input_data(layer.data)
+                break
+        spacing = self._get_spacing()
+        if self.cb_sweep_smoothing.isChecked():
+            try:
+                tolerance = float(self.li_tolerance.displayText())
+            except ValueError:
+                tolerance = None
+            # reuses an earlier smoothing result, and the result is reused later
+            smoothed = self._smoothing(preset = True, data = image, spacing = spacing, n_iter = self.s_iterations.value(), time_step = self.s_time_step.value()/10000, tolerance = tolerance, precision = self.c_precision.currentText())
+            image = self._input_data(smoothed)
+        reference = None
+        if self.c_sweep_reference.currentText() != "N/A":
+            reference = self._input_data(self.layer_model.layer(self.c_sweep_reference.currentText()).data)
+
+        params = {
+            "scales": values(self.li_sweep_scale),
+            "sigmas": values(self.li_sweep_sigma),
+            "gammas": values(self.li_sweep_gamma),
+            "cutoff_methods": values(self.li_sweep_cutoff, str),
+            "spacing": spacing,
+        }
+        with self.profiler.profile("sweep", image, params = params):
+            self.sweep_rows = sweep(image, reference = reference, **params)
+        self.sweep_input = image
+
+        self.t_sweep.setRowCount(0)
+        for row, result in enumerate(self.sweep_rows):
+            self.t_sweep.insertRow(row)
+            shown = {key: value for key, value in result["params"].items() if key not in ("dim", "spacing")}
+            cells = [
+                result["step"],
+                ", ".join(f"{key}={value}" for key, value in shown.items()),
+                f"{result['cutoff']:.4g}",
+                f"{100 * result['foreground']:.2f}",
+            ] + [f"{result[key]:.3f}" if key in result else "" for key in ("dice", "jaccard", "precision", "recall")]
+            for column, value in enumerate(cells):
+                self.t_sweep.setItem(row, column, QTableWidgetItem(value))
+
+    def _add_sweep_masks(self):
+        """
+        run the steps of the selected sweep rows and add their results as layers
+        """
+        rows = sorted({index.row() for index in self.t_sweep.selectionModel().selectedRows()})
+        for row in rows:
+            result = self.sweep_rows[row]
+            name = self._layer_name(result["step"], result["params"])
+            self._run_step(result["step"], name, [self.sweep_input], result["params"], blending = "additive")
+
+    # Progressive functions
+    def _coarse_factor(self):
+        """
+        the downsampling factor of the first results, 1 to compute at full resolution only
+        """
+        return [1, 2, 4][self.c_progressive.currentIndex()]
+
+    def _add_coarse(self, data, name, metadata, factor, shape, **kwargs):
+        """
+        add a result computed on the downsampled image, scaled to cover the full image
+        """
+        scale, translate = coarse_transform(shape, data.shape)
+        metadata = dict(metadata, coarse = factor)
+        return self.viewer.add_image(data = data, name = name, metadata = metadata, scale = scale, translate = translate, **kwargs)
+
+    def _replace_coarse(self, layer, data, record):
+        """
+        replace the data of a coarse layer by the full resolution result, in place
+        """
+        self.profiler.add(record)
+        layer.metadata.pop("coarse", None)
+        layer.data = data
+        layer.scale = (1,) * data.ndim
+        layer.translate = (0,) * data.ndim
+        layer.reset_contrast_limits()
+
+    def _refine(self, compute, apply):
+        """
+        run compute() in the background and apply(result) in the GUI thread once it is done
+        """
+        self.refinements.append((self.refine_executor.submit(compute), apply))
+        self.refine_timer.start()
+
+    def _apply_refinements(self, wait = False):
+        """
+        apply the finished background results, in the order they were started
 
         Parameters:
         -------------
-        image: np.ndarray
-            the image to be applied on
+        wait: bool
+            whether to wait for all results instead of applying only the finished ones
+        """
+        for refinement in list(self.refinements):
+            future, apply = refinement
+            if not (wait or future.done()):
+                break
+            self.refinements.remove(refinement)
+            apply(future.result())
+        if not self.refinements:
+            self.refine_timer.stop()
+
+    # Preview functions
+    def _request_preview(self, step = None):
+        """
+        schedule a preview of the given step (or of the last one), coalescing bursts of changes
+        """
+        if step is not None:
+            self.preview_step = step
+        if self.cb_preview.isChecked() and self.preview_step is not None:
+            self.preview_timer.start()
+
+    def _toggle_preview(self, checked):
+        if checked:
+            self._request_preview()
+        elif "preview" in self.viewer.layers:
+            self.viewer.layers.remove("preview")
+
+    def _preview_parameters(self, step):
+        """
+        the input layer name and parameters of a step, as its Run button would use them
+        """
+        spacing = self._get_spacing()
+        if step == "smoothing":
+            try:
+                tolerance = float(self.li_tolerance.displayText())
+            except ValueError:
+                tolerance = None
+            params = {"spacing": spacing, "n_iter": self.s_iterations.value(), "time_step": self.s_time_step.value()/10000, "tolerance": tolerance, "precision": self.c_precision.currentText()}
+            return self.c_smoothing.currentText(), params
+        if step == "threshold":
+            return self.c_smoothing.currentText(), {"scale": self.s_scale.value()/2}
+        if step == "vesselness":
+            params = {"sigma": self.s_sigma.value()/2, "gamma": self.s_gamma.value(), "dim": 3, "cutoff_method": self.c_cutoff_method.currentText(), "spacing": spacing}
+            return self.c_vesselness.currentText(), params
+        if step == "closing":
+            return self.c_closing.currentText(), {"kernel": self.s_kernel_size.value(), "spacing": spacing}
+        if step == "hole_removal":
+            return self.c_hole.currentText(), {"max_size": self.s_max_hole_size.value()}
+        if step == "thinning":
+            return self.c_thinning.currentText(), {"min_thickness": self.s_min_thick.value()/2, "thin": self.s_thin.value(), "spacing": spacing}
+        if step == "cleaning":
+            return self.c_cleaning.currentText(), {"min_size": self.s_min_size.value()}
+
+    def _preview_roi(self):
+        """
+        the (start, stop) along y and x of the first shape in a shapes layer named "ROI", None if there is none
+        """
+        if "ROI" not in self.viewer.layers or len(self.viewer.layers["ROI"].data) == 0:
+            return None
+        vertices = np.asarray(self.viewer.layers["ROI"].data[0])[:, -2:]
+        start = np.floor(vertices.min(axis = 0)).astype(int)
+        stop = np.ceil(vertices.max(axis = 0)).astype(int)
+        return list(zip(start, stop))
+
+    def _update_preview(self):
+        """
+        run the active step on the displayed slice and show it in the "preview" layer
+        """
+        if not self.cb_preview.isChecked() or self.preview_step is None:
+            return
+        name, params = self._preview_parameters(self.preview_step)
+        input_layer = self.layer_model.layer(name)
+        if input_layer is None or input_layer.metadata.get("placeholder") or input_layer.metadata.get("coarse") or input_layer.ndim != 3:
+            return
+        image = input_layer.data
+        # the displayed plane in the voxels of the input layer, which may be scaled and translated
+        z = int(np.round(input_layer.world_to_data(self.viewer.dims.point)[-3]))
+        z = min(max(z, 0), image.shape[0] - 1)
+
+        statistics = None
+        if self.preview_step == "threshold":
+            key = (id(image), image.shape)
+            if key not in self.preview_statistics:
+                self.preview_statistics = {key: (float(image.mean()), float(image.std()))}
+            statistics = self.preview_statistics[key]
+
+        with self.profiler.profile("preview_" + self.preview_step, params = params) as record:
+            out, offset = preview_step(self.preview_step, image, params, z, self._preview_roi(), statistics)
+            record.output(out)
+        scale = np.asarray(input_layer.scale[-3:])
+        translate = np.asarray(input_layer.translate[-3:]) + np.asarray(offset) * scale
+        if "preview" in self.viewer.layers:
+            preview = self.viewer.layers["preview"]
+            preview.data = out
+            preview.scale = scale
+            preview.translate = translate
+            preview.reset_contrast_limits()
+        else:
+            self.viewer.add_image(data = out, name = "preview", scale = scale, translate = translate, colormap = "magenta", blending = "additive", metadata = {"preview": True})
+
+    # Placeholder functions
+    def _add_placeholder(self, data, name, metadata, **kwargs):
+        """
+        add a hidden layer standing in for a result which is not kept in memory
+
+        The layer holds a zero-strided view of the right shape and data type, costing
+        no memory, and is computed (or loaded from the cache) once it is made visible.
+        """
+        placeholder = np.broadcast_to(np.zeros((), dtype = data.dtype), data.shape)
+        metadata = dict(metadata, placeholder = True)
+        layer = self.viewer.add_image(data = placeholder, name = name, metadata = metadata, visible = False, contrast_limits = [0, 1], **kwargs)
+        layer.events.visible.connect(lambda event: self._show_placeholder(layer))
+        return layer
+
+    def _show_placeholder(self, layer):
+        if layer.visible and layer.metadata.get("placeholder"):
+            try:
+                self._materialize(layer)
+            except ValueError as e:
+                msg = QMessageBox()
+                msg.setText(str(e))
+                msg.exec()
+
+    def _materialize(self, layer):
+        """
+        replace the data of a placeholder layer by the actual result
+
+        The result is loaded from the cache, or computed again from the nearest
+        inputs which are available, following the provenance of the layer.
 
         Return
         -------------
         np.ndarray
         """
-        from skimage.morphology import skeletonize_3d
-        if not preset:
-            selected_layer = self.c_skeleton.currentText()
-            for layer in self.viewer.layers:
-                if layer.name == selected_layer and type(layer) == Image:
-                    image = layer.data
-                    break
-        out = skeletonize_3d(image > 0)
-
-        self.viewer.add_image(data = out, name = "skeleton", blending="additive")
-        if preset:
-            return out
-
-    # Combobox update function
-    def _update_layer_lists(self, index = 0, new_index = 0, old_value = "", value = "", ):
-        for box in self.list_comboboxes:
-            box.clear()
-            if box == self.c_merge_3:
-                box.addItem("N/A")
-        names = []
+        key = layer.metadata["id"]
+        if key in self.placeholder_cache:
+            data = self.placeholder_cache.pop(key)
+        else:
+            pipeline = build_pipeline(self.viewer.layers, layer)
+            needed = set(pipeline["inputs"]) | {node["id"] for node in pipeline["nodes"]}
+            results = {}
+            for other in self.viewer.layers:
+                other_id = other.metadata.get("id")
+                if other_id not in needed or other_id == key or other.metadata.get("coarse"):
+                    continue
+                if not other.metadata.get("placeholder"):
+                    results[other_id] = other.data
+                elif other_id in self.placeholder_cache:
+                    results[other_id] = self.placeholder_cache[other_id]
+            results = run_dag(pipeline, results, on_result = lambda node, out, record: self.profiler.add(record))
+            data = results[key]
+        layer.metadata["placeholder"] = False
+        layer.data = data
+        layer.reset_contrast_limits()
+        return data
+
+    def _input_data(self, data):
+        """
+        the actual data for the data of a layer, materializing placeholders and
+        waiting for the full resolution result of coarse layers
+        """
         for layer in self.viewer.layers:
-            if type(layer) == Image:
-                names.append(layer.name)
-        for box in self.list_comboboxes:
-            for name in names:
-                box.addItem(name)
+            if type(layer) == Image and layer.data is data and layer.metadata.get("placeholder"):
+                return self._materialize(layer)
+            if type(layer) == Image and layer.data is data and layer.metadata.get("coarse"):
+                self._apply_refinements(wait = True)
+                return layer.data
+        return data
 
     # Preset function
+    def _layer_name(self, step, params):
+        """
+        the name of the layer holding a step result, as given by the step buttons
+        """
+        names = {
+            "smoothing": lambda: "smoothed_Image",
+            "threshold": lambda: f"threshold_{params['scale']}",
+            "vesselness": lambda: f"ves_{params['sigma']}_{params['gamma']}_{params['cutoff_method']}",
+            "merge": lambda: "merged_segmentation",
+            "closing": lambda: f"closing_{params['kernel']}",
+            "hole_removal": lambda: "filled_holes_seg",
+            "thinning": lambda: f"thinned_{params['min_thickness']}_{params['thin']}",
+            "cleaning": lambda: f"cleaned_{params['min_size']}",
+            "skeleton": lambda: "skeleton",
+        }
+        return names[step]() if step in names else step
+
     def _run_preset(self):
         """
         runs the selected preset on the selected layer without interaction from the user necessary
+
+        The preset is run as a DAG (see vessel_express.scheduler): the threshold and
+        vesselness branches only depend on the smoothed image and run concurrently,
+        joining at the merge. The results are added as layers in the order of the steps.
+        With coarse first results, the preset is run on the downsampled image first and
+        its layers are replaced once the full resolution run in the background is done.
         """
 
         selected_layer = self.c_preset_input.currentText()
@@ -945,88 +1895,163 @@ class ParameterTuning(QWidget):
             if layer.name == selected_layer and type(layer) == Image:
                 image = layer.data
                 break
+        spacing = self._get_spacing()
+        self.profiler.source = selected_layer
+        if self.cb_lazy.isChecked() and not hasattr(image, "dask"):
+            import dask.array as da
+            image = da.from_array(image, chunks = "auto")
+        pipeline = preset_pipeline(self.c_preset.currentText(), layer_id(layer), spacing, self.c_precision.currentText())
+        results = {layer_id(layer): image}
+
+        # reuse the smoothed image of an earlier run on the same data
+        smoothing = pipeline["nodes"][0]
+        fingerprint = array_fingerprint(image)
+        for smoothed in self.viewer.layers:
+            if (
+                type(smoothed) == Image
+                and not smoothed.metadata.get("placeholder")
+                and not smoothed.metadata.get("coarse")
+                and smoothed.metadata.get("step") == "smoothing"
+                and smoothed.metadata.get("params") == smoothing["params"]
+                and smoothed.metadata.get("fingerprint") == fingerprint
+            ):
+                for node in pipeline["nodes"]:
+                    node["inputs"] = [layer_id(smoothed) if i == smoothing["id"] else i for i in node["inputs"]]
+                pipeline["nodes"].remove(smoothing)
+                results[layer_id(smoothed)] = smoothed.data
+                break
+
+        retention = self.c_retention.currentIndex()
+
+        def layer_arguments(node):
+            metadata = {key: node[key] for key in ("id", "step", "params", "inputs")}
+            kwargs = {"blending": "additive"}
+            if node["step"] == "smoothing":
+                metadata["fingerprint"] = fingerprint
+                kwargs = {}
+            return self._layer_name(node["step"], node["params"]), metadata, kwargs
+
+        def add_layer(node, out, record):
+            self.profiler.add(record)
+            name, metadata, kwargs = layer_arguments(node)
+            if retention == 2 or node["id"] == pipeline["output"]:
+                self.viewer.add_image(data = out, name = name, metadata = metadata, **kwargs)
+                return
+            if retention == 1:
+                self.placeholder_cache[node["id"]] = out if not in_memory(out) else spill_to_disk(out, node["step"] + "_")
+            self._add_placeholder(out, name, metadata, **kwargs)
+
+        def swap_layer_data(key, spilled):
+            if key in self.placeholder_cache:
+                self.placeholder_cache[key] = spilled
+            for result_layer in self.viewer.layers:
+                if result_layer.metadata.get("id") == key and not result_layer.metadata.get("placeholder"):
+                    result_layer.data = spilled
+
+        try:
+            budget = float(self.li_memory_budget.displayText()) * 1024 ** 3
+        except ValueError:
+            budget = None
+        mode = self.c_scheduler.currentIndex()
+        if mode == 1 and not hasattr(image, "dask") and self.process_pool is None:
+            self.process_pool = process_pool()
+
+        def run(on_result, memory):
+            if mode == 1 and not hasattr(image, "dask"):
+                run_dag(pipeline, results, executor = self.process_pool, on_result = on_result, keep_intermediates = False, memory = memory)
+            else:
+                n_workers = 1 if mode == 2 else None
+                run_dag(pipeline, results, n_workers = n_workers, on_result = on_result, keep_intermediates = False, memory = memory)
+
+        factor = self._coarse_factor()
+        if factor == 1 or hasattr(image, "dask"):
+            # intermediates added as layers stay in memory after the run drops them
+            retained = [node["id"] for node in pipeline["nodes"]] if retention == 2 else []
+            run(add_layer, MemoryManager(budget = budget, on_spill = swap_layer_data, retained = retained))
+            return
 
-        if self.c_preset.currentIndex() == 0: # Bladder preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma=5, cutoff_method = "threshold_triangle")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 3, gamma=5, cutoff_method = "threshold_otsu")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            closed = self._closing(preset = True, image = merge, kernel = 5)
-            thinned = self._thinning(preset = True, image = closed, min_thickness = 1, thin = 1)
-            self._cleaning(preset = True, image = thinned, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 1: # bone preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 110, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 2, data1 = vessel1, data2 = vessel2)
-            closed = self._closing(preset = True, image = merge, kernel = 3)
-            self._cleaning(preset = True, image = closed, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 2: # Brain preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 5, cutoff_method = "threshold_li")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 5, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            closed = self._closing(preset = True, image = merge, kernel = 5)
-            self._cleaning(preset = True, image = closed, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 3: # Ear preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 2)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 120, cutoff_method = "threshold_triangle")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 120, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            closed = self._closing(preset = True, image = merge, kernel = 3)
-            thinned = self._thinning(preset = True, image = closed, min_thickness = 1, thin = 1)
-            self._cleaning(preset = True, image = thinned, min_size = 20)
-
-        elif self.c_preset.currentIndex() == 4: # Heart preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 5, cutoff_method = "threshold_li")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 5, cutoff_method = "threshold_otsu")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            thinned = self._thinning(preset = True, image = merge, min_thickness = 1, thin = 1)
-            self._cleaning(preset = True, image = thinned, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 5: # Liver preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 10, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 2, data1 = vessel1, data2 = vessel2)
-            closed = self._closing(preset = True, image = merge, kernel = 5)
-            self._cleaning(preset = True, image = closed, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 6: # Muscle preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3.5)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 70, cutoff_method = "threshold_triangle")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 90, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            self._cleaning(preset = True, image = merge, min_size = 20)
-
-        elif self.c_preset.currentIndex() == 7: # Spinal cord preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 3)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 5, cutoff_method = "threshold_triangle")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 2, gamma = 5, cutoff_method = "threshold_triangle")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3 = vessel3)
-            closed = self._closing(preset = True, image = merge, kernel = 3)
-            thinned = self._thinning(preset = True, image = closed, min_thickness = 1, thin = 1)
-            self._cleaning(preset = True, image = thinned, min_size = 100)
-
-        elif self.c_preset.currentIndex() == 8: # Tongue preset
-            smooth_image = self._smoothing(preset = True, data = image)
-            vessel1 = self._threshold(preset = True, image = smooth_image, scale = 4)
-            vessel2 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 170, cutoff_method = "threshold_triangle")
-            vessel3 = self._vesselness(preset = True, image = smooth_image, sigma = 1, gamma = 40, cutoff_method = "threshold_li")
-            merge = self._merge(preset = True, layers = 3, data1 = vessel1, data2 = vessel2, data3=vessel3)
-            closed = self._closing(preset = True, image = merge, kernel = 3)
-            thinned = self._thinning(preset = True, image = closed, min_thickness = 1, thin = 1)
-            self._cleaning(preset = True, image = thinned, min_size = 20)
+        # coarse to fine: show the results on the downsampled image, then refine in the background
+        coarse_results = {key: downsample(data, factor) for key, data in results.items()}
+        coarse_layers = {}
+
+        def add_coarse(node, out, record):
+            record.step = "coarse_" + record.step
+            self.profiler.add(record)
+            if retention == 2 or node["id"] == pipeline["output"]:
+                name, metadata, kwargs = layer_arguments(node)
+                coarse_layers[node["id"]] = self._add_coarse(out, name, metadata, factor, image.shape, **kwargs)
+
+        run_dag(coarse_pipeline(pipeline, factor), coarse_results, n_workers = 1 if mode == 2 else None, on_result = add_coarse, keep_intermediates = False)
+
+        # the layers are only touched in the GUI thread, once the full resolution run is done
+        spilled = {}
+
+        def refine():
+            finished = []
+            # every result is held until the layers are replaced
+            retained = [node["id"] for node in pipeline["nodes"]]
+            memory = MemoryManager(budget = budget, on_spill = lambda key, data: spilled.__setitem__(key, data), retained = retained)
+            run(lambda node, out, record: finished.append((node, out, record)), memory)
+            return finished
+
+        def replace(finished):
+            for node, out, record in finished:
+                out = spilled.get(node["id"], out)
+                if node["id"] in coarse_layers:
+                    self._replace_coarse(coarse_layers[node["id"]], out, record)
+                else:
+                    add_layer(node, out, record)
+
+        self._refine(refine, replace)
+
+    def _compare_presets(self):
+        """
+        runs all presets on the selected layer and shows their final masks side by side
+
+        The preset pipelines are combined into one plan (see pipeline.combine_pipelines),
+        so the steps they share, e.g., the smoothing and most thresholds, are run once.
+        """
+        selected_layer = self.c_preset_input.currentText()
+        for layer in self.viewer.layers:
+            if layer.name == selected_layer and type(layer) == Image:
+                image = self._input_data(layer.data)
+                break
+        spacing = self._get_spacing()
+        self.profiler.source = selected_layer
+        names = [self.c_preset.itemText(index) for index in range(self.c_preset.count())]
+        pipelines = [preset_pipeline(name, layer_id(layer), spacing, self.c_precision.currentText()) for name in names]
+        plan = combine_pipelines(pipelines)
+
+        try:
+            budget = float(self.li_memory_budget.displayText()) * 1024 ** 3
+        except ValueError:
+            budget = None
+        kwargs = {
+            "on_result": lambda node, out, record: self.profiler.add(record),
+            "keep_intermediates": False,
+            "memory": MemoryManager(budget = budget),
+        }
+        mode = self.c_scheduler.currentIndex()
+        if mode == 1:
+            if self.process_pool is None:
+                self.process_pool = process_pool()
+            results = run_dag(plan, {layer_id(layer): image}, executor = self.process_pool, **kwargs)
+        else:
+            results = run_dag(plan, {layer_id(layer): image}, n_workers = 1 if mode == 2 else None, **kwargs)
+
+        masks = [results[output] > 0 for output in plan["outputs"]]
+        majority = np.sum(masks, axis = 0) > len(masks) / 2
+        self.t_compare.setRowCount(0)
+        for row, (name, mask) in enumerate(zip(names, masks)):
+            self.viewer.add_image(data = mask, name = f"preset_{name}", metadata = {"preset": name}, blending = "additive")
+            statistics = mask_statistics(mask)
+            self.t_compare.insertRow(row)
+            cells = [name, f"{100 * statistics['foreground']:.2f}", str(statistics["components"]), f"{agreement(mask, majority)['dice']:.3f}"]
+            for column, value in enumerate(cells):
+                self.t_compare.setItem(row, column, QTableWidgetItem(value))
+        self.t_compare.setVisible(True)
+        self.l_compare.setText(f"{len(plan['nodes'])} steps run instead of {sum(len(p['nodes']) for p in pipelines)}")
+        self.viewer.grid.enabled = True
 
     """
     # This can be interesting if we decide to use the currently selected layers instead of comboboxes
@@ -1062,6 +2087,12 @@ class Evaluation(QWidget):
         self.btn_dir = QPushButton("Choose a directory")
         self.btn_next.clicked.connect(self._next)
         self.btn_save.clicked.connect(self._save)
+        self.btn_export = QPushButton("Export to table store")
+        self.btn_export.setToolTip(
+            "Append the evaluations and QC metrics of this directory to a Parquet table store "
+            "(table \"images\", partitioned by the name of the directory)."
+        )
+        self.btn_export.clicked.connect(self._export_records)
         self.btn_dir.clicked.connect(self._select_dir)
 
         
@@ -1071,6 +2102,35 @@ class Evaluation(QWidget):
         self.c_eval.addItem("Failed Segmentation")
         self.c_eval.addItem("Bad Image")
 
+        self.l_queue = QLabel("No directory chosen")
+        self.l_order = QLabel("Review order")
+        self.c_order = QComboBox()
+        self.c_order.addItem("file name", None)
+        for key, (label, high) in QC_METRICS.items():
+            self.c_order.addItem(f"{label} ({'high' if high else 'low'} values first)", key)
+        self.c_order.currentIndexChanged.connect(lambda: self._update_queue(set()))
+        self.h_order = QHBoxLayout()
+        self.h_order.addWidget(self.l_order)
+        self.h_order.addWidget(self.c_order)
+        # the review queue, double-click an image to show it
+        self.t_queue = QTableWidget(0, len(QC_METRICS) + 2)
+        self.t_queue.setHorizontalHeaderLabels(["image"] + [label for label, high in QC_METRICS.values()] + ["evaluation"])
+        self.t_queue.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.t_queue.setSelectionBehavior(QTableWidget.SelectRows)
+        self.t_queue.setMinimumHeight(200)
+        self.t_queue.cellDoubleClicked.connect(self._open_row)
+        # thumbnails of the queue (see vessel_express.review.thumbnail), double-click one to show the pair
+        self.l_grid = QListWidget()
+        self.l_grid.setViewMode(QListView.IconMode)
+        self.l_grid.setIconSize(QSize(128, 128))
+        self.l_grid.setResizeMode(QListView.Adjust)
+        self.l_grid.setMovement(QListView.Static)
+        self.l_grid.setSelectionMode(QListWidget.ExtendedSelection)
+        self.l_grid.setMinimumHeight(300)
+        self.l_grid.itemDoubleClicked.connect(lambda item: self._open(item.data(Qt.UserRole)))
+        self.btn_rate = QPushButton("Rate selected thumbnails")
+        self.btn_rate.clicked.connect(self._rate_selected)
+
         self.line_1 = QWidget()
         self.line_1.setFixedHeight(4)
         self.line_1.setSizePolicy(QSizePolicy.Expanding,QSizePolicy.Fixed)
@@ -1089,10 +2149,16 @@ class Evaluation(QWidget):
         self.content.layout().addWidget(self.line_1)
         self.content.layout().addWidget(self.l_directory)
         self.content.layout().addWidget(self.btn_next)
+        self.content.layout().addLayout(self.h_order)
+        self.content.layout().addWidget(self.l_queue)
+        self.content.layout().addWidget(self.t_queue)
+        self.content.layout().addWidget(self.l_grid)
         self.content.layout().addWidget(self.l_evaluate)
         self.content.layout().addWidget(self.c_eval)
+        self.content.layout().addWidget(self.btn_rate)
         self.content.layout().addWidget(self.line_2)
         self.content.layout().addWidget(self.btn_save)
+        self.content.layout().addWidget(self.btn_export)
         self.scroll_area = QScrollArea()
         self.scroll_area.setWidget(self.content)
 
@@ -1100,54 +2166,229 @@ class Evaluation(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout().addWidget(self.scroll_area)
 
-        self.evaluated = []
+        self.evaluated = {}
+        # the next image pairs are read in the background while the current one is evaluated
+        self.prefetcher = Prefetcher(self._load_pair, depth = 3)
+        self.index = None
+        self.current_fn = None
+        self.current_bw = None
+        self.order = []
+        self.shown = set()
+        # the QC metrics and thumbnails of all pairs are computed in the background,
+        # the queue is reordered as they arrive
+        self.records = {}
+        self.thumbnails = {}
+        self.review_futures = {}
+        # what the queue table and the thumbnail grid show, to update only what changed
+        self.queue_order = []
+        self.grid_order = []
+        self.grid_items = {}
+        self.review_executor = ThreadPoolExecutor(max_workers = default_workers())
+        self.review_timer = QTimer(self)
+        self.review_timer.setInterval(250)
+        self.review_timer.timeout.connect(self._collect_results)
 
     def _select_dir(self):
         self.directory = QFileDialog.getExistingDirectory(self, "Select Directory")
         self.filenames = glob(self.directory + os.sep + "Binary_*.tiff")
         self.filenames.sort()
         self.current_fn = None
+        self.current_bw = None
         self.total_num = len(self.filenames)
+        self.shown = set()
+        self.evaluated = {}
+        # contrast limits and QC metrics are cached in the directory (see vessel_express.review.ReviewIndex)
+        self.index = ReviewIndex(self.directory)
+        for future in self.review_futures.values():
+            future.cancel()
+        self.records = {bw_fn: None for bw_fn in self.filenames}
+        self.thumbnails = {}
+        # one job per pair reads it once for both; the index is saved once
+        # per collection of results (see _collect_results), not by every job
+        self.review_futures = {bw_fn: self.review_executor.submit(compute_review, bw_fn, self.index, save = False) for bw_fn in self.filenames}
+        self.queue_order = []
+        self.t_queue.setRowCount(0)
+        self.grid_order = []
+        self.grid_items = {}
+        self.l_grid.clear()
+        self.review_timer.start()
+        self._update_queue()
         self._next()
 
-    def _next(self): # Removes all current layers and loads in two corresponding images as layers
-        if len(self.filenames) == 0:
+    def _upcoming(self):
+        """
+        the segmentations neither shown nor rated yet, in review order
+        """
+        return [bw_fn for bw_fn in self.order if bw_fn not in self.shown and bw_fn not in self.evaluated]
+
+    def _load_pair(self, bw_fn):
+        return load_pair(bw_fn, self.index)
+
+    def _collect_results(self):
+        """
+        take over the QC metrics and thumbnails computed so far, and save what they added to the index
+        """
+        changed = set()
+        for bw_fn in [bw_fn for bw_fn, future in self.review_futures.items() if future.done()]:
+            future = self.review_futures.pop(bw_fn)
+            if not future.cancelled() and future.exception() is None:
+                self.records[bw_fn], self.thumbnails[bw_fn] = future.result()
+            changed.add(bw_fn)
+        if changed:
+            self.index.save()
+            self._update_queue(changed)
+        if not self.review_futures:
+            self.review_timer.stop()
+
+    def _update_queue(self, changed = None):
+        """
+        order the review queue by the selected QC metric and show it; only the
+        rows of changed files (all if changed is None) and moved rows are updated
+        """
+        self.order = review_order(qc_columns(self.records), self.c_order.currentData())
+        self.t_queue.setRowCount(len(self.order))
+        for row, bw_fn in enumerate(self.order):
+            moved = row >= len(self.queue_order) or self.queue_order[row] != bw_fn
+            if not moved and changed is not None and bw_fn not in changed:
+                continue
+            metrics = self.records[bw_fn]
+            cells = [os.path.basename(bw_fn)[7:]]
+            cells += ["" if metrics is None else f"{metrics[key]:.4g}" for key in QC_METRICS]
+            cells.append(self.evaluated.get(bw_fn, ""))
+            for column, value in enumerate(cells):
+                self.t_queue.setItem(row, column, QTableWidgetItem(value))
+        self.queue_order = list(self.order)
+        if self.current_bw in self.order:
+            self.t_queue.blockSignals(True)
+            self.t_queue.selectRow(self.order.index(self.current_bw))
+            self.t_queue.blockSignals(False)
+        self._update_grid(changed)
+        self.l_queue.setText(f"QC metrics and thumbnails of {len(self.records) - len(self.review_futures)} / {len(self.records)} images")
+        if self.index is not None:
+            self.prefetcher.prefetch(self._upcoming())
+
+    def _update_grid(self, changed = None):
+        """
+        show the thumbnails in review order, keeping the selection; items are
+        moved instead of recreated, and only the items of changed files (all if
+        changed is None) are updated
+        """
+        if self.grid_order != self.order:
+            selected = {item.data(Qt.UserRole) for item in self.l_grid.selectedItems()}
+            while self.l_grid.count():
+                self.l_grid.takeItem(self.l_grid.count() - 1)
+            for bw_fn in self.order:
+                if bw_fn not in self.grid_items:
+                    self.grid_items[bw_fn] = QListWidgetItem()
+                    self.grid_items[bw_fn].setData(Qt.UserRole, bw_fn)
+                    changed = None if changed is None else changed | {bw_fn}
+                self.l_grid.addItem(self.grid_items[bw_fn])
+                self.grid_items[bw_fn].setSelected(bw_fn in selected)
+            self.grid_order = list(self.order)
+        for bw_fn in self.order if changed is None else [bw_fn for bw_fn in changed if bw_fn in self.grid_items]:
+            item = self.grid_items[bw_fn]
+            evaluation = self.evaluated.get(bw_fn)
+            item.setText(os.path.basename(bw_fn)[7:] + ("" if evaluation is None else f"\n{evaluation}"))
+            if bw_fn in self.thumbnails and item.icon().isNull():
+                image = np.ascontiguousarray(self.thumbnails[bw_fn])
+                height, width = image.shape[:2]
+                qimage = QImage(image.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+                item.setIcon(QIcon(QPixmap.fromImage(qimage)))
+
+    def _rate_selected(self):
+        """
+        evaluate the pairs of the selected thumbnails as chosen, without showing them
+        """
+        rated = {item.data(Qt.UserRole) for item in self.l_grid.selectedItems()}
+        for bw_fn in rated:
+            self.evaluated[bw_fn] = self.c_eval.currentText()
+        self.l_directory.setText(f"{len(self.shown.union(self.evaluated))} / {self.total_num}")
+        self._update_queue(rated)
+
+    def _next(self): # Shows the next image pair of the review queue
+        upcoming = self._upcoming()
+        if len(upcoming) == 0:
             noMoreFiles = QMessageBox()
             noMoreFiles.setText("There are no more file tuples to evaluate!")
             noMoreFiles.exec()
             return
-        bw_fn = self.filenames.pop() # Assume the file name is Binary_xxxx.tiff
-        raw_fn = self.directory + os.sep + os.path.basename(bw_fn)[7:]
-        if not os.path.exists(raw_fn):
-            raw_fn = raw_fn[:-1]  # .tiff --> .tif
-        self.l_directory.setText(f"{self.total_num-len(self.filenames)} / {self.total_num}")
-        original = imread(raw_fn)
-        segmentation = imread(bw_fn)
-        self._remove_layers()
+        self._open(upcoming[0])
+
+    def _open_row(self, row, column):
+        self._open(self.order[row])
+
+    def _open(self, bw_fn): # Evaluates the current image pair and shows the given one, bw_fn is Binary_xxxx.tiff
+        previous = self.current_bw
         if self.current_fn is not None:
             self._eval()
-        vlow = np.percentile(original, 0.5)
-        vhigh = np.percentile(original, 99.5)
-        self.viewer.add_image(data = original, name = "Original data", blending = "additive", contrast_limits=[vlow, vhigh])
-        self.viewer.add_image(data = segmentation, name = "Segmentation data", colormap="magenta", blending = "additive")
-        self.current_fn = raw_fn
+        self.shown.add(bw_fn)
+        pair = self.prefetcher.get(bw_fn, upcoming = self._upcoming())
+        self.l_directory.setText(f"{len(self.shown.union(self.evaluated))} / {self.total_num}")
+        self._show_pair(pair)
+        self.current_fn = pair["raw_fn"]
+        self.current_bw = bw_fn
+        if bw_fn in self.evaluated:
+            self.c_eval.setCurrentText(self.evaluated[bw_fn])
+        self._update_queue({previous, bw_fn})
+
+    def _show_pair(self, pair):
+        """
+        show an image pair (see vessel_express.review.load_pair), reusing the layers of the previous pair
+        """
+        names = ["Original data", "Segmentation data"]
+        for layer in [layer for layer in self.viewer.layers if layer.name not in names]:
+            self.viewer.layers.remove(layer)
+        if all(name in self.viewer.layers for name in names):
+            for name, key in zip(names, ["original", "segmentation"]):
+                layer = self.viewer.layers[name]
+                layer.data = pair[key]
+                layer.contrast_limits = pair[key + "_limits"]
+            return
+        self._remove_layers()
+        self.viewer.add_image(data = pair["original"], name = "Original data", blending = "additive", contrast_limits = pair["original_limits"])
+        self.viewer.add_image(data = pair["segmentation"], name = "Segmentation data", colormap = "magenta", blending = "additive", contrast_limits = pair["segmentation_limits"])
         
 
     def _eval(self):
-        self.evaluated.append(os.path.basename(self.current_fn) + ", " + self.c_eval.currentText() + "\n")
+        self.evaluated[self.current_bw] = self.c_eval.currentText()
 
     def _save(self):
         if self.current_fn is not None:
             self._eval()
         filename = QFileDialog.getSaveFileName(self, caption = "test", directory  = self.directory, filter = "*.csv")
         outfile = open(filename[0],"a")
-        for i in range(0,len(self.evaluated)):
-            outfile.write(self.evaluated[i])
+        for bw_fn, evaluation in self.evaluated.items():
+            outfile.write(os.path.basename(raw_path(bw_fn)) + ", " + evaluation + "\n")
         outfile.close()
         msgBox = QMessageBox()
         msgBox.setText("The file has been saved.")
         msgBox.exec()
 
+    def _export_records(self):
+        """
+        append one record per image (evaluation and QC metrics) to a table store, see vessel_express.export
+        """
+        if not self.records:
+            return
+        if self.current_fn is not None:
+            self._eval()
+        root = QFileDialog.getExistingDirectory(self, "Select the table store")
+        if not root:
+            return
+        table = qc_columns(self.records)
+        paths = table.pop("path")
+        table = {
+            "image": np.array([os.path.basename(raw_path(bw_fn)) for bw_fn in paths], dtype = object),
+            "evaluation": np.array([self.evaluated.get(bw_fn, "") for bw_fn in paths], dtype = object),
+            **table,
+        }
+        try:
+            append_records(root, "images", table, dataset = os.path.basename(os.path.normpath(self.directory)))
+        except ImportError as e:
+            msg = QMessageBox()
+            msg.setText(str(e))
+            msg.exec()
+
     def _remove_layers(self):
         rm = []
         for layer in self.viewer.layers: # Split into two loops because one loop ignors some layers
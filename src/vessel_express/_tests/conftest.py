@@ -0,0 +1,25 @@
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def blobs_shape():
+    """
+    the shape of blobs; override this fixture in a test module, or
+    parametrize it, for stacks of another shape
+    """
+    return (12, 40, 40)
+
+
+@pytest.fixture
+def blobs(blobs_shape):
+    """
+    a noisy stack (mean 100, standard deviation 10) with a bright bar along y
+    in the middle planes, crossed by a dimmer bar along z
+    """
+    z, y, x = blobs_shape
+    rng = np.random.default_rng(0)
+    image = rng.normal(100, 10, blobs_shape).astype(np.float32)
+    image[z // 3:2 * z // 3, y // 4:3 * y // 4, x // 2 - 2:x // 2 + 2] += 80
+    image[z // 6:5 * z // 6, y // 2 - 2:y // 2 + 2, x // 4:x // 4 + 4] += 60
+    return image
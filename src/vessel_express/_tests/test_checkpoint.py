@@ -0,0 +1,107 @@
+import json
+import os
+import pytest
+import numpy as np
+from vessel_express.checkpoint import MANIFEST, TileStore, run_checkpointed, stage_keys
+from vessel_express.pipeline import STEPS, run_pipeline
+
+
+@pytest.fixture
+def blobs_shape():
+    return (24, 32, 32)
+
+
+@pytest.fixture
+def pipeline():
+    nodes = [
+        ("t", "threshold", {"scale": 2}, ["raw"]),
+        ("v", "vesselness", {"sigma": 1, "gamma": 5, "dim": 3, "cutoff_method": "threshold_otsu", "spacing": None}, ["raw"]),
+        ("m", "merge", {}, ["t", "v"]),
+        ("c", "closing", {"kernel": 3, "spacing": None}, ["m"]),
+        ("l", "cleaning", {"min_size": 10}, ["c"]),
+    ]
+    nodes = [{"id": i, "step": step, "params": params, "inputs": inputs} for i, step, params, inputs in nodes]
+    return {"version": 1, "inputs": ["raw"], "output": "l", "nodes": nodes}
+
+
+class Preempted(Exception):
+    pass
+
+
+@pytest.mark.checkpoint
+def test_tile_store(tmp_path, blobs):
+    store = TileStore(str(tmp_path / "tiles"), blobs.shape, (10, 16, 32))
+    assert len(store.tiles()) == 6 and len(store.missing()) == 6
+    for tile in store.tiles()[:4]:
+        store.write(tile, blobs[tile])
+    assert np.array_equal(store[5:18, 3:30, :], blobs[5:18, 3:30, :])
+    with pytest.raises(ValueError):
+        store.read()
+    # an existing store is opened with its own tiling
+    reopened = TileStore(str(tmp_path / "tiles"))
+    assert reopened.tile_shape == (10, 16, 32) and reopened.dtype == np.float32
+    assert reopened.missing() == store.tiles()[4:]
+    with pytest.raises(ValueError):
+        reopened.write(reopened.tiles()[4], blobs[:1])
+
+
+@pytest.mark.checkpoint
+def test_run_checkpointed(tmp_path, blobs, pipeline):
+    expected = run_pipeline(pipeline, blobs)
+    directory = str(tmp_path / "run")
+    computed = []
+
+    def preempt(node, tile):
+        computed.append(node["id"])
+        if len(computed) == 5:
+            raise Preempted()
+
+    with pytest.raises(Preempted):
+        run_checkpointed(pipeline, blobs, directory, tile_shape=(8, 32, 32), n_workers=1, on_tile=preempt)
+    # the restarted run only computes the missing tiles: the thresholds and two
+    # tiles of the vesselness response were done, the third one and its mask are not
+    computed.clear()
+    result = run_checkpointed(pipeline, blobs, directory, tile_shape=(8, 32, 32), n_workers=1,
+                              on_tile=lambda node, tile: computed.append(node["id"]))
+    assert computed == ["v"] * 4 + ["m"] * 3 + ["c"] * 3 + ["l"]
+    assert np.array_equal(result, expected)
+
+    # a finished run is read from the checkpoints, changed parameters only recompute the stages depending on them
+    computed.clear()
+    assert np.array_equal(run_checkpointed(pipeline, blobs, directory, tile_shape=(8, 32, 32), on_tile=preempt), expected)
+    assert computed == []
+    pipeline["nodes"][-1]["params"]["min_size"] = 50
+    run_checkpointed(pipeline, blobs, directory, tile_shape=(8, 32, 32), on_tile=lambda node, tile: computed.append(node["id"]))
+    assert computed == ["l"]
+    with open(os.path.join(directory, MANIFEST)) as f:
+        assert json.load(f)["pipeline"]["nodes"][-1]["params"]["min_size"] == 50
+
+
+@pytest.mark.checkpoint
+def test_manifest_mismatch(tmp_path, blobs, pipeline):
+    directory = str(tmp_path / "run")
+    run_checkpointed(pipeline, blobs, directory, tile_shape=(8, 32, 32))
+    with pytest.raises(ValueError, match="tile_shape"):
+        run_checkpointed(pipeline, blobs, directory, tile_shape=(12, 32, 32))
+    with pytest.raises(ValueError, match="inputs"):
+        run_checkpointed(pipeline, blobs + 1, directory, tile_shape=(8, 32, 32))
+
+
+@pytest.mark.checkpoint
+def test_smoothing_tiles(tmp_path, blobs):
+    params = {"spacing": None, "n_iter": 3, "time_step": 0.0625, "tolerance": None, "blockwise": False, "precision": "float32"}
+    pipeline = {"version": 1, "inputs": ["raw"], "output": "s",
+                "nodes": [{"id": "s", "step": "smoothing", "params": params, "inputs": ["raw"]}]}
+    result = run_checkpointed(pipeline, blobs, str(tmp_path / "run"), tile_shape=(12, 32, 32))
+    expected = STEPS["smoothing"](blobs, **params)
+    # the conductance is normalized per tile
+    assert result.dtype == expected.dtype
+    assert np.abs(result - expected).max() < 0.05 * np.ptp(expected)
+
+
+@pytest.mark.checkpoint
+def test_stage_keys(pipeline):
+    keys = stage_keys(pipeline, {"raw": "abc"})
+    swapped = dict(pipeline, nodes=[dict(n, inputs=n["inputs"][::-1]) if n["step"] == "merge" else n for n in pipeline["nodes"]])
+    assert stage_keys(swapped, {"raw": "abc"}) == keys
+    assert stage_keys(pipeline, {"raw": "abd"})["t"] != keys["t"]
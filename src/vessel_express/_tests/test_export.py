@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+from vessel_express.export import append_records, partition_name, read_records
+from vessel_express.measure import save_table
+from vessel_express.profiling import StepProfiler
+
+pa = pytest.importorskip("pyarrow")
+
+
+@pytest.mark.export
+def test_append_and_read(tmp_path):
+    first = {"image": np.array(["a.tiff", "b.tiff"], dtype=object), "foreground": np.array([1.5, 2.0]), "tip": np.array([True, False])}
+    second = {"image": np.array(["c.tiff"], dtype=object), "foreground": np.array([0.5]), "tip": np.array([True])}
+    path = append_records(str(tmp_path), "images", first, "liver")
+    append_records(str(tmp_path), "images", second, "liver")
+    append_records(str(tmp_path), "images", first, "kidney/2023")
+    # earlier files are kept as they are
+    assert pa.parquet.read_table(path).num_rows == 2
+    assert len(list((tmp_path / "images" / partition_name("liver")).iterdir())) == 2
+
+    table = read_records(str(tmp_path), "images")
+    assert table.num_rows == 5
+    assert table.schema.field("foreground").type == pa.float64()
+    assert table.schema.field("tip").type == pa.bool_()
+    liver = read_records(str(tmp_path), "images", datasets=["liver"], columns=["image", "dataset"])
+    assert sorted(liver.column("image").to_pylist()) == ["a.tiff", "b.tiff", "c.tiff"]
+    assert set(liver.column("dataset").to_pylist()) == {"liver"}
+
+
+@pytest.mark.export
+def test_parquet_tables(tmp_path):
+    save_table({"branch": np.arange(3), "length": np.array([1.0, 2.0, 3.0])}, str(tmp_path / "branches.parquet"))
+    assert pa.parquet.read_table(tmp_path / "branches.parquet").column("length").to_pylist() == [1.0, 2.0, 3.0]
+
+    profiler = StepProfiler(source="image.tiff")
+    with profiler.profile("threshold", np.zeros((4, 4)), params={"scale": 3}):
+        pass
+    save_table(profiler.to_columns(), str(tmp_path / "timings.parquet"))
+    timings = pa.parquet.read_table(tmp_path / "timings.parquet")
+    assert timings.column("step").to_pylist() == ["threshold"] and timings.column("voxels").to_pylist() == [16]
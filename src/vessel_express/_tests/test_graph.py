@@ -0,0 +1,60 @@
+import pytest
+import numpy as np
+from vessel_express.graph import branches, network_statistics, prune, skeleton_coordinates, skeleton_graph
+
+
+@pytest.fixture
+def tree():
+    # a trunk along x splitting into two diagonal arms, and a short spur
+    skeleton = np.zeros((5, 40, 40), dtype=bool)
+    skeleton[2, 20, 0:20] = True
+    for i in range(15):
+        skeleton[2, 20 + i, 20 + i] = True
+        skeleton[2, 20 - i, 20 + i] = True
+    skeleton[3:5, 20, 10] = True
+    return skeleton
+
+
+@pytest.mark.graph
+def test_skeleton_graph():
+    # a staircase: the diagonal steps next to two axial steps are dropped
+    skeleton = np.zeros((1, 8, 8), dtype=bool)
+    for i in range(10):
+        skeleton[0, i // 2, (i + 1) // 2] = True
+    graph = skeleton_graph(skeleton_coordinates(skeleton), skeleton.shape)
+    assert np.array_equal(np.bincount(graph.degree), [0, 2, 8])
+    assert graph.adjacency.data.sum() / 2 == 9
+    assert np.array_equal(graph.to_mask(), skeleton)
+
+
+@pytest.mark.graph
+def test_branches(tree):
+    graph = skeleton_graph(skeleton_coordinates(tree), tree.shape)
+    statistics = network_statistics(graph)
+    assert statistics["voxels"] == np.count_nonzero(tree)
+    assert statistics["branches"] == 5 and statistics["junctions"] == 2 and statistics["end_points"] == 4
+    parts = branches(graph)
+    # the spur, the arms and the trunk up to the spur
+    assert np.count_nonzero(parts["tip"]) == 4
+    # the arms are straight
+    arms = parts["length"] > 19.5
+    assert np.allclose(parts["tortuosity"][arms], 1)
+
+
+@pytest.mark.graph
+def test_prune(tree):
+    graph = skeleton_graph(skeleton_coordinates(tree), tree.shape)
+    pruned = prune(graph, 5)
+    expected = tree.copy()
+    expected[3:5, 20, 10] = False
+    assert np.array_equal(pruned.to_mask(), expected)
+    assert network_statistics(pruned)["branches"] == 3
+
+    # a T whose arms are all short keeps its longest arm
+    t = np.zeros((1, 20, 20), dtype=bool)
+    t[0, 10, 2:18] = True
+    t[0, 3:10, 10] = True
+    pruned = prune(skeleton_graph(skeleton_coordinates(t), t.shape), 10, iterations=3)
+    expected = np.zeros_like(t)
+    expected[0, 10, 2:11] = True
+    assert np.array_equal(pruned.to_mask(), expected)
@@ -0,0 +1,35 @@
+import pytest
+import numpy as np
+from napari.components import ViewerModel
+from qtpy.QtWidgets import QComboBox
+from vessel_express.layer_model import LayerListModel
+
+
+def _items(box):
+    return [box.itemText(i) for i in range(box.count())]
+
+
+@pytest.mark.layer_model
+def test_layer_list_model(qtbot):
+    viewer = ViewerModel()
+    viewer.add_image(np.zeros((2, 2)), name="a")
+    model = LayerListModel(viewer, delay=0)
+    boxes = [QComboBox(), QComboBox()]
+    for box in boxes:
+        box.setModel(model)
+
+    viewer.add_image(np.zeros((2, 2)), name="b")
+    viewer.add_points()
+    assert _items(boxes[0]) == ["a", "b"]
+    boxes[1].setCurrentText("b")
+
+    viewer.layers.move(1, 0)
+    qtbot.waitUntil(lambda: _items(boxes[0]) == ["b", "a"])
+    assert [box.currentText() for box in boxes] == ["a", "b"]
+
+    viewer.layers["b"].name = "c"
+    assert boxes[1].currentText() == "c"
+
+    viewer.layers.remove("a")
+    assert _items(boxes[0]) == ["c"]
+    assert [box.currentText() for box in boxes] == ["c", "c"]
@@ -0,0 +1,94 @@
+import pytest
+import numpy as np
+import dask.array as da
+from skimage import filters
+from vessel_express.pipeline import STEPS
+from vessel_express.lazy import halo_depth, lazy_step, run_lazy
+from vessel_express.utils import histogram_cutoff
+
+
+@pytest.mark.lazy
+def test_halo_depth():
+    assert halo_depth("smoothing", {"n_iter": 5}) == (5, 5, 5)
+    assert halo_depth("vesselness", {"sigma": 2, "spacing": (2, 1, 1)}) == (5, 9, 9)
+    assert halo_depth("vesselness", {"sigma": 1, "dim": 2}) == (0, 5, 5)
+    assert halo_depth("closing", {"kernel": 5}) == (5, 5, 5)
+    assert halo_depth("threshold", {"scale": 3}) == (0, 0, 0)
+
+
+@pytest.mark.lazy
+def test_histogram_cutoff():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 300, (20, 30, 30)).astype(np.int16) ** 2 // 300
+    for method in ["threshold_otsu", "threshold_li", "threshold_triangle"]:
+        expected = getattr(filters, method)(data)
+        assert np.array_equal(data > expected, data > histogram_cutoff(data, method))
+        assert histogram_cutoff(da.from_array(data, chunks=10), method) == histogram_cutoff(data, method)
+
+
+@pytest.mark.lazy
+def test_lazy_steps_match_eager(blobs):
+    lazy = da.from_array(blobs, chunks=(12, 20, 20))
+    for step, params in [
+        ("threshold", {"scale": 2}),
+        ("vesselness", {"sigma": 1, "gamma": 5, "cutoff_method": "threshold_otsu"}),
+    ]:
+        expected = STEPS[step](blobs, **params)
+        result = lazy_step(step, lazy, **params)
+        assert isinstance(result, da.Array)
+        assert np.array_equal(result.compute(), expected)
+
+    seg = STEPS["threshold"](blobs, 2)
+    lazy_seg = da.from_array(seg, chunks=(12, 20, 20))
+    assert np.array_equal(lazy_step("closing", lazy_seg, kernel=3).compute(), STEPS["closing"](seg, 3))
+    assert np.array_equal(lazy_step("cleaning", lazy_seg, min_size=5).compute(), STEPS["cleaning"](seg, 5))
+
+
+@pytest.mark.lazy
+def test_run_lazy(blobs):
+    pipeline = {
+        "version": 1,
+        "inputs": ["raw"],
+        "output": "merged",
+        "nodes": [
+            {"id": "t", "step": "threshold", "params": {"scale": 2}, "inputs": ["raw"]},
+            {"id": "v", "step": "vesselness", "params": {"sigma": 1, "gamma": 5,
+                                                         "cutoff_method": "threshold_li"}, "inputs": ["raw"]},
+            {"id": "merged", "step": "merge", "params": {}, "inputs": ["t", "v"]},
+        ],
+    }
+    result = run_lazy(pipeline, blobs, chunks=(12, 20, 20), compute=False)
+    assert isinstance(result, da.Array)
+    expected = STEPS["merge"](STEPS["threshold"](blobs, 2), STEPS["vesselness"](blobs, 1, 5, cutoff_method="threshold_li"))
+    assert (result.compute() != expected).mean() < 1e-3
+
+
+@pytest.mark.lazy
+def test_reductions_share_inputs(blobs, monkeypatch):
+    from vessel_express import lazy
+    from vessel_express.scheduler import run_dag
+    smoothing = {"spacing": None, "n_iter": 2, "time_step": 0.0625, "tolerance": None, "blockwise": False, "precision": "float32"}
+    pipeline = {
+        "version": 1,
+        "inputs": ["raw"],
+        "output": "merged",
+        "nodes": [
+            {"id": "s", "step": "smoothing", "params": smoothing, "inputs": ["raw"]},
+            {"id": "t", "step": "threshold", "params": {"scale": 2}, "inputs": ["s"]},
+            {"id": "v", "step": "vesselness", "params": {"sigma": 1, "gamma": 5,
+                                                         "cutoff_method": "threshold_otsu"}, "inputs": ["s"]},
+            {"id": "merged", "step": "merge", "params": {}, "inputs": ["t", "v"]},
+        ],
+    }
+    calls = []
+    eager = lazy._smoothing
+    monkeypatch.setattr(lazy, "_smoothing", lambda block, **params: calls.append(block.shape) or eager(block, **params))
+    # the smoothed chunks are computed once, for the reductions and the masks of both steps
+    result = run_lazy(pipeline, blobs, chunks=(12, 20, 20), compute=False)
+    assert len(calls) == 4
+    result.compute()
+    assert len(calls) == 4
+    calls.clear()
+    results = run_dag(pipeline, {"raw": da.from_array(blobs, chunks=(12, 20, 20))}, n_workers=2)
+    assert np.array_equal(results["merged"].compute(), result.compute())
+    assert len(calls) == 4
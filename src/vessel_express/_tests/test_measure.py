@@ -0,0 +1,36 @@
+import csv
+import pytest
+import numpy as np
+from vessel_express.graph import skeleton_coordinates, skeleton_graph
+from vessel_express.measure import BRANCH_COLUMNS, distance_transform, measure_network, save_table
+
+
+@pytest.mark.measure
+def test_distance_transform():
+    rng = np.random.default_rng(0)
+    mask = rng.random((30, 40, 40)) > 0.05
+    exact = distance_transform(mask, spacing=(2, 1, 1))
+    for n_workers in [1, 4]:
+        clipped = distance_transform(mask, spacing=(2, 1, 1), max_radius=2.5, n_workers=n_workers)
+        assert np.array_equal(clipped, np.minimum(exact, 2.5))
+
+
+@pytest.mark.measure
+def test_measure_network(tmp_path):
+    # a tube of radius 3 along x, with its center line as the skeleton
+    z, y, x = np.mgrid[:20, :20, :60]
+    tube = (z - 10) ** 2 + (y - 10) ** 2 <= 9
+    skeleton = np.zeros(tube.shape, dtype=bool)
+    skeleton[10, 10, 5:55] = True
+    graph = skeleton_graph(skeleton_coordinates(skeleton), skeleton.shape)
+    table = measure_network(tube, graph=graph)
+    assert list(table) == BRANCH_COLUMNS
+    assert table["voxels"][0] == 50 and table["length"][0] == 49 and table["tortuosity"][0] == 1
+    # the distance to the nearest background voxel
+    assert table["min_radius"][0] == table["max_radius"][0] == pytest.approx(np.sqrt(10))
+    assert table["volume"][0] == pytest.approx(np.pi * 10 * 49)
+
+    save_table(table, tmp_path / "branches.csv")
+    with open(tmp_path / "branches.csv") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == BRANCH_COLUMNS and len(rows) == 2
@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+from vessel_express.memory import MemoryManager, estimate_peak, in_memory
+from vessel_express.pipeline import run_pipeline
+from vessel_express.scheduler import run_dag
+
+
+@pytest.mark.memory
+def test_estimate_peak():
+    image = np.zeros((10, 20, 20), dtype=np.float32)
+    assert estimate_peak("vesselness", [image]) > estimate_peak("threshold", [image])
+    assert estimate_peak("isotropic", [image], {"zoom": (2, 1, 1)}) == 2 * estimate_peak("isotropic", [image], {"zoom": 1})
+
+
+@pytest.mark.memory
+def test_spill_least_recently_used(tmp_path):
+    spilled = []
+    memory = MemoryManager(budget=3000, spill_dir=tmp_path, on_spill=lambda key, data: spilled.append(key))
+    results = {key: np.full(1000, i, dtype=np.uint8) for i, key in enumerate("abc")}
+    for key in "abc":
+        memory.track(key, results[key])
+    memory.touch("a")
+    assert memory.reserve(1500, results, busy=["c"])
+    assert spilled == ["b", "a"]
+    assert not in_memory(results["a"]) and in_memory(results["c"])
+    assert np.all(results["a"] == 0) and np.all(results["b"] == 1)
+    assert memory.usage == 2500
+    memory.free(1500)
+    assert list(tmp_path.iterdir()) == []     # spilled files are removed once unmapped
+
+
+@pytest.mark.memory
+def test_run_dag_within_budget():
+    raw = np.random.default_rng(0).random((8, 20, 20))
+    pipeline = {
+        "version": 1,
+        "inputs": ["raw"],
+        "output": "cleaned",
+        "nodes": [
+            {"id": "t1", "step": "threshold", "params": {"scale": 1}, "inputs": ["raw"]},
+            {"id": "t2", "step": "threshold", "params": {"scale": 2}, "inputs": ["raw"]},
+            {"id": "merged", "step": "merge", "params": {}, "inputs": ["t1", "t2"]},
+            {"id": "cleaned", "step": "cleaning", "params": {"min_size": 3}, "inputs": ["merged"]},
+        ],
+    }
+    expected = run_pipeline(pipeline, raw)
+    memory = MemoryManager(budget=raw.size * 12)
+    results = run_dag(pipeline, {"raw": raw}, n_workers=2, memory=memory)
+    assert memory.spilled > 0
+    assert np.array_equal(results["cleaned"], expected)
+    assert memory.reserved == 0
+
+
+@pytest.mark.memory
+def test_retained_intermediates():
+    raw = np.random.default_rng(0).random((8, 20, 20))
+    pipeline = {
+        "version": 1,
+        "inputs": ["raw"],
+        "output": "merged",
+        "nodes": [
+            {"id": "t1", "step": "threshold", "params": {"scale": 1}, "inputs": ["raw"]},
+            {"id": "t2", "step": "threshold", "params": {"scale": 2}, "inputs": ["raw"]},
+            {"id": "merged", "step": "merge", "params": {}, "inputs": ["t1", "t2"]},
+        ],
+    }
+    layers = {}
+    memory = MemoryManager(budget=10 ** 9, retained=["t1"], on_spill=lambda key, data: layers.__setitem__(key, data))
+    results = run_dag(pipeline, {"raw": raw}, n_workers=1, keep_intermediates=False, memory=memory,
+                      on_result=lambda node, out, record: layers.__setitem__(node["id"], out))
+    # the run dropped both thresholds, but the retained one is still alive (e.g., as a layer)
+    assert "t1" not in results and "t2" not in results
+    assert set(memory.tracked) == {"t1", "merged"}
+    assert memory.usage == layers["t1"].nbytes + results["merged"].nbytes
+    # and is spilled when a step needs the room
+    memory.budget = results["merged"].nbytes + 100
+    memory.reserve(100, results)
+    assert not in_memory(layers["t1"]) and not in_memory(memory.kept["t1"])
+    assert np.array_equal(layers["t1"], run_pipeline(dict(pipeline, output="t1"), raw))
@@ -0,0 +1,47 @@
+import pytest
+import numpy as np
+from skimage.measure import marching_cubes
+from vessel_express.mesh import decimate, mask_mesh, merge_vertices, save_mesh
+
+
+@pytest.fixture
+def ring():
+    z, y, x = np.mgrid[:30, :36, :40]
+    return ((z - 15) ** 2 + (y - 18) ** 2 + (x - 20) ** 2 < 12 ** 2) & ((z - 15) ** 2 + (y - 18) ** 2 >= 9)
+
+
+def edge_counts(faces):
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    return np.unique(np.unique(edges, axis=0, return_counts=True)[1])
+
+
+@pytest.mark.mesh
+def test_mask_mesh(ring):
+    vertices, faces = mask_mesh(ring, block_shape=(7, 11, 40), n_workers=3)
+    expected = marching_cubes(np.pad(ring, 1).astype(np.float32), 0.5, allow_degenerate=False)[:2]
+    expected = merge_vertices(expected[0] - 1, expected[1])
+    # the blocks are stitched into the mesh of the whole mask, which is closed
+    assert len(faces) == len(expected[1])
+    assert np.array_equal(np.sort(vertices, axis=0), np.sort(expected[0].astype(np.float32), axis=0))
+    assert np.array_equal(edge_counts(faces), [2])
+    # blocks of a single plane at the high borders (shape % block == 1), for a mask touching them
+    corner = np.zeros((10, 11, 12), dtype=bool)
+    corner[3:, 4:, 5:] = True
+    expected = marching_cubes(np.pad(corner, 1).astype(np.float32), 0.5, allow_degenerate=False)[:2]
+    single = mask_mesh(corner, block_shape=(3, 5, 11), n_workers=2)[1]
+    assert len(single) == len(merge_vertices(*expected)[1])
+    assert np.array_equal(edge_counts(single), [2])
+    scaled = mask_mesh(ring, spacing=(2, 1, 1))[0]
+    assert np.allclose(scaled.max(axis=0), vertices.max(axis=0) * [2, 1, 1])
+
+
+@pytest.mark.mesh
+def test_decimate(ring, tmp_path):
+    vertices, faces = mask_mesh(ring)
+    small_vertices, small_faces = decimate(vertices, faces, 500)
+    assert 250 < len(small_faces) <= 500
+    assert small_faces.max() < len(small_vertices)
+    save_mesh(tmp_path / "ring.ply", small_vertices, small_faces)
+    with open(tmp_path / "ring.ply", "rb") as f:
+        assert f.read(3) == b"ply"
+    assert (tmp_path / "ring.ply").stat().st_size > 13 * len(small_faces) + 12 * len(small_vertices)
@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+from vessel_express.pipeline import (
+    STEPS,
+    provenance,
+    layer_id,
+    build_pipeline,
+    save_pipeline,
+    load_pipeline,
+    run_pipeline
+)
+
+
+class FakeLayer:
+    def __init__(self, data, metadata=None):
+        self.data = data
+        self.metadata = metadata or {}
+
+
+def _run(layers, step, inputs, **params):
+    out = STEPS[step](*[layer.data for layer in inputs], **params)
+    layer = FakeLayer(out, provenance(step, params, [layer_id(i) for i in inputs]))
+    layers.append(layer)
+    return layer
+
+
+@pytest.mark.pipeline
+def test_build_and_replay_pipeline(tmp_path):
+    rng = np.random.default_rng(0)
+    raw = FakeLayer(rng.random((10, 20, 20)))
+    layers = [raw]
+    thresh_1 = _run(layers, "threshold", [raw], scale=1)
+    thresh_2 = _run(layers, "threshold", [raw], scale=2)     # a branch which was tried but not used
+    merged = _run(layers, "merge", [thresh_1, raw])
+    final = _run(layers, "cleaning", [merged], min_size=3)
+
+    pipeline = build_pipeline(layers, final)
+    assert pipeline["inputs"] == [raw.metadata["id"]]
+    assert [node["step"] for node in pipeline["nodes"]] == ["threshold", "merge", "cleaning"]
+    assert thresh_2.metadata["id"] not in [node["id"] for node in pipeline["nodes"]]
+
+    save_pipeline(pipeline, tmp_path / "pipeline.json")
+    pipeline = load_pipeline(tmp_path / "pipeline.json")
+    assert np.array_equal(run_pipeline(pipeline, raw.data), final.data)
+
+    results = run_pipeline(pipeline, raw.data, keep_intermediates=True)
+    assert np.array_equal(results[thresh_1.metadata["id"]], thresh_1.data)
+
+    # replay on a new image
+    new_image = rng.random((5, 20, 20))
+    assert run_pipeline(pipeline, new_image).shape == new_image.shape
@@ -0,0 +1,27 @@
+import pytest
+import numpy as np
+from vessel_express.pipeline import STEPS
+from vessel_express.preview import preview_region, preview_step
+
+
+@pytest.mark.preview
+def test_preview_region():
+    padded, inner = preview_region((12, 40, 40), "closing", {"kernel": 3}, 5)
+    assert padded == (slice(2, 9), slice(0, 40), slice(0, 40))
+    assert inner == (slice(3, 4), slice(0, 40), slice(0, 40))
+    padded, inner = preview_region((12, 40, 40), "threshold", {"scale": 2}, 0, roi=[(5, 15), (30, 50)])
+    assert padded == (slice(0, 1), slice(5, 15), slice(30, 40))
+    assert inner == (slice(0, 1), slice(0, 10), slice(0, 10))
+
+
+@pytest.mark.preview
+def test_preview_matches_full(blobs):
+    threshold = STEPS["threshold"](blobs, 2)
+    out, offset = preview_step("threshold", blobs, {"scale": 2}, 5)
+    assert offset == (5, 0, 0)
+    assert np.array_equal(out, threshold[5:6])
+
+    closing = STEPS["closing"](threshold, 3)
+    out, offset = preview_step("closing", threshold, {"kernel": 3}, 6, roi=[(8, 32), (15, 25)])
+    assert offset == (6, 8, 15)
+    assert np.array_equal(out, closing[6:7, 8:32, 15:25])
@@ -0,0 +1,29 @@
+import json
+import pytest
+import numpy as np
+from vessel_express.profiling import StepProfiler
+
+
+@pytest.mark.profiling
+def test_profiler(tmp_path):
+    profiler = StepProfiler(source="Raw_liver_1")
+    rows = []
+    profiler.callbacks.append(rows.append)
+    image = np.random.rand(20, 30, 40).astype(np.float32)
+
+    with profiler.profile("threshold", image, params={"scale": 2}) as record:
+        out = image > image.mean() + 2 * image.std()
+        record.output(out)
+
+    assert rows == profiler.records
+    record = profiler.records[0]
+    assert record.inputs == [{"shape": [20, 30, 40], "dtype": "float32"}]
+    assert record.outputs == [{"shape": [20, 30, 40], "dtype": "bool"}]
+    assert record.peak_memory >= out.nbytes
+    assert record.wall_time > 0 and record.voxels == 24000
+
+    profiler.export_json(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as f:
+        trace = json.load(f)
+    assert trace["source"] == "Raw_liver_1"
+    assert trace["records"][0]["params"] == {"scale": 2}
@@ -0,0 +1,31 @@
+import pytest
+import numpy as np
+from vessel_express.pipeline import preset_pipeline
+from vessel_express.progressive import coarse_params, coarse_pipeline, coarse_transform, downsample
+
+
+@pytest.mark.progressive
+def test_coarse_params():
+    assert coarse_params("vesselness", {"sigma": 2, "gamma": 5}, 2) == {"sigma": 1, "gamma": 5}
+    assert coarse_params("smoothing", {"n_iter": 10}, 2)["n_iter"] == 2
+    assert coarse_params("closing", {"kernel": 5}, 4)["kernel"] == 1
+    assert coarse_params("cleaning", {"min_size": 100}, 2)["min_size"] == 12
+    assert coarse_params("threshold", {"scale": 3}, 4) == {"scale": 3}
+
+    pipeline = preset_pipeline("Liver")
+    coarse = coarse_pipeline(pipeline, 2)
+    assert [node["id"] for node in coarse["nodes"]] == [node["id"] for node in pipeline["nodes"]]
+    assert pipeline["nodes"][2]["params"]["sigma"] == 2
+    assert coarse["nodes"][2]["params"]["sigma"] == 1
+
+
+@pytest.mark.progressive
+def test_downsample():
+    mask = np.zeros((12, 40, 40), dtype=bool)
+    mask[4:8, 10:30, 10:30] = True
+    coarse = downsample(mask, 2)
+    assert coarse.shape == (6, 20, 20) and coarse.dtype == bool
+    assert np.array_equal(coarse, mask[::2, ::2, ::2])
+
+    scale, translate = coarse_transform(mask.shape, coarse.shape)
+    assert scale == (2, 2, 2) and translate == (0.5, 0.5, 0.5)
@@ -0,0 +1,30 @@
+import pytest
+import numpy as np
+from tifffile import imread
+from skimage.transform import rescale
+from vessel_express.resample import resample, isotropic_zoom
+
+
+@pytest.mark.resample
+def test_resample_matches_rescale():
+    image = imread('src/vessel_express/_tests/images/Raw_liver_1.tiff').astype(np.float32)
+
+    for zoom, anti_aliasing in [((2.5, 1, 1), False), ((1, 0.4, 0.4), True)]:
+        expected = rescale(image, zoom, order=1, preserve_range=True,
+                           anti_aliasing=anti_aliasing)
+        out = resample(image, zoom, anti_aliasing=anti_aliasing,
+                       block_shape=(16, 40, 40), n_workers=2)
+        assert out.dtype == np.float32
+        assert out.shape == expected.shape
+        np.testing.assert_allclose(out, expected, atol=0.01)
+
+
+@pytest.mark.resample
+def test_resample_to_memmap(tmp_path):
+    image = imread('src/vessel_express/_tests/images/Raw_liver_1.tiff')
+    zoom = isotropic_zoom((0.29, 0.108, 0.108), target="coarsest")
+
+    out = resample(image, zoom, out=tmp_path / "iso.npy")
+    assert out.dtype == image.dtype
+    assert np.array_equal(np.load(tmp_path / "iso.npy"), out)
+    assert out.shape == (51, 48, 48)
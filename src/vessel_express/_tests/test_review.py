@@ -0,0 +1,168 @@
+import os
+import threading
+import pytest
+import numpy as np
+from tifffile import imread, imwrite
+from vessel_express.review import (
+    THUMBNAIL_DIR, Prefetcher, ReviewIndex, compute_qc, compute_review, compute_thumbnail, contrast_limits, load_pair,
+    projections, qc_columns, qc_metrics, raw_path, review_order, thumbnail
+)
+
+
+@pytest.mark.review
+def test_load_pair(tmp_path):
+    original = np.arange(4 * 8 * 8, dtype=np.uint16).reshape(4, 8, 8)
+    imwrite(tmp_path / "a.tif", original)
+    imwrite(tmp_path / "Binary_a.tiff", (original > 100).astype(np.uint8))
+    bw_fn = str(tmp_path / "Binary_a.tiff")
+    assert raw_path(bw_fn) == str(tmp_path / "a.tif")
+    pair = load_pair(bw_fn)
+    assert np.array_equal(pair["original"], original)
+    assert np.array_equal(pair["segmentation"], original > 100)
+    assert pair["segmentation_limits"] == [0, 1]
+
+
+@pytest.mark.review
+def test_prefetcher():
+    loaded = []
+    release = threading.Event()
+
+    def load(key):
+        release.wait(5)
+        loaded.append(key)
+        return key * 2
+
+    prefetcher = Prefetcher(load, depth=2)
+    prefetcher.prefetch([1, 2, 3])
+    assert list(prefetcher.futures) == [1, 2]
+    # 2 is no longer upcoming: dropped before it is loaded
+    prefetcher.prefetch([1, 3])
+    assert list(prefetcher.futures) == [1, 3]
+    release.set()
+    assert prefetcher.get(1, upcoming=[3, 4]) == 2
+    assert list(prefetcher.futures) == [3, 4]
+    assert prefetcher.get(3) == 6
+    # not prefetched: loaded on demand
+    assert prefetcher.get(5) == 10
+    prefetcher.shutdown()
+    assert 2 not in loaded
+
+
+@pytest.mark.review
+def test_contrast_limits():
+    rng = np.random.default_rng(0)
+    image = rng.gamma(2, 300, (20, 64, 64))
+    for data, tolerance in [(image.astype(np.uint16), 1), (image, np.ptp(image) / 4096)]:
+        expected = np.percentile(data, [0.5, 99.5])
+        assert np.allclose(contrast_limits(data), expected, atol=tolerance)
+    # a subsample of a quarter of the voxels
+    assert np.allclose(contrast_limits(image, max_samples=image.size // 4), np.percentile(image, [0.5, 99.5]), rtol=0.05)
+
+
+@pytest.mark.review
+def test_review_index(tmp_path):
+    path = tmp_path / "a.tif"
+    imwrite(path, np.zeros((2, 4, 4), dtype=np.uint8))
+    index = ReviewIndex(str(tmp_path))
+    assert index.get(str(path), "contrast_limits") is None
+    index.set(str(path), "contrast_limits", [0, 1])
+    # reloaded from the sidecar file
+    assert ReviewIndex(str(tmp_path)).get(str(path), "contrast_limits") == [0, 1]
+    # a modified file invalidates its entry
+    imwrite(path, np.ones((2, 8, 8), dtype=np.uint8))
+    assert ReviewIndex(str(tmp_path)).get(str(path), "contrast_limits") is None
+
+    # values set without saving are written together, unchanged indexes are not written again
+    index = ReviewIndex(str(tmp_path))
+    index.set(str(path), "contrast_limits", [0, 2], save=False)
+    index.set(str(path), "qc", {}, save=False)
+    assert ReviewIndex(str(tmp_path)).get(str(path), "qc") is None
+    index.save()
+    assert ReviewIndex(str(tmp_path)).get(str(path), "qc") == {}
+    os.remove(index.path)
+    index.save()
+    assert not os.path.exists(index.path)
+
+
+@pytest.mark.review
+def test_qc_metrics():
+    original = np.ones((4, 10, 10))
+    segmentation = np.zeros((4, 10, 10), dtype=np.uint8)
+    segmentation[1, 1:4, 1:4] = 1
+    segmentation[2, 6, 6] = 1
+    original[segmentation > 0] = 5
+    metrics = qc_metrics(original, segmentation)
+    assert metrics == {"foreground": 2.5, "components": 2, "largest_share": 90.0, "mean_inside": 5.0, "mean_outside": 1.0}
+
+
+@pytest.mark.review
+def test_review_order(tmp_path):
+    records = {"c": {"foreground": 1, "components": 3}, "a": None, "b": {"foreground": 2, "components": 3}}
+    for metrics in records.values():
+        if metrics is not None:
+            metrics.update(largest_share=100.0, mean_inside=1.0, mean_outside=0.0)
+    columns = qc_columns(records)
+    assert np.isnan(columns["foreground"][1])
+    assert review_order(columns) == ["a", "b", "c"]
+    # high foreground fractions are suspicious, files without metrics come last
+    assert review_order(columns, "foreground") == ["b", "c", "a"]
+    # ties keep the name order
+    assert review_order(columns, "components") == ["b", "c", "a"]
+
+
+@pytest.mark.review
+def test_compute_qc(tmp_path):
+    original = np.arange(4 * 8 * 8, dtype=np.uint16).reshape(4, 8, 8)
+    imwrite(tmp_path / "a.tiff", original)
+    imwrite(tmp_path / "Binary_a.tiff", (original > 200).astype(np.uint8))
+    bw_fn = str(tmp_path / "Binary_a.tiff")
+    index = ReviewIndex(str(tmp_path))
+    metrics = compute_qc(bw_fn, index)
+    assert metrics == qc_metrics(original, original > 200)
+    # cached, along with the contrast limits of the raw image
+    index = ReviewIndex(str(tmp_path))
+    assert index.get(str(tmp_path / "a.tiff"), "contrast_limits") is not None
+    assert compute_qc(bw_fn, index) == metrics
+    # a changed raw image invalidates the metrics
+    imwrite(tmp_path / "a.tiff", original * 2)
+    assert compute_qc(bw_fn, index)["mean_inside"] == 2 * metrics["mean_inside"]
+
+
+@pytest.mark.review
+def test_thumbnail(tmp_path):
+    rng = np.random.default_rng(0)
+    original = rng.integers(0, 1000, (6, 40, 30), dtype=np.uint16)
+    imwrite(tmp_path / "a.tiff", original)
+    imwrite(tmp_path / "Binary_a.tiff", (original > 990).astype(np.uint8))
+    xy, xz = projections(str(tmp_path / "a.tiff"))
+    assert np.array_equal(xy, original.max(axis=0))
+    assert np.array_equal(xz, original.max(axis=1))
+    bw_fn = str(tmp_path / "Binary_a.tiff")
+    image = compute_thumbnail(bw_fn, ReviewIndex(str(tmp_path)), size=23)
+    # reduced by 2: the XY projection above the XZ projection
+    assert image.shape == (20 + 3, 15, 3) and image.dtype == np.uint8
+    assert (tmp_path / THUMBNAIL_DIR / "Binary_a.tiff.npy").exists()
+    assert np.array_equal(compute_thumbnail(bw_fn, ReviewIndex(str(tmp_path)), size=23), image)
+
+
+@pytest.mark.review
+def test_compute_review(tmp_path, monkeypatch):
+    from vessel_express import review
+    rng = np.random.default_rng(0)
+    original = rng.integers(0, 1000, (6, 40, 30), dtype=np.uint16)
+    imwrite(tmp_path / "a.tiff", original)
+    imwrite(tmp_path / "Binary_a.tiff", (original > 990).astype(np.uint8))
+    bw_fn = str(tmp_path / "Binary_a.tiff")
+    read = []
+    monkeypatch.setattr(review, "imread", lambda path: read.append(path) or imread(path))
+    metrics, image = compute_review(bw_fn, ReviewIndex(str(tmp_path)), size=23)
+    # each image is read once for the metrics and the thumbnail
+    assert sorted(read) == [str(tmp_path / "Binary_a.tiff"), str(tmp_path / "a.tiff")]
+    assert metrics == qc_metrics(original, original > 990)
+    assert np.array_equal(image, thumbnail(str(tmp_path / "a.tiff"), bw_fn, size=23))
+    # both cached
+    read.clear()
+    index = ReviewIndex(str(tmp_path))
+    assert compute_qc(bw_fn, index) == metrics
+    assert np.array_equal(compute_review(bw_fn, index, size=23)[1], image)
+    assert read == []
@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+from vessel_express.pipeline import PRESETS, combine_pipelines, preset_pipeline, run_pipeline
+from vessel_express.scheduler import SharedArray, run_dag, process_pool
+
+
+def _branches():
+    return {
+        "version": 1,
+        "inputs": ["raw"],
+        "output": "cleaned",
+        "nodes": [
+            {"id": "t1", "step": "threshold", "params": {"scale": 1}, "inputs": ["raw"]},
+            {"id": "t2", "step": "threshold", "params": {"scale": 2}, "inputs": ["raw"]},
+            {"id": "t3", "step": "threshold", "params": {"scale": 0}, "inputs": ["raw"]},
+            {"id": "merged", "step": "merge", "params": {}, "inputs": ["t1", "t2", "t3"]},
+            {"id": "cleaned", "step": "cleaning", "params": {"min_size": 3}, "inputs": ["merged"]},
+        ],
+    }
+
+
+@pytest.mark.scheduler
+def test_run_dag_threads():
+    raw = np.random.default_rng(0).random((8, 20, 20))
+    pipeline = _branches()
+    expected = run_pipeline(pipeline, raw, keep_intermediates=True)
+    order = []
+    results = run_dag(pipeline, {"raw": raw}, n_workers=3,
+                      on_result=lambda node, out, record: order.append((node["id"], record.step)))
+    assert order == [(node["id"], node["step"]) for node in pipeline["nodes"]]
+    for key in expected:
+        assert np.array_equal(results[key], expected[key])
+
+    # given results are not computed again
+    results = run_dag(pipeline, {"raw": raw, "merged": expected["merged"]}, n_workers=1,
+                      on_result=lambda node, out, record: order.append(node["id"]))
+    assert order[-1] == "cleaned" and "t1" not in results
+
+
+@pytest.mark.scheduler
+def test_run_dag_processes():
+    raw = np.random.default_rng(0).random((8, 20, 20))
+    pipeline = _branches()
+    expected = run_pipeline(pipeline, raw)
+    pool = process_pool(2)
+    try:
+        results = run_dag(pipeline, {"raw": raw}, executor=pool, keep_intermediates=False)
+    finally:
+        pool.shutdown()
+    assert set(results) == {"cleaned"}
+    assert np.array_equal(results["cleaned"], expected)
+
+
+@pytest.mark.scheduler
+def test_shared_array():
+    data = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    shared = SharedArray(data)
+    try:
+        assert np.array_equal(shared.array, data)
+    finally:
+        shared.release()
+
+
+@pytest.mark.scheduler
+def test_preset_pipeline():
+    for name, preset in PRESETS.items():
+        pipeline = preset_pipeline(name, "raw", spacing=(2, 1, 1))
+        steps = [node["step"] for node in pipeline["nodes"]]
+        assert steps[0] == "smoothing" and steps[-1] == "cleaning"
+        merge = pipeline["nodes"][steps.index("merge")]
+        assert len(merge["inputs"]) == 1 + len(preset["vesselness"])
+        assert pipeline["nodes"][0]["params"]["spacing"] == (2, 1, 1)
+
+
+@pytest.mark.scheduler
+def test_combine_pipelines():
+    raw = np.random.default_rng(0).random((8, 20, 20))
+    first, second = _branches(), _branches()
+    second["nodes"][-1].update(id="cleaned_more", params={"min_size": 10})
+    second["output"] = "cleaned_more"
+    # the same masks merged in another order
+    second["nodes"][3]["inputs"] = ["t3", "t1", "t2"]
+    plan = combine_pipelines([first, second])
+    assert len(plan["nodes"]) == 6 and len(set(plan["outputs"])) == 2
+    results = run_dag(plan, {"raw": raw}, n_workers=2, keep_intermediates=False)
+    assert set(results) == set(plan["outputs"])
+    for pipeline, output in zip([first, second], plan["outputs"]):
+        assert np.array_equal(results[output], run_pipeline(pipeline, raw))
+
+    plan = combine_pipelines([preset_pipeline(name, "raw") for name in PRESETS])
+    assert [node["step"] for node in plan["nodes"]].count("smoothing") == 1
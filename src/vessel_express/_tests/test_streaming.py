@@ -0,0 +1,123 @@
+import os
+import pytest
+import numpy as np
+from tifffile import imwrite
+from vessel_express.pipeline import STEPS, preset_pipeline
+from vessel_express.streaming import PlaneStore, PlaneWatcher, StreamingPipeline, split_pipeline, stream_directory
+
+
+@pytest.fixture
+def blobs_shape():
+    return (30, 32, 32)
+
+
+def pipeline_of(*nodes, output=None):
+    nodes = [{"id": i, "step": step, "params": params, "inputs": inputs} for i, step, params, inputs in nodes]
+    return {"version": 1, "inputs": ["raw"], "output": output or nodes[-1]["id"], "nodes": nodes}
+
+
+VESSELNESS = {"sigma": 1, "gamma": 5, "dim": 3, "cutoff_method": "threshold_otsu", "spacing": None}
+
+
+@pytest.mark.streaming
+def test_plane_store(tmp_path, blobs):
+    store = PlaneStore(str(tmp_path / "store"), chunk=4)
+    store.append(blobs[:3])
+    store.append(blobs[3:10])
+    assert store.shape == (10, 32, 32)
+    assert np.array_equal(store.read(2, 9), blobs[2:9])
+    store.flush()
+    # an existing store is opened, including its incomplete last chunk
+    reopened = PlaneStore(str(tmp_path / "store"))
+    assert reopened.chunk == 4 and reopened.dtype == np.float32
+    reopened.append(blobs[10:13])
+    assert np.array_equal(reopened.read(), blobs[:13])
+    with pytest.raises(ValueError):
+        reopened.append(blobs[:1, :10])
+
+
+@pytest.mark.streaming
+def test_plane_watcher(tmp_path):
+    watcher = PlaneWatcher(str(tmp_path))
+    for z in (1, 2, 10):
+        imwrite(str(tmp_path / f"plane_{z}.tif"), np.full((4, 4), z, dtype=np.uint16))
+    # files are complete once their size is unchanged between two polls
+    assert watcher.poll() == []
+    assert [os.path.basename(p) for p in watcher.poll()] == ["plane_1.tif", "plane_2.tif", "plane_10.tif"]
+    # a file being written holds back the later ones
+    open(tmp_path / "plane_11.tif", "w").close()
+    imwrite(str(tmp_path / "plane_12.tif"), np.zeros((4, 4), dtype=np.uint16))
+    watcher.poll()
+    assert watcher.poll() == []
+    imwrite(str(tmp_path / "plane_11.tif"), np.zeros((4, 4), dtype=np.uint16))
+    watcher.poll()
+    assert [os.path.basename(p) for p in watcher.poll()] == ["plane_11.tif", "plane_12.tif"]
+
+
+@pytest.mark.streaming
+def test_split_pipeline():
+    pipeline = preset_pipeline("Brain")
+    head, tail = split_pipeline(pipeline)
+    assert [node["step"] for node in head["nodes"]] == ["smoothing", "threshold", "vesselness", "vesselness", "merge"]
+    assert [node["step"] for node in tail["nodes"]] == ["closing", "cleaning"]
+    assert tail["inputs"] == [head["output"]] and tail["output"] == pipeline["output"]
+    assert split_pipeline(head) == (head, None)
+    with pytest.raises(ValueError):
+        split_pipeline(pipeline_of(("c", "cleaning", {"min_size": 5}, ["raw"])))
+    with pytest.raises(ValueError):
+        StreamingPipeline(pipeline, "unused")
+
+
+@pytest.mark.streaming
+def test_streaming_matches_whole_stack(tmp_path, blobs):
+    pipeline = pipeline_of(
+        ("t", "threshold", {"scale": 2}, ["raw"]),
+        ("v", "vesselness", VESSELNESS, ["raw"]),
+        ("m", "merge", {}, ["t", "v"]),
+    )
+    stream = StreamingPipeline(pipeline, str(tmp_path / "stream"), chunk=8, batch=4)
+    for plane in blobs:
+        stream.push(plane)
+        # only the planes within the halo of the filter are kept
+        assert len(stream.planes["raw"].planes) <= stream.batch + 2 * stream.halo["v"]
+    # the last planes wait for the end of the stack
+    assert stream.processed < len(blobs)
+    result = stream.finish().read()
+
+    threshold = STEPS["threshold"](blobs, 2)
+    assert np.array_equal(result, STEPS["merge"](threshold, STEPS["vesselness"](blobs, **VESSELNESS)))
+    assert np.array_equal(stream._pointwise("t", 0, len(blobs)), threshold)
+    with pytest.raises(FileExistsError):
+        StreamingPipeline(pipeline, str(tmp_path / "stream"))
+
+
+@pytest.mark.streaming
+def test_streaming_smoothing(tmp_path, blobs):
+    params = {"spacing": None, "n_iter": 3, "time_step": 0.0625, "tolerance": None, "blockwise": False, "precision": "float32"}
+    pipeline = pipeline_of(("s", "smoothing", params, ["raw"]), ("t", "threshold", {"scale": 2}, ["s"]))
+    stream = StreamingPipeline(pipeline, str(tmp_path / "stream"), batch=8)
+    stream.push(blobs[:20])
+    stream.push(blobs[20:])
+    result = stream.finish().read()
+    smoothed = stream.stores["s"].read()
+    expected = STEPS["smoothing"](blobs, **params)
+    # the conductance is normalized per window
+    assert np.abs(smoothed - expected).max() < 0.05 * np.ptp(expected)
+    assert np.mean(result == STEPS["threshold"](expected, 2)) > 0.99
+
+
+@pytest.mark.streaming
+def test_stream_directory(tmp_path, blobs):
+    source = tmp_path / "planes"
+    source.mkdir()
+    for z, plane in enumerate(blobs):
+        imwrite(str(source / f"z{z}.tif"), plane)
+    pipeline = pipeline_of(("t", "threshold", {"scale": 2}, ["raw"]))
+    seen = []
+    result = stream_directory(str(source), pipeline, str(tmp_path / "store"), n_planes=len(blobs), interval=0,
+                              on_planes=lambda stream: seen.append(stream.n_planes))
+    assert seen == list(range(1, len(blobs) + 1))
+    assert np.array_equal(result.read(), STEPS["threshold"](blobs, 2))
+    # without more planes, the stack ends after the idle time
+    result = stream_directory(str(source), pipeline, str(tmp_path / "idle"), idle=0.05, interval=0.01)
+    assert result.shape == blobs.shape
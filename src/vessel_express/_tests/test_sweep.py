@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+from vessel_express.pipeline import STEPS
+from vessel_express.sweep import agreement, sweep
+
+
+@pytest.mark.sweep
+def test_agreement():
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[:2] = True
+    reference = np.zeros((4, 4), dtype=bool)
+    reference[1:3] = True
+    assert agreement(mask, reference) == {"dice": 0.5, "jaccard": 1 / 3, "precision": 0.5, "recall": 0.5}
+
+
+@pytest.mark.sweep
+def test_sweep_matches_steps(blobs):
+    reference = STEPS["threshold"](blobs, 2)
+    rows = sweep(blobs, scales=[2, 3], sigmas=[1, 2], gammas=[5],
+                 cutoff_methods=["threshold_otsu", "threshold_triangle"], reference=reference, n_workers=2)
+    assert [row["step"] for row in rows] == ["threshold"] * 2 + ["vesselness"] * 4
+    assert rows[0]["dice"] == 1
+    for row in rows:
+        mask = STEPS[row["step"]](blobs, **row["params"])
+        assert row["foreground"] == np.count_nonzero(mask) / mask.size
+        assert row["dice"] == agreement(mask, reference)["dice"]
@@ -0,0 +1,95 @@
+import pytest
+import numpy as np
+from tifffile import imread
+from skimage.morphology import ball, cube
+from vessel_express.utils import (
+    normalize_spacing,
+    anisotropic_cube,
+    anisotropic_ball,
+    topology_preserving_thinning,
+    vesselness_filter,
+    edge_preserving_smoothing,
+    array_fingerprint,
+    vesselness_response
+)
+from vessel_express.pipeline import STEPS
+
+
+@pytest.mark.spacing
+def test_normalize_spacing():
+    assert normalize_spacing(None) is None
+    assert normalize_spacing((0.29, 0, 0.108)) is None
+    assert normalize_spacing((0.5, 0.25, 0.25)) == (2.0, 1.0, 1.0)
+
+
+@pytest.mark.spacing
+def test_footprints():
+    assert np.array_equal(anisotropic_cube(5), cube(5))
+    assert np.array_equal(anisotropic_ball(2), ball(2))
+    assert anisotropic_cube(5, (2.5, 1, 1)).shape == (2, 5, 5)
+    assert anisotropic_ball(2, (2, 1, 1)).shape == (3, 5, 5)
+
+
+@pytest.mark.spacing
+def test_isotropic_spacing_is_identity():
+    image = np.load('src/vessel_express/_tests/images/smoothing.npy')
+    mask = np.load('src/vessel_express/_tests/images/hole_removal.npy')
+
+    ves1 = vesselness_filter(image, 3, 2, 10, "threshold_li")
+    ves2 = vesselness_filter(image, 3, 2, 10, "threshold_li", spacing=(1, 1, 1))
+    assert np.array_equal(ves1, ves2)
+
+    # medial_axis breaks ties randomly, so only check that thinning removes
+    # boundary voxels and nothing else
+    thinned = topology_preserving_thinning(mask, 1, 1, spacing=(2.7, 1, 1))
+    assert not np.any(thinned & ~mask)
+    assert 0 < thinned.sum() < mask.sum()
+
+
+@pytest.mark.smoothing
+def test_edge_preserving_smoothing():
+    image = imread('src/vessel_express/_tests/images/Raw_liver_1.tiff')
+    expected = np.load('src/vessel_express/_tests/images/smoothing.npy')
+
+    out = edge_preserving_smoothing(image)
+    assert out.dtype == np.float32
+    assert np.array_equal(out, expected)
+
+    # a zero tolerance never stops early, one iteration at a time gives the same result
+    out = edge_preserving_smoothing(image, tolerance=0)
+    assert np.array_equal(out, expected)
+
+    out = edge_preserving_smoothing(image[:20], n_iter=3, blockwise=True,
+                                    block_shape=(10, 65, 65), n_workers=2)
+    assert out.shape == (20, 130, 130)
+    assert out.dtype == np.float32
+
+
+def test_array_fingerprint():
+    image = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+    assert array_fingerprint(image) == array_fingerprint(image.copy())
+    assert array_fingerprint(image) != array_fingerprint(image.astype(np.int32))
+    assert array_fingerprint(image) != array_fingerprint(image.reshape(4, 3, 2))
+
+
+@pytest.mark.precision
+def test_precision(blobs):
+    image = blobs
+    reference = STEPS["smoothing"](image)
+    assert reference.dtype == np.float32
+    for precision, dtype, rtol in [("float64", np.float64, 1e-4), ("float16", np.float16, 1e-3)]:
+        smoothed = STEPS["smoothing"](image, precision=precision)
+        assert smoothed.dtype == dtype
+        assert np.allclose(smoothed, reference, rtol=rtol)
+        resampled = STEPS["isotropic"](reference, (2, 1, 1), precision=precision)
+        assert resampled.dtype == dtype
+        assert np.allclose(resampled, STEPS["isotropic"](reference, (2, 1, 1)), rtol=rtol)
+    with pytest.warns(UserWarning):
+        assert STEPS["smoothing"](image * 1000, n_iter=1, precision="float16").dtype == np.float32
+
+    # the response does not depend on the storage type of its input
+    half = reference.astype(np.float16)
+    for dim in (2, 3):
+        response = vesselness_response(half, dim, 1, 5)
+        assert response.dtype == vesselness_response(reference, dim, 1, 5).dtype
+    assert vesselness_response(image.astype(np.uint8), 2, 1, 5).dtype == np.int16
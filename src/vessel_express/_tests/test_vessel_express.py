@@ -218,3 +218,29 @@ def test_skeleton(make_napari_viewer):
 
     image2 = para_tuning._skeleton(preset=True, image=image1)
     assert np.array_equal(image2, image3)
+
+
+@pytest.mark.retention
+def test_preset_placeholders(make_napari_viewer):
+    viewer = make_napari_viewer()
+    para_tuning = ParameterTuning(viewer)
+
+    file1 = 'src/vessel_express/_tests/images/Raw_liver_1.tiff'
+    image1 = imread(file1)
+    viewer.add_image(data=image1, name='Raw_liver_1')
+
+    para_tuning.c_preset_input.setCurrentText('Raw_liver_1')
+    para_tuning.c_preset.setCurrentText('Liver')
+    para_tuning.c_retention.setCurrentIndex(0)     # final result only
+    para_tuning._run_preset()
+
+    placeholders = [layer for layer in viewer.layers if layer.metadata.get('placeholder')]
+    assert [layer.name for layer in placeholders] == [
+        'smoothed_Image', 'threshold_3', 'ves_2_10_threshold_li', 'merged_segmentation', 'closing_5'
+    ]
+    assert all(not layer.visible and layer.data.strides == (0, 0, 0) for layer in placeholders)
+
+    merged = viewer.layers['merged_segmentation']
+    merged.visible = True
+    assert not merged.metadata['placeholder']
+    assert merged.data.any()
@@ -0,0 +1,179 @@
+import os
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Sequence, Tuple, Union
+
+
+def default_workers() -> int:
+    """
+    the number of worker threads used by blockwise operations
+    """
+    return os.cpu_count() or 1
+
+
+def block_shape_for(
+    shape: Sequence[int],
+    itemsize: int = 4,
+    max_bytes: int = 64 * 1024 ** 2
+) -> Tuple[int, ...]:
+    """
+    choose a block shape whose size stays below a memory limit
+    Parameters:
+    ------
+    shape: Sequence[int]
+        the shape of the full array
+    itemsize: int
+        the number of bytes per element
+    max_bytes: int
+        the maximum number of bytes per block
+    Returns:
+    ---------
+    tuple
+        the block shape; the leading axis is split first, then the following ones
+    """
+    block = list(shape)
+    axis = 0
+    while int(np.prod(block)) * itemsize > max_bytes and axis < len(block):
+        rest = int(np.prod(block[axis + 1:])) * itemsize
+        block[axis] = max(1, min(block[axis], max_bytes // max(rest, 1)))
+        if block[axis] > 1 or rest <= max_bytes:
+            break
+        axis += 1
+    return tuple(block)
+
+
+def iter_blocks(shape: Sequence[int], block_shape: Sequence[int]) -> Iterator[Tuple[slice, ...]]:
+    """
+    iterate over the blocks tiling an array
+    Parameters:
+    ------
+    shape: Sequence[int]
+        the shape of the full array
+    block_shape: Sequence[int]
+        the (maximal) shape of a block
+    Returns:
+    ---------
+    Iterator[Tuple[slice, ...]]
+        one tuple of slices per block
+    """
+    ranges = [range(0, n, b) for n, b in zip(shape, block_shape)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(s, min(s + b, n)) for s, b, n in zip(starts, block_shape, shape))
+
+
+def create_output(
+    shape: Sequence[int],
+    dtype,
+    out: Optional[Union[np.ndarray, str, os.PathLike]] = None
+) -> np.ndarray:
+    """
+    create (or check) the array a blockwise operation writes into
+    Parameters:
+    ------
+    shape: Sequence[int]
+        the shape of the output
+    dtype:
+        the data type of the output
+    out: np.ndarray or path
+        None for a new in-memory array, a file path for a new memory-mapped
+        .npy file, or an existing array (e.g., np.memmap) to write into
+    Returns:
+    ---------
+    np.ndarray
+        the output array
+    """
+    shape = tuple(int(n) for n in shape)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, (str, os.PathLike)):
+        return np.lib.format.open_memmap(os.fspath(out), mode="w+", dtype=dtype, shape=shape)
+    if tuple(out.shape) != shape:
+        raise ValueError(f"output has shape {tuple(out.shape)}, expected {shape}")
+    return out
+
+
+def save_npy(path: str, array: np.ndarray):
+    """
+    write an .npy file atomically, so readers (and restarted runs) never see a partial file
+    """
+    tmp = os.fspath(path) + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def run_blocks(func: Callable, blocks: Sequence, n_workers: Optional[int] = None) -> list:
+    """
+    run a function on every block, in parallel threads
+    Parameters:
+    ------
+    func: Callable
+        the function to be called with each block (tuple of slices)
+    blocks: Sequence
+        the blocks to process
+    n_workers: int
+        the number of threads, all cores by default
+    Returns:
+    ---------
+    list
+        the return values of func, in the order of blocks
+    """
+    blocks = list(blocks)
+    n_workers = n_workers or default_workers()
+    if n_workers == 1 or len(blocks) == 1:
+        return [func(block) for block in blocks]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(func, blocks))
+
+
+def run_blockwise(
+    func: Callable,
+    image: np.ndarray,
+    depth: Union[int, Sequence[int]],
+    block_shape: Optional[Sequence[int]] = None,
+    dtype=None,
+    out=None,
+    n_workers: Optional[int] = None
+) -> np.ndarray:
+    """
+    apply a filter block by block, each block extended by a halo
+    Parameters:
+    ------
+    func: Callable
+        the filter, taking and returning an array of the same shape
+    image: np.ndarray
+        the image to be filtered (any array supporting slicing, e.g., a memmap)
+    depth: Union[int, Sequence[int]]
+        the halo size along each axis, i.e., how far the filter looks around a voxel
+    block_shape: Sequence[int]
+        the shape of the blocks (without halo), about 64 MB of float32 per block by default
+    dtype:
+        the output data type, the input data type by default
+    out: np.ndarray or path
+        see create_output
+    n_workers: int
+        the number of threads, all cores by default
+    Returns:
+    ---------
+    np.ndarray
+        the filtered image
+    """
+    shape = image.shape
+    depth = np.broadcast_to(np.asarray(depth, dtype=int), (len(shape),))
+    output = create_output(shape, dtype or image.dtype, out)
+    if block_shape is None:
+        block_shape = block_shape_for(shape, itemsize=4)
+
+    def process(block):
+        padded = tuple(
+            slice(max(0, s.start - d), min(n, s.stop + d)) for s, d, n in zip(block, depth, shape)
+        )
+        result = func(np.asarray(image[padded]))
+        inner = tuple(slice(s.start - p.start, s.stop - p.start) for s, p in zip(block, padded))
+        output[block] = result[inner]
+
+    run_blocks(process, iter_blocks(shape, block_shape), n_workers)
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
@@ -0,0 +1,318 @@
+"""
+Checkpointed runs of a pipeline, for long jobs (e.g., whole-organ stacks on
+preemptible nodes) which may be killed before they are done.
+
+Every stage writes its result tile by tile to a TileStore on disk, one .npy
+file per tile, each written atomically. A stage is identified by a hash of
+its step, its parameters and the stages (or input fingerprints) it reads, so
+a restarted run finds the tiles of the same computation, and a run with
+changed parameters recomputes only the stages depending on them. A manifest
+in the checkpoint directory records the pipeline, the fingerprints of the
+input images and the tiling; a restarted run checks it belongs to the same
+job and then computes only the missing tiles.
+
+Local steps (smoothing, vesselness, closing) are computed tile by tile, each
+tile extended by the halo of the step (see lazy.halo_depth). Pointwise steps
+(threshold, the vesselness cutoff, merge) are computed tile by tile from
+statistics of their whole input, reduced from its stored tiles; their masks
+are stored as booleans. Steps on connected components (hole removal,
+thinning, cleaning, skeleton) and resampling need the whole image and are
+stored as a single tile.
+
+As with blockwise smoothing, the conductance of the smoothing is normalized
+per tile, so its result differs slightly from smoothing the whole image.
+"""
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from typing import Callable, Dict, Optional, Sequence, Union
+
+from .blocks import block_shape_for, iter_blocks, run_blocks, save_npy
+from .lazy import halo_depth
+from .pipeline import STEPS
+from .utils import IntegerHistogram, RunningMoments, array_fingerprint, vesselness_response
+
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+LOCAL_STEPS = ("smoothing", "vesselness", "closing")
+
+
+class TileStore:
+    """
+    an image on disk as one .npy file per tile, with a JSON file of its shape
+    and tiling. An existing store is opened with its own shape and tiling.
+
+    Attributes:
+    -------------
+    directory: str
+        the directory of the store
+    shape: tuple
+        the shape of the image
+    tile_shape: tuple
+        the (maximal) shape of a tile
+    dtype: np.dtype
+        the data type, None before the first tile
+    """
+    META = "tiles.json"
+
+    def __init__(self, directory: str, shape: Optional[Sequence[int]] = None, tile_shape: Optional[Sequence[int]] = None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        meta = os.path.join(directory, self.META)
+        if os.path.exists(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            self.shape, self.tile_shape = tuple(meta["shape"]), tuple(meta["tile_shape"])
+            self.dtype = None if meta["dtype"] is None else np.dtype(meta["dtype"])
+            return
+        if shape is None or tile_shape is None:
+            raise FileNotFoundError(f"there is no tile store in {directory}")
+        self.shape, self.tile_shape, self.dtype = tuple(shape), tuple(tile_shape), None
+        os.makedirs(directory, exist_ok=True)
+        self._save_meta()
+
+    def _save_meta(self):
+        meta = {"shape": list(self.shape), "tile_shape": list(self.tile_shape), "dtype": None if self.dtype is None else self.dtype.str}
+        tmp = os.path.join(self.directory, self.META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, self.META))
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def tiles(self) -> list:
+        """
+        the tiles as tuples of slices
+        """
+        return list(iter_blocks(self.shape, self.tile_shape))
+
+    def _path(self, tile) -> str:
+        index = "-".join(str(s.start // t) for s, t in zip(tile, self.tile_shape))
+        return os.path.join(self.directory, f"tile-{index}.npy")
+
+    def done(self, tile) -> bool:
+        return os.path.exists(self._path(tile))
+
+    def missing(self) -> list:
+        """
+        the tiles which are not stored yet
+        """
+        return [tile for tile in self.tiles() if not self.done(tile)]
+
+    def write(self, tile, data: np.ndarray):
+        """
+        store the data of a tile
+        """
+        data = np.asarray(data)
+        if data.shape != tuple(s.stop - s.start for s in tile):
+            raise ValueError(f"data of shape {data.shape} do not fit the tile {tile}")
+        with self._lock:
+            if self.dtype is None:
+                self.dtype = data.dtype
+                self._save_meta()
+        save_npy(self._path(tile), data.astype(self.dtype, copy=False))
+
+    def __getitem__(self, region) -> np.ndarray:
+        """
+        the data within a tuple of slices (with steps of 1), read from the overlapping tiles
+        """
+        region = tuple(slice(*s.indices(n)[:2]) for s, n in zip(region, self.shape))
+        out = None
+        for tile in self.tiles():
+            overlap = tuple(slice(max(r.start, t.start), min(r.stop, t.stop)) for r, t in zip(region, tile))
+            if any(o.start >= o.stop for o in overlap):
+                continue
+            if not self.done(tile):
+                raise ValueError(f"the tile {tile} of {self.directory} is missing")
+            data = np.load(self._path(tile), mmap_mode="r")
+            if out is None:
+                out = np.empty(tuple(r.stop - r.start for r in region), dtype=data.dtype)
+            out[tuple(slice(o.start - r.start, o.stop - r.start) for o, r in zip(overlap, region))] = \
+                data[tuple(slice(o.start - t.start, o.stop - t.start) for o, t in zip(overlap, tile))]
+        return out
+
+    def read(self) -> np.ndarray:
+        """
+        the whole image
+        """
+        return self[tuple(slice(0, n) for n in self.shape)]
+
+
+def stage_keys(pipeline: dict, fingerprints: Dict[str, str]) -> Dict[str, str]:
+    """
+    identify the results of a pipeline by their computation
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline, see pipeline.build_pipeline
+    fingerprints: dict
+        the fingerprint (see utils.array_fingerprint) of each input by id
+    Returns:
+    ---------
+    dict
+        a hash of the step, parameters and inputs of each node (and the fingerprint of each input) by id
+    """
+    keys = dict(fingerprints)
+    for node in pipeline["nodes"]:
+        inputs = [keys[i] for i in node["inputs"]]
+        if node["step"] == "merge":
+            # the order of the merged masks does not matter
+            inputs = sorted(inputs)
+        description = json.dumps([node["step"], node["params"], inputs], sort_keys=True)
+        keys[node["id"]] = hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+    return keys
+
+
+def _check_manifest(directory: str, manifest: dict):
+    """
+    check that a checkpoint directory belongs to the same job, then record the (current) pipeline
+    """
+    path = os.path.join(directory, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        for key in ("version", "inputs", "tile_shape"):
+            if previous.get(key) != manifest[key]:
+                raise ValueError(
+                    f"the checkpoints in {directory} belong to another run ({key} differs), "
+                    "use another directory or delete it"
+                )
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _local_filter(node: dict) -> Callable:
+    params = node["params"]
+    if node["step"] == "smoothing":
+        return lambda block: STEPS["smoothing"](block, **dict(params, blockwise=False))
+    if node["step"] == "vesselness":
+        spacing = params.get("spacing")
+        spacing = None if spacing is None else tuple(spacing)
+        return lambda block: vesselness_response(block, params.get("dim", 3), params["sigma"], params["gamma"], spacing)
+    return lambda block: STEPS["closing"](block, params["kernel"], params.get("spacing"))
+
+
+def run_checkpointed(
+    pipeline: dict,
+    images: Union[np.ndarray, Dict[str, np.ndarray]],
+    directory: str,
+    tile_shape: Optional[Sequence[int]] = None,
+    n_workers: Optional[int] = None,
+    on_tile: Optional[Callable[[dict, tuple], None]] = None
+) -> np.ndarray:
+    """
+    replay a pipeline tile by tile, keeping every finished tile on disk, so a
+    restarted run continues where the last one stopped
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline, see pipeline.build_pipeline
+    images: np.ndarray or dict
+        the input image, or a dict mapping the pipeline inputs to images (any
+        arrays supporting slicing, e.g., memmaps)
+    directory: str
+        the checkpoint directory, with one tile store per stage
+    tile_shape: Sequence[int]
+        the shape of the tiles, about 64 MB of float32 per tile by default
+    n_workers: int
+        the number of threads computing tiles, all cores by default
+    on_tile: Callable
+        called as on_tile(node, tile) after each computed tile, e.g., to show the progress
+    Returns:
+    ---------
+    np.ndarray
+        the final result
+    """
+    if not isinstance(images, dict):
+        if len(pipeline["inputs"]) != 1:
+            raise ValueError(f"the pipeline needs {len(pipeline['inputs'])} input images")
+        images = {pipeline["inputs"][0]: images}
+    shape = next(iter(images.values())).shape
+    tile_shape = tuple(tile_shape or block_shape_for(shape, itemsize=4))
+    fingerprints = {key: array_fingerprint(image) for key, image in images.items()}
+    _check_manifest(directory, {
+        "version": MANIFEST_VERSION,
+        "inputs": [fingerprints[i] for i in pipeline["inputs"]],
+        "tile_shape": list(tile_shape),
+        "pipeline": pipeline,
+    })
+    keys = stage_keys(pipeline, fingerprints)
+    sources = dict(images)
+
+    def run_tiles(node, store, compute):
+        def process(tile):
+            store.write(tile, compute(tile))
+            if on_tile is not None:
+                on_tile(node, tile)
+        run_blocks(process, store.missing(), n_workers)
+
+    def local(node, source, key):
+        func = _local_filter(node)
+        depth = halo_depth(node["step"], node["params"], source.ndim)
+        store = TileStore(os.path.join(directory, key), source.shape, tile_shape)
+
+        def compute(tile):
+            padded = tuple(slice(max(0, s.start - d), min(n, s.stop + d)) for s, d, n in zip(tile, depth, source.shape))
+            result = np.asarray(func(np.asarray(source[padded])))
+            return result[tuple(slice(s.start - p.start, s.stop - p.start) for s, p in zip(tile, padded))]
+
+        run_tiles(node, store, compute)
+        return store
+
+    def tiles_of(source):
+        return (np.asarray(source[tile]) for tile in iter_blocks(source.shape, tile_shape))
+
+    for node in pipeline["nodes"]:
+        key, step, params = keys[node["id"]], node["step"], node["params"]
+        inputs = [sources[i] for i in node["inputs"]]
+        if step in LOCAL_STEPS:
+            source = inputs[0]
+            if step == "vesselness":
+                # the response is a stage of its own, the cutoff is reduced from all its tiles
+                source = local(node, source, key + "-response")
+                store = TileStore(os.path.join(directory, key), source.shape, tile_shape)
+                if store.missing():
+                    histogram = IntegerHistogram()
+                    for data in tiles_of(source):
+                        histogram.add(data)
+                    cutoff = histogram.cutoff(params.get("cutoff_method", "threshold_li"))
+                    run_tiles(node, store, lambda tile: np.asarray(source[tile]) > cutoff)
+            else:
+                store = local(node, source, key)
+        elif step == "threshold":
+            store = TileStore(os.path.join(directory, key), inputs[0].shape, tile_shape)
+            if store.missing():
+                moments = RunningMoments()
+                for data in tiles_of(inputs[0]):
+                    moments.add(data)
+                cutoff = moments.mean + params["scale"] * moments.std
+                run_tiles(node, store, lambda tile: np.asarray(inputs[0][tile]) > cutoff)
+        elif step == "merge":
+            store = TileStore(os.path.join(directory, key), inputs[0].shape, tile_shape)
+
+            def merge_tile(tile):
+                seg = np.asarray(inputs[0][tile]) > 0
+                for other in inputs[1:]:
+                    seg = np.logical_or(seg, np.asarray(other[tile]) > 0)
+                return seg
+
+            run_tiles(node, store, merge_tile)
+        else:
+            # steps on the whole image are one tile, of the shape of their result
+            path = os.path.join(directory, key)
+            store = TileStore(path) if os.path.exists(os.path.join(path, TileStore.META)) else None
+            if store is None or store.missing():
+                result = STEPS[step](*[i.read() if isinstance(i, TileStore) else np.asarray(i) for i in inputs], **params)
+                store = TileStore(path, result.shape, result.shape)
+                store.write(store.tiles()[0], result)
+                if on_tile is not None:
+                    on_tile(node, store.tiles()[0])
+        sources[node["id"]] = store
+    return sources[pipeline["output"]].read()
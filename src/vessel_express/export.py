@@ -0,0 +1,132 @@
+"""
+Export records of many images (per image, per branch, per step timing) as
+Parquet tables for cohort studies.
+
+A store is a directory with one subdirectory per table, partitioned by
+dataset in the hive layout:
+
+    <root>/<table>/dataset=<name>/part-<time>-<uuid>.parquet
+
+Every write adds a new file, so batch workers can append records
+concurrently without rewriting (or locking) earlier files, and a table of
+the whole cohort (or of some datasets) is loaded with one columnar scan.
+
+pyarrow is an optional dependency, only needed for the export.
+"""
+import os
+import time
+import uuid
+import numpy as np
+from typing import Optional, Sequence, Union
+
+PARTITION = "dataset"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("exporting Parquet tables requires pyarrow, e.g., pip install pyarrow") from e
+    return pyarrow
+
+
+def to_arrow(table: Union[dict, list]):
+    """
+    convert a table to a pyarrow.Table
+    Parameters:
+    ------
+    table: dict or list
+        one array per column (the types of the arrays are kept), or one dict per row
+    Returns:
+    ---------
+    pyarrow.Table
+    """
+    pa = _pyarrow()
+    if isinstance(table, list):
+        return pa.Table.from_pylist(table)
+    columns = {}
+    for name, column in table.items():
+        column = np.asarray(column)
+        # strings (and other objects) are converted element by element
+        columns[name] = column.tolist() if column.dtype == object else column
+    return pa.table(columns)
+
+
+def write_table(table: Union[dict, list], path: str):
+    """
+    write a table (see to_arrow) as one Parquet file
+    """
+    _pyarrow().parquet.write_table(to_arrow(table), path)
+
+
+def partition_name(dataset: str) -> str:
+    """
+    the directory name of a dataset partition, without path separators
+    """
+    name = str(dataset).replace(os.sep, "_").replace("/", "_").replace("=", "_")
+    return f"{PARTITION}={name or '_'}"
+
+
+def append_records(root: str, table: str, records: Union[dict, list], dataset: str) -> str:
+    """
+    add records to a table of a store, as a new file in the partition of the dataset
+    Parameters:
+    ------
+    root: str
+        the directory of the store
+    table: str
+        the name of the table, e.g., "images", "branches" or "timings"
+    records: dict or list
+        the records, see to_arrow; the dataset is given by the partition
+    dataset: str
+        the name of the dataset (e.g., of the image directory)
+    Returns:
+    ---------
+    str
+        the path of the new file
+    """
+    pq = _pyarrow().parquet
+    directory = os.path.join(root, table, partition_name(dataset))
+    os.makedirs(directory, exist_ok=True)
+    name = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex}.parquet"
+    # files starting with a dot are ignored when scanning, until they are complete
+    tmp = os.path.join(directory, "." + name)
+    pq.write_table(to_arrow(records), tmp)
+    path = os.path.join(directory, name)
+    os.replace(tmp, path)
+    return path
+
+
+def read_records(
+    root: str,
+    table: str,
+    datasets: Optional[Sequence[str]] = None,
+    columns: Optional[Sequence[str]] = None
+):
+    """
+    load a table of a store in one scan over its files
+    Parameters:
+    ------
+    root: str
+        the directory of the store
+    table: str
+        the name of the table
+    datasets: Sequence[str]
+        the datasets to load, all by default
+    columns: Sequence[str]
+        the columns to load, all by default ("dataset" is the partition column)
+    Returns:
+    ---------
+    pyarrow.Table
+        the records, e.g., table.to_pandas() for a data frame
+    """
+    pa = _pyarrow()
+    partitioning = pa.dataset.partitioning(pa.schema([(PARTITION, pa.string())]), flavor="hive")
+    data = pa.dataset.dataset(os.path.join(root, table), format="parquet", partitioning=partitioning)
+    where = None
+    if datasets is not None:
+        names = [partition_name(dataset).split("=", 1)[1] for dataset in datasets]
+        where = pa.dataset.field(PARTITION).isin(names)
+    return data.to_table(columns=None if columns is None else list(columns), filter=where)
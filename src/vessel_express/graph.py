@@ -0,0 +1,287 @@
+"""
+Turn a skeleton into a vessel network: the skeleton voxels are kept as
+coordinates, and their 26-neighborhood (8-neighborhood in 2D) as a sparse
+adjacency matrix in CSR format, weighted with the distances between the
+voxels. All voxels are processed at once: the neighbors along each offset are
+found by a binary search in the sorted linear indices of the voxels.
+
+Voxels with more than two neighbors are junction voxels, adjacent junction
+voxels form one junction. Removing the junction voxels splits the skeleton
+into its branches. Voxels with at most one neighbor are end points.
+"""
+import itertools
+import numpy as np
+from typing import Optional, Sequence
+
+from .utils import normalize_spacing
+
+
+def skeleton_coordinates(skeleton: np.ndarray) -> np.ndarray:
+    """
+    the coordinates of the voxels of a skeleton, in C order
+    Parameters:
+    ------
+    skeleton: np.ndarray
+        the skeleton as a mask
+    Returns:
+    ---------
+    np.ndarray
+        the coordinates of shape (number of voxels, ndim)
+    """
+    return np.argwhere(np.asarray(skeleton) > 0)
+
+
+class SkeletonGraph:
+    """
+    the adjacency of the voxels of a skeleton, see skeleton_graph
+
+    Attributes:
+    -------------
+    coordinates: np.ndarray
+        the coordinates of the voxels, of shape (number of voxels, ndim)
+    adjacency: scipy.sparse.csr_matrix
+        the symmetric adjacency matrix of the voxels, the entries are the distances
+    shape: tuple
+        the shape of the image of the skeleton
+    spacing: tuple
+        the relative voxel spacing, None for isotropic voxels
+    """
+    def __init__(self, coordinates: np.ndarray, adjacency, shape: Sequence[int], spacing: Optional[Sequence[float]] = None):
+        self.coordinates = coordinates
+        self.adjacency = adjacency
+        self.shape = tuple(shape)
+        self.spacing = spacing
+
+    @property
+    def degree(self) -> np.ndarray:
+        """
+        the number of neighbors of each voxel
+        """
+        return np.diff(self.adjacency.indptr)
+
+    def subgraph(self, keep: np.ndarray) -> "SkeletonGraph":
+        """
+        the graph of the voxels selected by a mask
+        """
+        return SkeletonGraph(self.coordinates[keep], self.adjacency[keep][:, keep], self.shape, self.spacing)
+
+    def to_mask(self) -> np.ndarray:
+        """
+        the skeleton as a mask of the image shape
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[tuple(self.coordinates.T)] = True
+        return mask
+
+
+def _remove_triangles(adjacency):
+    """
+    remove the longest edge of every triangle: a diagonal step next to two
+    shorter steps, as in staircases of the skeleton, would make a junction
+    """
+    from scipy.sparse import csr_matrix
+
+    adjacency = adjacency.tocoo()
+    drop = np.zeros(adjacency.nnz, dtype=bool)
+    for length in np.unique(adjacency.data)[1:]:
+        short = adjacency.data < length
+        shorter = csr_matrix(
+            (np.ones(np.count_nonzero(short)), (adjacency.row[short], adjacency.col[short])), shape=adjacency.shape
+        )
+        paths = shorter @ shorter
+        edges = np.flatnonzero(adjacency.data == length)
+        drop[edges] = np.asarray(paths[adjacency.row[edges], adjacency.col[edges]]).ravel() > 0
+    keep = ~drop
+    return csr_matrix((adjacency.data[keep], (adjacency.row[keep], adjacency.col[keep])), shape=adjacency.shape)
+
+
+def skeleton_graph(
+    coordinates: np.ndarray,
+    shape: Sequence[int],
+    spacing: Optional[Sequence[float]] = None,
+    simplify: bool = True
+) -> SkeletonGraph:
+    """
+    connect the voxels of a skeleton with their neighbors
+    Parameters:
+    ------
+    coordinates: np.ndarray
+        the coordinates of the skeleton voxels, see skeleton_coordinates
+    shape: Sequence[int]
+        the shape of the image of the skeleton
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    simplify: bool
+        whether to remove the longest edge of each triangle of neighbors, so
+        diagonal steps of a line do not make junctions
+    Returns:
+    ---------
+    SkeletonGraph
+        the graph of the voxels
+    """
+    from scipy.sparse import csr_matrix
+
+    coordinates = np.asarray(coordinates, dtype=np.intp).reshape(-1, len(shape))
+    spacing = normalize_spacing(spacing)
+    linear = np.ravel_multi_index(coordinates.T, shape)
+    order = np.argsort(linear, kind="stable")
+    coordinates, linear = coordinates[order], linear[order]
+    unit = np.ones(len(shape)) if spacing is None else np.asarray(spacing, dtype=np.float64)
+
+    rows, cols, lengths = [], [], []
+    index = np.arange(len(linear))
+    # every edge once: the offsets which are positive in C order
+    for offset in itertools.product((-1, 0, 1), repeat=len(shape)):
+        offset = np.asarray(offset)
+        if not any(offset) or offset[np.flatnonzero(offset)[0]] < 0:
+            continue
+        neighbors = coordinates + offset
+        inside = np.all((neighbors >= 0) & (neighbors < np.asarray(shape)), axis=1)
+        target = np.ravel_multi_index(neighbors[inside].T, shape)
+        position = np.minimum(np.searchsorted(linear, target), len(linear) - 1)
+        found = linear[position] == target
+        rows.append(index[inside][found])
+        cols.append(position[found])
+        lengths.append(np.full(np.count_nonzero(found), np.linalg.norm(offset * unit)))
+    rows, cols, lengths = (np.concatenate(a) if a else np.zeros(0) for a in (rows, cols, lengths))
+    adjacency = csr_matrix(
+        (np.concatenate([lengths, lengths]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(len(linear), len(linear))
+    )
+    if simplify and adjacency.nnz:
+        adjacency = _remove_triangles(adjacency)
+    return SkeletonGraph(coordinates, adjacency, shape, spacing)
+
+
+def branches(graph: SkeletonGraph) -> dict:
+    """
+    split a skeleton graph into its branches
+    Parameters:
+    ------
+    graph: SkeletonGraph
+        the graph
+    Returns:
+    ---------
+    dict
+        "labels": the branch of each voxel (-1 for junction voxels);
+        "length": the length of each branch, including the steps to adjacent junctions;
+        "chord": the distance between the two ends of each branch (0 for loops and single voxels);
+        "tortuosity": the length between the ends over the chord (NaN without two ends);
+        "tip": whether the branch has a free end and touches a junction;
+        "junctions": the junction of each voxel (-1 for branch voxels), and "n_junctions"
+    """
+    from scipy.sparse.csgraph import connected_components
+
+    degree = graph.degree
+    junction = degree > 2
+    free = ~junction
+    inner = graph.adjacency[free][:, free].tocoo()
+    n_branches, free_labels = connected_components(inner, directed=False)
+    labels = np.full(len(degree), -1)
+    labels[free] = free_labels
+
+    # the length inside the branch (each edge is stored twice) and the steps to junctions
+    inside = np.bincount(free_labels[inner.row], weights=inner.data, minlength=n_branches) / 2
+    contacts = graph.adjacency[free][:, junction].tocoo()
+    length = inside + np.bincount(free_labels[contacts.row], weights=contacts.data, minlength=n_branches)
+    touches = np.bincount(free_labels[contacts.row], minlength=n_branches) > 0
+
+    # the ends of a branch: its voxels with at most one neighbor within the branch
+    ends = np.flatnonzero(np.diff(inner.tocsr().indptr) <= 1)
+    ends = ends[np.argsort(free_labels[ends], kind="stable")]
+    end_labels, first, count = np.unique(free_labels[ends], return_index=True, return_counts=True)
+    two = count == 2
+    positions = graph.coordinates[free].astype(np.float64)
+    if graph.spacing is not None:
+        positions *= np.asarray(graph.spacing)
+    chord = np.zeros(n_branches)
+    a, b = ends[first[two]], ends[first[two] + 1]
+    chord[end_labels[two]] = np.linalg.norm(positions[a] - positions[b], axis=1)
+    tortuosity = np.full(n_branches, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tortuosity[chord > 0] = inside[chord > 0] / chord[chord > 0]
+
+    tip = np.bincount(free_labels[degree[free] <= 1], minlength=n_branches) > 0
+    n_junctions, junction_labels = connected_components(graph.adjacency[junction][:, junction], directed=False)
+    junctions = np.full(len(degree), -1)
+    junctions[junction] = junction_labels
+    return {
+        "labels": labels,
+        "length": length,
+        "chord": chord,
+        "tortuosity": tortuosity,
+        "tip": tip & touches,
+        "junctions": junctions,
+        "n_junctions": n_junctions,
+    }
+
+
+def _longest_at_junctions(graph: SkeletonGraph, parts: dict) -> np.ndarray:
+    """
+    whether each branch is the longest of the branches touching one of its junctions
+    """
+    labels, junctions, length = parts["labels"], parts["junctions"], parts["length"]
+    contacts = graph.adjacency.tocoo()
+    touch = (labels[contacts.row] >= 0) & (junctions[contacts.col] >= 0)
+    branch, junction = labels[contacts.row[touch]], junctions[contacts.col[touch]]
+    # the first contact of each junction after sorting by decreasing length (then by branch)
+    order = np.lexsort((branch, -length[branch], junction))
+    first = np.unique(junction[order], return_index=True)[1]
+    longest = np.zeros(len(length), dtype=bool)
+    longest[branch[order][first]] = True
+    return longest
+
+
+def prune(graph: SkeletonGraph, min_length: float, iterations: int = 1) -> SkeletonGraph:
+    """
+    remove the short side branches of a skeleton: branches shorter than the
+    given length that end freely on one side and at a junction on the other.
+    The longest branch at each junction is kept, so a junction whose branches
+    are all short keeps its main vessel instead of collapsing to a point.
+    Parameters:
+    ------
+    graph: SkeletonGraph
+        the graph
+    min_length: float
+        the minimal length of the side branches to keep, in (spacing weighted) voxels
+    iterations: int
+        how often to prune, as pruning side branches can make new ones
+    Returns:
+    ---------
+    SkeletonGraph
+        the graph without the short side branches
+    """
+    for _ in range(iterations):
+        parts = branches(graph)
+        short = parts["tip"] & (parts["length"] < min_length) & ~_longest_at_junctions(graph, parts)
+        if not short.any():
+            break
+        labels = parts["labels"]
+        graph = graph.subgraph((labels < 0) | ~short[np.maximum(labels, 0)])
+    return graph
+
+
+def network_statistics(graph: SkeletonGraph) -> dict:
+    """
+    summarize a vessel network
+    Parameters:
+    ------
+    graph: SkeletonGraph
+        the graph of the skeleton
+    Returns:
+    ---------
+    dict
+        the number of skeleton voxels, the total length (in spacing weighted
+        voxels), the number of branches, junctions and end points, and the mean
+        tortuosity of the branches with two ends
+    """
+    parts = branches(graph)
+    tortuosity = parts["tortuosity"][~np.isnan(parts["tortuosity"])]
+    return {
+        "voxels": len(graph.coordinates),
+        "length": float(graph.adjacency.data.sum() / 2),
+        "branches": len(parts["length"]),
+        "junctions": int(parts["n_junctions"]),
+        "end_points": int(np.count_nonzero(graph.degree <= 1)),
+        "tortuosity": float(tortuosity.mean()) if len(tortuosity) else float("nan"),
+    }
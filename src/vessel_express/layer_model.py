@@ -0,0 +1,127 @@
+from napari.layers import Image
+from qtpy.QtCore import QAbstractListModel, QModelIndex, Qt, QTimer
+
+
+class LayerListModel(QAbstractListModel):
+    """
+    the image layers of a viewer as one list model, shared by all layer selecting combo boxes
+
+    Inserted, removed and renamed layers update only their own row, so the
+    combo boxes keep their selections. Reordering (and other changes of the
+    layer list) is coalesced: a burst of such events causes one resync,
+    which moves the rows without losing selections.
+
+    Example:
+    -------------
+    model = LayerListModel(viewer)
+    combo_box.setModel(model)
+    """
+    def __init__(self, viewer, delay: int = 50, parent=None):
+        """
+        Parameters:
+        -------------
+        viewer: napari.Viewer
+            the viewer whose layers are listed
+        delay: int
+            the time in milliseconds over which reorder events are coalesced
+        """
+        super().__init__(parent)
+        self.viewer = viewer
+        self.layers = [layer for layer in viewer.layers if type(layer) == Image]
+        for layer in self.layers:
+            layer.events.name.connect(self._renamed)
+
+        self._resync_timer = QTimer(self)
+        self._resync_timer.setSingleShot(True)
+        self._resync_timer.setInterval(delay)
+        self._resync_timer.timeout.connect(self.resync)
+
+        viewer.layers.events.inserted.connect(self._inserted)
+        viewer.layers.events.removed.connect(self._removed)
+        viewer.layers.events.reordered.connect(lambda event: self._resync_timer.start())
+        viewer.layers.events.changed.connect(lambda event: self._resync_timer.start())
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.layers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.layers):
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.layers[index.row()].name
+        return None
+
+    def layer(self, name: str):
+        """
+        the image layer with the given name, None if there is none
+        """
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        return None
+
+    def _row_for(self, layer) -> int:
+        """
+        the row a layer belongs to: the number of listed layers before it in the viewer
+        """
+        listed = {id(other) for other in self.layers}
+        row = 0
+        for other in self.viewer.layers:
+            if other is layer:
+                return row
+            if id(other) in listed:
+                row += 1
+        return row
+
+    def _inserted(self, event):
+        layer = event.value
+        if type(layer) != Image or id(layer) in {id(other) for other in self.layers}:
+            return
+        row = min(self._row_for(layer), len(self.layers))
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.layers.insert(row, layer)
+        self.endInsertRows()
+        layer.events.name.connect(self._renamed)
+
+    def _removed(self, event):
+        layer = event.value
+        for row, other in enumerate(self.layers):
+            if other is layer:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.layers[row]
+                self.endRemoveRows()
+                layer.events.name.disconnect(self._renamed)
+                return
+
+    def _renamed(self, event):
+        layer = event.source
+        for row, other in enumerate(self.layers):
+            if other is layer:
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.DisplayRole])
+                return
+
+    def resync(self):
+        """
+        bring the rows into the order of the viewer's layers, keeping selections
+        """
+        layers = [layer for layer in self.viewer.layers if type(layer) == Image]
+        if len(layers) == len(self.layers) and all(a is b for a, b in zip(layers, self.layers)):
+            return
+        if set(map(id, layers)) != set(map(id, self.layers)):
+            # layers were replaced: start over
+            self.beginResetModel()
+            for layer in self.layers:
+                layer.events.name.disconnect(self._renamed)
+            self.layers = layers
+            for layer in self.layers:
+                layer.events.name.connect(self._renamed)
+            self.endResetModel()
+            return
+        self.layoutAboutToBeChanged.emit()
+        new_rows = {id(layer): row for row, layer in enumerate(layers)}
+        old_indexes = self.persistentIndexList()
+        new_indexes = [self.index(new_rows[id(self.layers[index.row()])]) for index in old_indexes]
+        self.layers = layers
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
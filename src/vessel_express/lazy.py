@@ -0,0 +1,213 @@
+"""
+Lazy, chunked execution of the pipeline steps with dask.
+
+Local steps (smoothing, vesselness, closing) are applied chunk by chunk with
+``map_overlap``; the overlap of each step is its halo depth, i.e., how far
+the filter looks around a voxel, so the result does not depend on the
+chunking. Pointwise steps (threshold, merge) only need global statistics,
+which are reduced from all chunks first. The statistics are computed when
+the graph is built, so the input of a reducing step (threshold, vesselness)
+is persisted first (see reduced_inputs) and the vesselness response is kept
+in memory: neither is computed again for the masks. Steps acting on whole
+connected components (hole removal, thinning, cleaning, skeleton) and
+resampling are computed eagerly and wrapped again as a dask array, so a
+pipeline ending in one of them is computed completely, not per chunk.
+
+Smoothing normalizes its conductance per chunk (as blockwise smoothing), so
+its result differs slightly from smoothing the whole image at once.
+"""
+import numpy as np
+from typing import Dict, Optional, Sequence, Union
+
+from .utils import PRECISIONS, IntegerHistogram, normalize_spacing, anisotropic_cube, vesselness_response
+from .pipeline import STEPS
+
+
+LOCAL_STEPS = ("smoothing", "vesselness", "closing")
+POINTWISE_STEPS = ("threshold", "merge")
+REDUCING_STEPS = ("threshold", "vesselness")
+
+
+def halo_depth(step: str, params: dict, ndim: int = 3) -> tuple:
+    """
+    the overlap a step needs between neighboring chunks
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of STEPS)
+    params: dict
+        the keyword arguments of the step
+    ndim: int
+        the number of image dimensions
+    Returns:
+    ---------
+    tuple
+        the halo size along each axis
+    """
+    if step == "smoothing":
+        # every diffusion iteration looks one voxel further
+        return (int(params.get("n_iter", 10)),) * ndim
+    if step == "vesselness":
+        spacing = normalize_spacing(params.get("spacing")) or (1.0,) * ndim
+        # the recursive Gaussian of the Hessian is negligible beyond 4 sigma
+        depth = [int(np.ceil(4 * params["sigma"] / s)) + 1 for s in spacing]
+        if params.get("dim", 3) == 2:
+            depth[0] = 0
+        return tuple(depth[-ndim:])
+    if step == "closing":
+        footprint = anisotropic_cube(params["kernel"], normalize_spacing(params.get("spacing")))
+        return tuple(n for n in footprint.shape[-ndim:])
+    return (0,) * ndim
+
+
+def _smoothing(block, **params):
+    return STEPS["smoothing"](block, **params)
+
+
+def _vesselness(block, sigma, gamma, dim=3, spacing=None):
+    return vesselness_response(block, dim, sigma, gamma, spacing)
+
+
+def _closing(block, kernel, spacing=None):
+    return STEPS["closing"](block, kernel, spacing)
+
+
+def _block_histogram(block):
+    histogram = IntegerHistogram()
+    histogram.add(block)
+    return histogram
+
+
+def _merge_histograms(histograms):
+    merged = IntegerHistogram()
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged
+
+
+def reduced_inputs(nodes: Sequence[dict]) -> set:
+    """
+    the ids of the results a reducing step (threshold, vesselness) reads; as
+    lazy results they are persisted, so the reductions and the masks of all
+    these steps share one computation of them
+    Parameters:
+    ------
+    nodes: Sequence[dict]
+        the nodes of a pipeline
+    Returns:
+    ---------
+    set
+        the ids of the inputs
+    """
+    return {i for node in nodes if node["step"] in REDUCING_STEPS for i in node["inputs"]}
+
+
+def lazy_step(step: str, *images, **params):
+    """
+    apply a pipeline step lazily to dask arrays
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of STEPS)
+    images: dask.array.Array
+        the input image(s)
+    params:
+        the keyword arguments of the step
+    Returns:
+    ---------
+    dask.array.Array
+        the (not yet computed) result
+    """
+    import dask
+    import dask.array as da
+
+    images = [da.asarray(image) for image in images]
+    image = images[0]
+
+    if step in LOCAL_STEPS:
+        depth = halo_depth(step, params, image.ndim)
+        # with meta given, the filters are not run on empty blocks to find the type of their results
+        if step == "smoothing":
+            params = dict(params, blockwise=False)
+            storage = PRECISIONS[params.get("precision", "float32")][1]
+            result = da.map_overlap(_smoothing, image, depth=depth, boundary="none",
+                                    dtype=storage, meta=np.empty((0,) * image.ndim, storage), **params)
+        elif step == "vesselness":
+            cutoff_method = params.pop("cutoff_method", "threshold_li")
+            # ITK returns the response as int16, see vesselness_response
+            response = da.map_overlap(_vesselness, image, depth=depth,
+                                      boundary="none", dtype=np.int16, meta=np.empty((0,) * image.ndim, np.int16),
+                                      **params).persist()
+            # the cutoff is global: reduced from the histograms of all chunks in one pass
+            histograms = [dask.delayed(_block_histogram)(block) for block in response.to_delayed().ravel()]
+            histogram = dask.delayed(_merge_histograms)(histograms).compute()
+            result = 1 * (response > histogram.cutoff(cutoff_method))
+        else:
+            result = da.map_overlap(_closing, image, depth=depth, boundary="none",
+                                    dtype=bool, meta=np.empty((0,) * image.ndim, bool), **params)
+        return result
+
+    if step == "threshold":
+        mean, std = dask.compute(image.mean(), image.std())
+        return 1 * (image > mean + params["scale"] * std)
+
+    if step == "merge":
+        seg = image > 0
+        for other in images[1:]:
+            seg = da.logical_or(seg, other > 0)
+        return seg
+
+    result = STEPS[step](*[np.asarray(i) for i in images], **params)
+    return da.from_array(result, chunks=_chunks_like(image, result))
+
+
+def _chunks_like(image, result):
+    """
+    the chunk size of the input, or "auto" if the step changed the shape
+    """
+    if image.shape == result.shape:
+        return image.chunksize
+    return "auto"
+
+
+def run_lazy(
+    pipeline: dict,
+    images: Union[np.ndarray, Dict[str, np.ndarray]],
+    chunks: Optional[Union[str, Sequence[int]]] = "auto",
+    compute: bool = True
+):
+    """
+    replay a pipeline (see pipeline.build_pipeline) chunk by chunk with dask
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline
+    images: np.ndarray or dict
+        the input image, or a dict mapping the pipeline inputs to images.
+        NumPy arrays, memmaps or zarr arrays are split into chunks of the given size.
+    chunks: str or Sequence[int]
+        the chunk shape of inputs that are not dask arrays yet
+    compute: bool
+        whether to compute the final result or return it as a dask array. The
+        results of steps on connected components are computed in any case.
+    Returns:
+    ---------
+    np.ndarray or dask.array.Array
+        the final result
+    """
+    import dask.array as da
+
+    if not isinstance(images, dict):
+        if len(pipeline["inputs"]) != 1:
+            raise ValueError(f"the pipeline needs {len(pipeline['inputs'])} input images")
+        images = {pipeline["inputs"][0]: images}
+    results = {
+        key: image if isinstance(image, da.Array) else da.from_array(image, chunks=chunks)
+        for key, image in images.items()
+    }
+    reduced = reduced_inputs(pipeline["nodes"])
+    for node in pipeline["nodes"]:
+        result = lazy_step(node["step"], *[results[i] for i in node["inputs"]], **node["params"])
+        results[node["id"]] = result.persist() if node["id"] in reduced else result
+    output = results[pipeline["output"]]
+    return output.compute() if compute else output
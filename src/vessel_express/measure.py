@@ -0,0 +1,166 @@
+"""
+Measure a vessel network branch by branch: the radius of the vessels is the
+Euclidean distance transform (EDT) of the segmentation, sampled at the
+voxels of its skeleton, and aggregated over the branches of the skeleton
+graph (see graph.branches) together with their length and volume.
+
+The EDT is computed once for the whole mask. Given the largest radius of
+interest, it is computed block by block in parallel threads, each block
+extended by a halo of that radius; larger distances are clipped to it.
+"""
+import csv
+import numpy as np
+from typing import Optional, Sequence
+
+from .blocks import block_shape_for, default_workers, run_blockwise
+from .export import write_table
+from .graph import SkeletonGraph, branches
+from .pipeline import skeleton_network
+from .utils import normalize_spacing
+
+# the columns of a branch table (see branch_measurements), in order
+BRANCH_COLUMNS = [
+    "branch", "voxels", "length", "chord", "tortuosity",
+    "mean_radius", "min_radius", "max_radius", "volume", "tip",
+]
+
+
+def distance_transform(
+    mask: np.ndarray,
+    spacing: Optional[Sequence[float]] = None,
+    max_radius: Optional[float] = None,
+    n_workers: Optional[int] = None
+) -> np.ndarray:
+    """
+    the Euclidean distance of each foreground voxel to the background
+    Parameters:
+    ------
+    mask: np.ndarray
+        the mask
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    max_radius: float
+        the largest distance of interest (in spacing weighted voxels), larger
+        distances are clipped to it; None to compute the exact transform in one piece
+    n_workers: int
+        the number of threads with a max_radius, all cores by default
+    Returns:
+    ---------
+    np.ndarray
+        the distances as float32
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    spacing = normalize_spacing(spacing)
+    if max_radius is None:
+        return distance_transform_edt(np.asarray(mask) > 0, sampling=spacing).astype(np.float32)
+
+    unit = np.ones(mask.ndim) if spacing is None else np.asarray(spacing)
+    depth = tuple(int(np.ceil(max_radius / s)) + 1 for s in unit)
+
+    def edt_block(block):
+        block = block > 0
+        # without background in reach, every distance exceeds the halo
+        if block.all():
+            return np.full(block.shape, max_radius, dtype=np.float32)
+        return np.minimum(distance_transform_edt(block, sampling=spacing), max_radius)
+
+    # at least one block per thread, split along the leading axis
+    n_workers = n_workers or default_workers()
+    block_shape = block_shape_for(mask.shape, itemsize=4)
+    block_shape = (max(1, min(block_shape[0], -(-mask.shape[0] // n_workers))),) + tuple(block_shape[1:])
+    return run_blockwise(edt_block, mask, depth, block_shape=block_shape, dtype=np.float32, n_workers=n_workers)
+
+
+def branch_measurements(graph: SkeletonGraph, distance: np.ndarray) -> dict:
+    """
+    measure the branches of a skeleton graph
+    Parameters:
+    ------
+    graph: SkeletonGraph
+        the graph of the skeleton
+    distance: np.ndarray
+        the distance transform of the segmentation, see distance_transform
+    Returns:
+    ---------
+    dict
+        one array per column (see BRANCH_COLUMNS): the number of voxels, length,
+        chord and tortuosity of each branch (see graph.branches), the mean,
+        minimal and maximal radius at its voxels, its volume (as a tube of the
+        length and the mean squared radius), and whether it is a side branch
+    """
+    parts = branches(graph)
+    labels = parts["labels"]
+    n_branches = len(parts["length"])
+    radius = np.asarray(distance[tuple(graph.coordinates.T)], dtype=np.float64)
+
+    free = labels >= 0
+    labels, radius = labels[free], radius[free]
+    voxels = np.bincount(labels, minlength=n_branches)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_radius = np.bincount(labels, weights=radius, minlength=n_branches) / voxels
+        mean_squared = np.bincount(labels, weights=radius ** 2, minlength=n_branches) / voxels
+    # minima and maxima over the voxels sorted by branch
+    order = np.argsort(labels, kind="stable")
+    starts = np.searchsorted(labels[order], np.arange(n_branches))
+    min_radius = np.minimum.reduceat(radius[order], starts) if len(radius) else np.zeros(0)
+    max_radius = np.maximum.reduceat(radius[order], starts) if len(radius) else np.zeros(0)
+    return {
+        "branch": np.arange(n_branches),
+        "voxels": voxels,
+        "length": parts["length"],
+        "chord": parts["chord"],
+        "tortuosity": parts["tortuosity"],
+        "mean_radius": mean_radius,
+        "min_radius": min_radius,
+        "max_radius": max_radius,
+        "volume": np.pi * mean_squared * parts["length"],
+        "tip": parts["tip"],
+    }
+
+
+def measure_network(
+    mask: np.ndarray,
+    spacing: Optional[Sequence[float]] = None,
+    min_branch_length: float = 0,
+    max_radius: Optional[float] = None,
+    graph: Optional[SkeletonGraph] = None,
+    n_workers: Optional[int] = None
+) -> dict:
+    """
+    skeletonize a segmentation and measure its branches
+    Parameters:
+    ------
+    mask: np.ndarray
+        the final segmentation
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    min_branch_length: float
+        the length of the shortest side branches to keep, see graph.prune
+    max_radius: float
+        the largest radius of interest, see distance_transform
+    graph: SkeletonGraph
+        the graph of the skeleton of the mask if it is known already
+    n_workers: int
+        the number of threads of the distance transform
+    Returns:
+    ---------
+    dict
+        the branch table, see branch_measurements
+    """
+    if graph is None:
+        graph = skeleton_network(mask, min_branch_length, spacing)[1]
+    return branch_measurements(graph, distance_transform(mask, spacing, max_radius, n_workers))
+
+
+def save_table(table: dict, path: str):
+    """
+    write a table (one array per column) as CSV, or as Parquet if the path ends with .parquet (see export.write_table)
+    """
+    if str(path).endswith(".parquet"):
+        write_table(table, path)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(table))
+        writer.writerows(zip(*(np.asarray(column).tolist() for column in table.values())))
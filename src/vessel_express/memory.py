@@ -0,0 +1,226 @@
+"""
+Keep the intermediates of a pipeline run within a memory budget.
+
+Before a step runs, its peak memory is estimated from the size of its input.
+If the step would not fit next to the intermediates that are still needed,
+the least recently used intermediates are spilled to memory-mapped temporary
+files; they stay usable as (read-only) arrays and are read back from disk
+when a later step needs them. Intermediates are dropped as soon as no
+downstream step needs them, unless they stay alive outside of the run (e.g.,
+as layers): those are still counted, and can still be spilled.
+"""
+import os
+import warnings
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Collection, Dict, Optional, Sequence
+
+
+# additional bytes a step allocates per input voxel, measured at the peak of
+# each step (ITK filters included) with float32 images and boolean masks
+PEAK_BYTES_PER_VOXEL = {
+    "smoothing": 12,
+    "vesselness": 56,
+    "threshold": 9,
+    "merge": 3,
+    "closing": 2,
+    "hole_removal": 4,
+    "thinning": 7,
+    "cleaning": 15,
+    "skeleton": 4,
+}
+
+
+def estimate_peak(step: str, inputs: Sequence[np.ndarray], params: Optional[dict] = None) -> int:
+    """
+    estimate the memory a step allocates while it runs (besides its inputs)
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of pipeline.STEPS)
+    inputs: Sequence[np.ndarray]
+        the input arrays
+    params: dict
+        the parameters of the step
+    Returns:
+    ---------
+    int
+        the estimated peak in bytes, including the result
+    """
+    voxels = max((int(np.prod(a.shape)) for a in inputs), default=0)
+    if step == "isotropic":
+        # float32 computation of the (larger or smaller) output, plus the output itself
+        return int(voxels * float(np.prod((params or {}).get("zoom", 1))) * 16)
+    return voxels * PEAK_BYTES_PER_VOXEL.get(step, 16)
+
+
+def available_memory() -> int:
+    """
+    the memory currently available to this process in bytes
+    """
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        return int(os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+
+
+def in_memory(array) -> bool:
+    """
+    whether an array occupies RAM (memory-mapped and lazy arrays do not)
+    """
+    if hasattr(array, "dask"):
+        return False
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return False
+        array = array.base
+    return True
+
+
+def spill_to_disk(array: np.ndarray, prefix: str = "", directory: Optional[str] = None) -> np.memmap:
+    """
+    copy an array into a memory-mapped temporary file
+    Parameters:
+    ------
+    array: np.ndarray
+        the array
+    prefix: str
+        added to the file name
+    directory: str
+        the directory of the temporary file, the system default by default
+    Returns:
+    ---------
+    np.memmap
+        the copy; the file is deleted once the memmap is closed
+    """
+    fd, path = tempfile.mkstemp(suffix=".npy", prefix=f"vessel_express_{prefix}", dir=directory)
+    os.close(fd)
+    spilled = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+    spilled[...] = array
+    spilled.flush()
+    try:
+        # the mapping stays valid, the file is deleted once it is closed
+        os.remove(path)
+    except OSError:
+        warnings.warn(f"temporary file {path} could not be removed")
+    return spilled
+
+
+class MemoryManager:
+    """
+    track the intermediates of a pipeline run against a memory budget and
+    spill the least recently used ones to disk when a step needs the room
+
+    Example:
+    -------------
+    memory = MemoryManager(budget=8 * 1024 ** 3)
+    results = run_dag(pipeline, {"raw": image}, memory=memory)
+    """
+    def __init__(
+        self,
+        budget: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        on_spill: Optional[Callable] = None,
+        retained: Collection[str] = ()
+    ):
+        """
+        Parameters:
+        -------------
+        budget: int
+            the memory budget in bytes, 80 % of the available memory by default
+        spill_dir: str
+            the directory of the temporary files, the system default by default
+        on_spill: Callable
+            called as on_spill(key, memmap) when an intermediate was spilled,
+            e.g., to swap the data of a layer holding it
+        retained: Collection[str]
+            the keys of intermediates which stay alive when the run drops them,
+            e.g., because they are shown as layers
+        """
+        self.budget = int(budget) if budget else int(0.8 * available_memory())
+        self.spill_dir = spill_dir
+        self.on_spill = on_spill
+        self.tracked = OrderedDict()    # key -> bytes in memory, least recently used first
+        self.retained = set(retained)
+        self.kept = {}                  # key -> retained intermediates the run dropped
+        self.reserved = 0
+        self.spilled = 0
+
+    @property
+    def usage(self) -> int:
+        """
+        the bytes held by tracked intermediates in memory plus reservations of running steps
+        """
+        return sum(self.tracked.values()) + self.reserved
+
+    def track(self, key: str, array):
+        """
+        start tracking an intermediate
+        """
+        self.tracked[key] = int(array.nbytes) if in_memory(array) else 0
+
+    def touch(self, key: str):
+        """
+        mark an intermediate as used, so it is spilled last
+        """
+        if key in self.tracked:
+            self.tracked.move_to_end(key)
+
+    def release(self, key: str, array=None):
+        """
+        stop tracking an intermediate the run dropped, unless it is retained:
+        then it is kept (given the array) to be spilled if needed
+        """
+        if key in self.retained and array is not None:
+            self.kept[key] = array
+            return
+        self.tracked.pop(key, None)
+
+    def reserve(self, nbytes: int, results: Dict[str, np.ndarray], busy: Sequence[str] = ()) -> bool:
+        """
+        reserve memory for a step, spilling intermediates (least recently used first) if needed
+        Parameters:
+        -------------
+        nbytes: int
+            the estimated peak of the step, see estimate_peak
+        results: dict
+            the results by key; spilled intermediates are replaced by their memmap
+            (as are the retained intermediates the run dropped, in kept)
+        busy: Sequence[str]
+            keys which must not be spilled, e.g., inputs of running steps
+        Returns:
+        -------------
+        bool
+            whether the step fits into the budget. It is reserved anyway, so
+            a caller that cannot wait may run it.
+        """
+        for key in list(self.tracked):
+            if self.usage + nbytes <= self.budget:
+                break
+            if key in busy or self.tracked[key] == 0:
+                continue
+            if key in results:
+                results[key] = self.spill(key, results[key])
+            elif key in self.kept:
+                self.kept[key] = self.spill(key, self.kept[key])
+        self.reserved += nbytes
+        return self.usage <= self.budget
+
+    def free(self, nbytes: int):
+        """
+        return the reservation of a finished step
+        """
+        self.reserved = max(0, self.reserved - nbytes)
+
+    def spill(self, key: str, array: np.ndarray) -> np.memmap:
+        """
+        move an intermediate to a memory-mapped temporary file
+        """
+        spilled = spill_to_disk(array, f"{key}_", self.spill_dir)
+        self.tracked[key] = 0
+        self.spilled += 1
+        if self.on_spill is not None:
+            self.on_spill(key, spilled)
+        return spilled
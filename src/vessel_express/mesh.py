@@ -0,0 +1,185 @@
+"""
+Surface meshes of masks, for interactive 3D display (as a napari Surface
+layer) and for sharing results in a much smaller format than the voxels.
+
+Marching cubes runs block by block in parallel threads. Neighboring blocks
+overlap by one voxel plane, so every cube of voxels belongs to exactly one
+block and the vertices on the seams are found by both blocks at the same
+positions; merging equal vertices stitches the blocks into one mesh. The
+mask is treated as surrounded by background, so the surface is closed.
+
+Meshes are decimated to a triangle budget by vertex clustering: vertices in
+the same cell of a grid are merged into their mean, and triangles collapsing
+to an edge or point are dropped.
+"""
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+from .blocks import block_shape_for, default_workers, iter_blocks, run_blocks
+from .utils import normalize_spacing
+
+
+def _block_mesh(mask: np.ndarray, block: Tuple[slice, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    the marching cubes mesh of one block, extended by one voxel plane on the
+    high side (and by background beyond the borders of the mask)
+    """
+    from skimage.measure import marching_cubes
+
+    stop = [min(s.stop + 1, n) for s, n in zip(block, mask.shape)]
+    data = np.asarray(mask[tuple(slice(s.start, e) for s, e in zip(block, stop))] > 0, dtype=np.float32)
+    # only the blocks at the borders close the surface, not a block which merely reaches the border by its extra plane
+    pad = [(1 if s.start == 0 else 0, 1 if s.stop == n else 0) for s, n in zip(block, mask.shape)]
+    data = np.pad(data, pad)
+    if data.min() == data.max():
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64)
+    vertices, faces = marching_cubes(data, level=0.5, allow_degenerate=False)[:2]
+    offset = np.asarray([s.start - p[0] for s, p in zip(block, pad)], dtype=np.float32)
+    return vertices + offset, faces.astype(np.int64)
+
+
+def merge_vertices(vertices: np.ndarray, faces: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    merge vertices at equal positions, and drop the triangles collapsing by that
+    Parameters:
+    ------
+    vertices: np.ndarray
+        the vertex positions, of shape (n, 3)
+    faces: np.ndarray
+        the vertex indices of the triangles, of shape (m, 3)
+    Returns:
+    ---------
+    tuple
+        the merged vertices and the faces indexing them
+    """
+    vertices, inverse = np.unique(vertices, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    return vertices, faces[keep]
+
+
+def mask_mesh(
+    mask: np.ndarray,
+    spacing: Optional[Sequence[float]] = None,
+    block_shape: Optional[Sequence[int]] = None,
+    n_workers: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    the surface mesh of a 3D mask
+    Parameters:
+    ------
+    mask: np.ndarray
+        the mask (any array supporting slicing, e.g., a memmap)
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    block_shape: Sequence[int]
+        the shape of the blocks, about 16 MB of float32 per block by default
+    n_workers: int
+        the number of threads, all cores by default
+    Returns:
+    ---------
+    tuple
+        the vertices (ZYX, in voxels along the finest axis) and the triangles
+    """
+    spacing = normalize_spacing(spacing)
+    block_shape = block_shape or block_shape_for(mask.shape, itemsize=4, max_bytes=16 * 1024 ** 2)
+    blocks = list(iter_blocks(mask.shape, block_shape))
+    meshes = run_blocks(lambda block: _block_mesh(mask, block), blocks, n_workers or default_workers())
+    offsets = np.cumsum([0] + [len(vertices) for vertices, faces in meshes])
+    vertices = np.concatenate([vertices for vertices, faces in meshes])
+    faces = np.concatenate([mesh[1] + offset for mesh, offset in zip(meshes, offsets)])
+    vertices, faces = merge_vertices(vertices, faces)
+    if spacing is not None:
+        vertices = vertices * np.asarray(spacing, dtype=np.float32)
+    return vertices.astype(np.float32), faces
+
+
+def _cluster(vertices: np.ndarray, faces: np.ndarray, cell: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    merge the vertices within each cell of a grid into their mean
+    """
+    keys = np.floor(vertices / cell).astype(np.int64)
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(keys))
+    merged = np.stack([np.bincount(inverse, weights=vertices[:, axis], minlength=len(keys)) for axis in range(3)], axis=1)
+    faces = inverse[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    # triangles with the same vertices (in any order and orientation) are kept once
+    faces = faces[keep]
+    faces = faces[np.unique(np.sort(faces, axis=1), axis=0, return_index=True)[1]]
+    used = np.unique(faces)
+    index = np.full(len(keys), -1)
+    index[used] = np.arange(len(used))
+    return (merged[used] / counts[used, None]).astype(np.float32), index[faces]
+
+
+def decimate(vertices: np.ndarray, faces: np.ndarray, max_faces: int, iterations: int = 12) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    reduce a mesh to at most the given number of triangles by vertex clustering
+    Parameters:
+    ------
+    vertices: np.ndarray
+        the vertex positions, of shape (n, 3)
+    faces: np.ndarray
+        the vertex indices of the triangles, of shape (m, 3)
+    max_faces: int
+        the triangle budget
+    iterations: int
+        the number of steps of the search for the finest grid within the budget
+    Returns:
+    ---------
+    tuple
+        the vertices and triangles of the decimated mesh
+    """
+    if len(faces) <= max_faces:
+        return vertices, faces
+    # the number of triangles shrinks about with the squared cell size: start
+    # with that estimate, grow the cell until the mesh fits, then bisect
+    cell = np.sqrt(len(faces) / max_faces)
+    low, high, best = 0.0, None, None
+    for _ in range(iterations):
+        candidate = _cluster(vertices, faces, cell)
+        if len(candidate[1]) <= max_faces:
+            best, high = candidate, cell
+        else:
+            low = cell
+        cell = cell * 1.5 if high is None else (low + high) / 2
+    if best is None:
+        best = _cluster(vertices, faces, float(np.ptp(vertices, axis=0).max()) + 1)
+    return best
+
+
+def save_mesh(path: str, vertices: np.ndarray, faces: np.ndarray):
+    """
+    write a mesh as binary PLY, or as Wavefront OBJ if the path ends with .obj;
+    the coordinates are written in XYZ order
+    Parameters:
+    ------
+    path: str
+        the file path
+    vertices: np.ndarray
+        the vertex positions in ZYX order, of shape (n, 3)
+    faces: np.ndarray
+        the vertex indices of the triangles, of shape (m, 3)
+    """
+    # reversing the axes mirrors the mesh: reverse the triangles to keep their orientation
+    xyz = np.ascontiguousarray(vertices[:, ::-1], dtype=np.float32)
+    faces = np.asarray(faces)[:, ::-1]
+    if str(path).endswith(".obj"):
+        with open(path, "w") as f:
+            np.savetxt(f, xyz, fmt="v %.6g %.6g %.6g")
+            np.savetxt(f, faces + 1, fmt="f %d %d %d")
+        return
+    header = (
+        "ply\nformat binary_little_endian 1.0\n"
+        f"element vertex {len(xyz)}\nproperty float x\nproperty float y\nproperty float z\n"
+        f"element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n"
+    )
+    records = np.empty(len(faces), dtype=[("n", "u1"), ("v", "<i4", 3)])
+    records["n"] = 3
+    records["v"] = faces
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(xyz.astype("<f4").tobytes())
+        f.write(records.tobytes())
@@ -0,0 +1,390 @@
+"""
+Processing steps as plain functions, plus the provenance records that link
+step outputs to their inputs, so that a workflow tuned in the widget can be
+exported as a minimal pipeline and replayed headlessly on new images.
+
+A pipeline is a dict:
+
+    {
+        "version": 1,
+        "inputs": ["<id of the raw image>"],
+        "output": "<id of the final result>",
+        "nodes": [
+            {"id": "...", "step": "smoothing", "params": {...}, "inputs": ["..."]},
+            ...
+        ]
+    }
+
+where the nodes are sorted such that every node comes after its inputs.
+"""
+import json
+import uuid
+import numpy as np
+from typing import Dict, Optional, Sequence, Union
+
+from .utils import (
+    vesselness_filter,
+    anisotropic_cube,
+    topology_preserving_thinning,
+    edge_preserving_smoothing,
+    precision_dtypes,
+)
+from .resample import resample
+from .graph import prune, skeleton_coordinates, skeleton_graph
+
+
+PIPELINE_VERSION = 1
+
+
+def _spacing(spacing):
+    return None if spacing is None else tuple(spacing)
+
+
+# Steps
+def smoothing(image, spacing=None, n_iter=10, time_step=0.0625, tolerance=None, blockwise=False, precision="float32"):
+    return edge_preserving_smoothing(image, n_iter, time_step, spacing=_spacing(spacing),
+                                     tolerance=tolerance, blockwise=blockwise, precision=precision)
+
+
+def isotropic(image, zoom, anti_aliasing=False, precision="float32"):
+    # integer images keep their data type
+    dtype = precision_dtypes(precision, image)[1] if np.issubdtype(image.dtype, np.floating) else None
+    return resample(image, zoom, order=1, anti_aliasing=anti_aliasing, dtype=dtype)
+
+
+def threshold(image, scale):
+    thresh = image.mean() + scale * image.std()
+    return 1 * (image > thresh)     # convert from bool to int
+
+
+def vesselness(image, sigma, gamma, dim=3, cutoff_method="threshold_li", spacing=None):
+    return 1 * vesselness_filter(image, dim, sigma, gamma, cutoff_method, _spacing(spacing))
+
+
+def merge(*images):
+    seg = images[0] > 0
+    for image in images[1:]:
+        seg = np.logical_or(seg, image > 0)
+    return seg
+
+
+def closing(image, kernel, spacing=None):
+    from skimage.morphology import binary_closing
+    return binary_closing(image, anisotropic_cube(kernel, _spacing(spacing)))
+
+
+def hole_removal(image, max_size):
+    from aicssegmentation.core.utils import hole_filling
+    return hole_filling(image, hole_min=1, hole_max=max_size, fill_2d=True)
+
+
+def thinning(image, min_thickness, thin, spacing=None):
+    return topology_preserving_thinning(image > 0, min_thickness, thin, _spacing(spacing))
+
+
+def cleaning(image, min_size):
+    from skimage.morphology import remove_small_objects
+    return remove_small_objects(image > 0, min_size)
+
+
+def _skeletonize(image):
+    from skimage.morphology import skeletonize_3d
+    return skeletonize_3d(image > 0)
+
+
+def skeleton_network(image, min_branch_length=0, spacing=None):
+    """
+    the skeleton of a mask and its graph (see graph.skeleton_graph), without
+    the side branches shorter than min_branch_length (see graph.prune)
+    """
+    skeleton = _skeletonize(image)
+    graph = skeleton_graph(skeleton_coordinates(skeleton), skeleton.shape, _spacing(spacing))
+    if min_branch_length:
+        graph = prune(graph, min_branch_length)
+        skeleton = skeleton * graph.to_mask()
+    return skeleton, graph
+
+
+def skeleton(image, min_branch_length=0, spacing=None):
+    if not min_branch_length:
+        return _skeletonize(image)
+    return skeleton_network(image, min_branch_length, spacing)[0]
+
+
+STEPS = {
+    "smoothing": smoothing,
+    "isotropic": isotropic,
+    "threshold": threshold,
+    "vesselness": vesselness,
+    "merge": merge,
+    "closing": closing,
+    "hole_removal": hole_removal,
+    "thinning": thinning,
+    "cleaning": cleaning,
+    "skeleton": skeleton,
+}
+
+
+# Presets: the threshold scale, the (sigma, gamma, cutoff method) of each vesselness
+# branch, and the post-processing parameters (None to skip the step)
+PRESETS = {
+    "Bladder": {"threshold": 3, "vesselness": [(1, 5, "threshold_triangle"), (3, 5, "threshold_otsu")],
+                "closing": 5, "thinning": (1, 1), "cleaning": 100},
+    "Bone": {"threshold": 3, "vesselness": [(1, 110, "threshold_li")],
+             "closing": 3, "thinning": None, "cleaning": 100},
+    "Brain": {"threshold": 3, "vesselness": [(1, 5, "threshold_li"), (2, 5, "threshold_li")],
+              "closing": 5, "thinning": None, "cleaning": 100},
+    "Ear": {"threshold": 2, "vesselness": [(1, 120, "threshold_triangle"), (2, 120, "threshold_li")],
+            "closing": 3, "thinning": (1, 1), "cleaning": 20},
+    "Heart": {"threshold": 3, "vesselness": [(1, 5, "threshold_li"), (2, 5, "threshold_otsu")],
+              "closing": None, "thinning": (1, 1), "cleaning": 100},
+    "Liver": {"threshold": 3, "vesselness": [(2, 10, "threshold_li")],
+              "closing": 5, "thinning": None, "cleaning": 100},
+    "Muscle": {"threshold": 3.5, "vesselness": [(1, 70, "threshold_triangle"), (2, 90, "threshold_li")],
+               "closing": None, "thinning": None, "cleaning": 20},
+    "Spinal Cord": {"threshold": 3, "vesselness": [(1, 5, "threshold_triangle"), (2, 5, "threshold_triangle")],
+                    "closing": 3, "thinning": (1, 1), "cleaning": 100},
+    "Tongue": {"threshold": 4, "vesselness": [(1, 170, "threshold_triangle"), (1, 40, "threshold_li")],
+               "closing": 3, "thinning": (1, 1), "cleaning": 20},
+}
+
+
+def preset_pipeline(name: str, input_id: Optional[str] = None, spacing=None, precision: str = "float32") -> dict:
+    """
+    the pipeline of a preset: smoothing, then the threshold and vesselness
+    branches (independent of each other), merged and post-processed
+    Parameters:
+    ------
+    name: str
+        the name of the preset (a key of PRESETS)
+    input_id: str
+        the provenance id of the input image, a new one by default
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    precision: str
+        the precision of the smoothed image, see utils.precision_dtypes
+    Returns:
+    ---------
+    dict
+        the pipeline, with new node ids
+    """
+    preset = PRESETS[name]
+    spacing = _spacing(spacing)
+    input_id = input_id or new_id()
+    nodes = []
+
+    def add(step, params, inputs):
+        nodes.append({"id": new_id(), "step": step, "params": params, "inputs": inputs})
+        return nodes[-1]["id"]
+
+    smoothed = add("smoothing", {"spacing": spacing, "n_iter": 10, "time_step": 0.0625,
+                                 "tolerance": None, "blockwise": False, "precision": precision}, [input_id])
+    branches = [add("threshold", {"scale": preset["threshold"]}, [smoothed])]
+    for sigma, gamma, cutoff_method in preset["vesselness"]:
+        params = {"sigma": sigma, "gamma": gamma, "dim": 3, "cutoff_method": cutoff_method, "spacing": spacing}
+        branches.append(add("vesselness", params, [smoothed]))
+    last = add("merge", {}, branches)
+    if preset["closing"] is not None:
+        last = add("closing", {"kernel": preset["closing"], "spacing": spacing}, [last])
+    if preset["thinning"] is not None:
+        min_thickness, thin = preset["thinning"]
+        last = add("thinning", {"min_thickness": min_thickness, "thin": thin, "spacing": spacing}, [last])
+    last = add("cleaning", {"min_size": preset["cleaning"]}, [last])
+    return {"version": PIPELINE_VERSION, "inputs": [input_id], "output": last, "nodes": nodes}
+
+
+def combine_pipelines(pipelines: Sequence[dict]) -> dict:
+    """
+    combine pipelines into one plan in which identical step invocations, i.e.,
+    the same step with the same parameters on the same inputs, occur only once
+    Parameters:
+    ------
+    pipelines: Sequence[dict]
+        the pipelines, e.g., preset_pipeline of several presets with the same input id
+    Returns:
+    ---------
+    dict
+        the plan: a pipeline whose "outputs" are the outputs of the given
+        pipelines in the same order (and "output" the first of them)
+    """
+    inputs, nodes, outputs = [], [], []
+    unique = {}
+    for pipeline in pipelines:
+        renamed = {}
+        inputs.extend(i for i in pipeline["inputs"] if i not in inputs)
+        for node in pipeline["nodes"]:
+            node_inputs = [renamed.get(i, i) for i in node["inputs"]]
+            if node["step"] == "merge":
+                # the order of the merged masks does not matter
+                node_inputs = sorted(node_inputs)
+            key = (node["step"], json.dumps(node["params"], sort_keys=True), tuple(node_inputs))
+            if key not in unique:
+                unique[key] = node["id"]
+                nodes.append(dict(node, inputs=node_inputs))
+            renamed[node["id"]] = unique[key]
+        outputs.append(renamed.get(pipeline["output"], pipeline["output"]))
+    return {"version": PIPELINE_VERSION, "inputs": inputs, "output": outputs[0], "outputs": outputs, "nodes": nodes}
+
+
+def run_presets(
+    image: np.ndarray,
+    names: Optional[Sequence[str]] = None,
+    spacing=None,
+    n_workers: Optional[int] = None,
+    executor=None
+) -> Dict[str, np.ndarray]:
+    """
+    run several presets on one image, computing the steps they share only once
+    Parameters:
+    ------
+    image: np.ndarray
+        the input image
+    names: Sequence[str]
+        the presets (keys of PRESETS), all by default
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    n_workers: int
+        the number of threads running independent steps concurrently, all cores by default
+    executor: concurrent.futures.Executor
+        the executor running the steps, e.g., scheduler.process_pool()
+    Returns:
+    ---------
+    dict
+        the final mask of each preset
+    """
+    from .scheduler import run_dag
+
+    names = list(PRESETS) if names is None else list(names)
+    input_id = new_id()
+    plan = combine_pipelines([preset_pipeline(name, input_id, spacing) for name in names])
+    results = run_dag(plan, {input_id: image}, n_workers, executor, keep_intermediates=False)
+    return {name: results[output] for name, output in zip(names, plan["outputs"])}
+
+
+# Provenance
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+
+def layer_id(layer) -> str:
+    """
+    get the provenance id of a layer, assigning a new one to layers not created by a step
+    """
+    if "id" not in layer.metadata:
+        layer.metadata["id"] = new_id()
+    return layer.metadata["id"]
+
+
+def provenance(step: str, params: dict, inputs: Sequence[Optional[str]]) -> dict:
+    """
+    the metadata describing how a step output was created
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of STEPS)
+    params: dict
+        the keyword arguments of the step
+    inputs: Sequence[str]
+        the provenance ids of the input layers (None if unknown)
+    Returns:
+    ---------
+    dict
+        to be used as layer metadata
+    """
+    return {"id": new_id(), "step": step, "params": dict(params), "inputs": list(inputs)}
+
+
+def build_pipeline(layers, final) -> dict:
+    """
+    walk back from a final layer to the minimal pipeline producing it
+    Parameters:
+    ------
+    layers: Iterable
+        all layers, e.g., viewer.layers
+    final:
+        the final layer (or its provenance id)
+    Returns:
+    ---------
+    dict
+        the pipeline, containing only the steps the final layer depends on
+    """
+    by_id = {layer.metadata["id"]: layer for layer in layers if "id" in layer.metadata}
+    output = final if isinstance(final, str) else layer_id(final)
+
+    sources, nodes, visited = [], [], set()
+
+    def visit(node_id):
+        if node_id in visited:
+            return
+        visited.add(node_id)
+        if node_id not in by_id:
+            raise ValueError("an input of this result no longer exists, pipeline cannot be built")
+        metadata = by_id[node_id].metadata
+        if "step" not in metadata:
+            sources.append(node_id)
+            return
+        if None in metadata["inputs"]:
+            raise ValueError(f"the input of step {metadata['step']} is unknown, pipeline cannot be built")
+        for input_id in metadata["inputs"]:
+            visit(input_id)
+        nodes.append({
+            "id": node_id,
+            "step": metadata["step"],
+            "params": metadata["params"],
+            "inputs": metadata["inputs"],
+        })
+
+    visit(output)
+    return {"version": PIPELINE_VERSION, "inputs": sources, "output": output, "nodes": nodes}
+
+
+def save_pipeline(pipeline: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(pipeline, f, indent=2)
+
+
+def load_pipeline(path: str) -> dict:
+    with open(path) as f:
+        pipeline = json.load(f)
+    if pipeline.get("version") != PIPELINE_VERSION:
+        raise ValueError(f"unsupported pipeline version {pipeline.get('version')}")
+    return pipeline
+
+
+def run_pipeline(
+    pipeline: dict,
+    images: Union[np.ndarray, Dict[str, np.ndarray]],
+    keep_intermediates: bool = False,
+    n_workers: int = 1,
+    executor=None
+):
+    """
+    replay a pipeline on new images
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline, see build_pipeline
+    images: np.ndarray or dict
+        the input image, or a dict mapping the pipeline inputs to images
+    keep_intermediates: bool
+        whether to return all step results instead of only the final one.
+        Otherwise, intermediates are released as soon as no later step needs them.
+    n_workers: int
+        the number of threads running independent steps concurrently, see scheduler.run_dag
+    executor: concurrent.futures.Executor
+        the executor running the steps, e.g., scheduler.process_pool()
+    Returns:
+    ---------
+    np.ndarray or dict
+        the final result, or a dict of all results by node id
+    """
+    from .scheduler import run_dag
+
+    if not isinstance(images, dict):
+        if len(pipeline["inputs"]) != 1:
+            raise ValueError(f"the pipeline needs {len(pipeline['inputs'])} input images")
+        images = {pipeline["inputs"][0]: images}
+    results = run_dag(pipeline, images, n_workers, executor, keep_intermediates=keep_intermediates)
+    if keep_intermediates:
+        return results
+    return results[pipeline["output"]]
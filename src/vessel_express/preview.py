@@ -0,0 +1,110 @@
+"""
+Preview a step on the currently displayed slice (or a region of interest of
+it) instead of the whole volume, for quick feedback while tuning parameters.
+
+The step is run on the slice plus the halo it needs around it (see
+lazy.halo_depth), so the vesselness response and closing are the same on the
+slice as on the whole volume. As with blockwise smoothing, the conductance of
+the smoothing is normalized per window, so its preview differs slightly from
+smoothing the whole image. The threshold step uses the statistics of the whole image,
+which are cheap and can be cached. The vesselness cutoff is computed from the
+response around the slice, and steps acting on whole connected components
+(hole removal, thinning, cleaning, skeleton) only see a limited context
+around it, so their previews are approximations.
+"""
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+from .lazy import halo_depth
+from .pipeline import STEPS
+from .utils import histogram_cutoff, vesselness_response
+
+# the context (in voxels) around the region for steps acting on whole components
+COMPONENT_CONTEXT = 16
+
+
+def preview_region(
+    shape: Sequence[int],
+    step: str,
+    params: dict,
+    z: int,
+    roi: Optional[Sequence[Tuple[int, int]]] = None
+) -> Tuple[tuple, tuple]:
+    """
+    the region to be computed for the preview of one slice
+    Parameters:
+    ------
+    shape: Sequence[int]
+        the shape of the (3D) image
+    step: str
+        the name of the step (a key of STEPS)
+    params: dict
+        the parameters of the step
+    z: int
+        the index of the displayed slice
+    roi: Sequence[Tuple[int, int]]
+        the (start, stop) of the region of interest along y and x, the whole slice by default
+    Returns:
+    ---------
+    tuple
+        the slices of the region including its halo, and the slices of the
+        previewed region (the slice z, cropped to the roi) within it
+    """
+    if step in ("hole_removal", "thinning", "cleaning", "skeleton"):
+        depth = (COMPONENT_CONTEXT,) * 3
+    else:
+        depth = halo_depth(step, params, 3)
+    if roi is None:
+        roi = [(0, shape[1]), (0, shape[2])]
+    bounds = [(z, z + 1)] + [(max(0, int(a)), min(n, int(b))) for (a, b), n in zip(roi, shape[1:])]
+    padded = tuple(
+        slice(max(0, a - d), min(n, b + d)) for (a, b), d, n in zip(bounds, depth, shape)
+    )
+    inner = tuple(slice(a - p.start, b - p.start) for (a, b), p in zip(bounds, padded))
+    return padded, inner
+
+
+def preview_step(
+    step: str,
+    image: np.ndarray,
+    params: dict,
+    z: int,
+    roi: Optional[Sequence[Tuple[int, int]]] = None,
+    statistics: Optional[Tuple[float, float]] = None
+) -> Tuple[np.ndarray, tuple]:
+    """
+    run a step for the preview of one slice
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of STEPS)
+    image: np.ndarray
+        the 3D input image
+    params: dict
+        the parameters of the step
+    z: int
+        the index of the displayed slice
+    roi: Sequence[Tuple[int, int]]
+        the (start, stop) of the region of interest along y and x, the whole slice by default
+    statistics: Tuple[float, float]
+        the mean and standard deviation of the whole image for the threshold
+        step, computed if not given
+    Returns:
+    ---------
+    tuple
+        the result of shape (1, height, width), and its offset (z, y, x) in the image
+    """
+    padded, inner = preview_region(image.shape, step, params, z, roi)
+    offset = tuple(p.start + i.start for p, i in zip(padded, inner))
+    if step == "threshold":
+        if statistics is None:
+            statistics = (float(image.mean()), float(image.std()))
+        mean, std = statistics
+        crop = np.asarray(image[tuple(slice(o, o + i.stop - i.start) for o, i in zip(offset, inner))])
+        return 1 * (crop > mean + params["scale"] * std), offset
+    crop = np.asarray(image[padded])
+    if step == "vesselness":
+        response = vesselness_response(crop, params.get("dim", 3), params["sigma"], params["gamma"], params.get("spacing"))
+        cutoff = histogram_cutoff(response, params.get("cutoff_method", "threshold_li"))
+        return 1 * (response[inner] > cutoff), offset
+    return np.asarray(STEPS[step](crop, **params))[inner], offset
@@ -0,0 +1,193 @@
+import json
+import time
+import threading
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+
+def _describe(arrays) -> list:
+    """
+    shape and dtype of every array in a list (other values are skipped)
+    """
+    return [
+        {"shape": list(a.shape), "dtype": str(a.dtype)}
+        for a in arrays if hasattr(a, "shape") and hasattr(a, "dtype")
+    ]
+
+
+class StepRecord:
+    """
+    the measurements of one step: wall time, CPU time, peak memory and data sizes
+    """
+    def __init__(self, step: str, inputs: list, params: Optional[dict] = None):
+        self.step = step
+        self.params = dict(params or {})
+        self.inputs = _describe(inputs)
+        self.outputs = []
+        self.start = time.time()
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = 0
+
+    def input(self, *arrays):
+        """
+        register (additional) input(s) of the step
+        """
+        self.inputs.extend(_describe(arrays))
+
+    def output(self, *arrays):
+        """
+        register the output(s) of the step
+        """
+        self.outputs.extend(_describe(arrays))
+
+    @property
+    def voxels(self) -> int:
+        """
+        the number of voxels of the largest input (or output, if there is no input)
+        """
+        sizes = [int(np.prod(a["shape"])) for a in (self.inputs or self.outputs)]
+        return max(sizes, default=0)
+
+    @property
+    def throughput(self) -> float:
+        """
+        processed voxels per second
+        """
+        return self.voxels / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "step": self.step,
+            "params": self.params,
+            "start": self.start,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_memory": self.peak_memory,
+            "inputs": self.inputs,
+            "outputs": self.outputs,
+            "voxels_per_second": self.throughput,
+        }
+
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+
+
+@contextmanager
+def measure(record: StepRecord):
+    """
+    measure the code in the with-block into a record, without adding it to a profiler
+
+    Several threads may measure at the same time; the peak memory of a record
+    then includes the allocations of the other threads, and the CPU time
+    is the time of the whole process.
+    """
+    global _tracing_users
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_users = 1
+        elif _tracing_users > 0:
+            _tracing_users += 1
+        elif hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        started_tracing = _tracing_users > 0
+        memory_before = tracemalloc.get_traced_memory()[0]
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record.wall_time = time.perf_counter() - wall_start
+        record.cpu_time = time.process_time() - cpu_start
+        with _tracing_lock:
+            record.peak_memory = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+            if started_tracing:
+                _tracing_users -= 1
+                if _tracing_users == 0:
+                    tracemalloc.stop()
+
+
+class StepProfiler:
+    """
+    collect timing and memory records of processing steps
+
+    Memory is measured with tracemalloc, which covers Python and NumPy
+    allocations but not memory allocated internally by ITK.
+
+    Example:
+    -------------
+    profiler = StepProfiler(source="image.tiff")
+    with profiler.profile("threshold", image, params={"scale": 3}) as record:
+        out = image > image.mean() + 3 * image.std()
+        record.output(out)
+    profiler.export_json("trace.json")
+    """
+    def __init__(self, source: Optional[str] = None):
+        self.source = source
+        self.records: List[StepRecord] = []
+        self.callbacks: List[Callable] = []
+
+    @contextmanager
+    def profile(self, step: str, *inputs, params: Optional[dict] = None):
+        """
+        measure the code in the with-block as one step
+        Parameters:
+        -------------
+        step: str
+            the name of the step
+        inputs: np.ndarray
+            the input arrays of the step
+        params: dict
+            the parameters of the step, stored with the record
+        """
+        record = StepRecord(step, inputs, params)
+        try:
+            with measure(record):
+                yield record
+        finally:
+            self.add(record)
+
+    def add(self, record: StepRecord):
+        """
+        add a record measured elsewhere, e.g., in a worker thread or process
+        """
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def clear(self):
+        self.records = []
+
+    def to_dict(self) -> dict:
+        return {
+            "source": self.source,
+            "total_wall_time": sum(r.wall_time for r in self.records),
+            "records": [r.to_dict() for r in self.records],
+        }
+
+    def to_columns(self) -> dict:
+        """
+        all records as one array per column, e.g., for a Parquet table (see export.append_records)
+        """
+        return {
+            "source": np.array([str(self.source or "")] * len(self.records), dtype=object),
+            "step": np.array([r.step for r in self.records], dtype=object),
+            "params": np.array([json.dumps(r.params, default=str) for r in self.records], dtype=object),
+            "start": np.array([r.start for r in self.records], dtype=np.float64),
+            "wall_time": np.array([r.wall_time for r in self.records], dtype=np.float64),
+            "cpu_time": np.array([r.cpu_time for r in self.records], dtype=np.float64),
+            "peak_memory": np.array([r.peak_memory for r in self.records], dtype=np.int64),
+            "voxels": np.array([r.voxels for r in self.records], dtype=np.int64),
+            "voxels_per_second": np.array([r.throughput for r in self.records], dtype=np.float64),
+        }
+
+    def export_json(self, path: str):
+        """
+        write all records as a JSON trace
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
@@ -0,0 +1,92 @@
+"""
+Coarse-to-fine execution: run a step (or a whole pipeline) on a downsampled
+image first, for a quick first impression, and refine at full resolution
+afterwards.
+
+Parameters given in voxels are scaled to the coarse grid, so the coarse
+result approximates the full result: lengths (sigma, kernel size, thickness,
+branch length) are divided by the factor, sizes of objects by the factor to
+the power of their dimension, and the number of smoothing iterations by the
+squared factor (the extent of diffusion grows with the square root of the
+time).
+"""
+import copy
+import numpy as np
+from typing import Sequence, Tuple
+
+from .resample import resample
+
+
+def coarse_params(step: str, params: dict, factor: int) -> dict:
+    """
+    the parameters of a step on an image downsampled by the given factor
+    Parameters:
+    ------
+    step: str
+        the name of the step (a key of pipeline.STEPS)
+    params: dict
+        the parameters of the step at full resolution
+    factor: int
+        the downsampling factor along each axis
+    Returns:
+    ---------
+    dict
+        the scaled parameters
+    """
+    params = dict(params)
+    if step == "smoothing":
+        params["n_iter"] = max(1, int(round(params.get("n_iter", 10) / factor ** 2)))
+    elif step == "vesselness":
+        params["sigma"] = max(0.5, params["sigma"] / factor)
+    elif step == "closing":
+        params["kernel"] = max(1, int(round(params["kernel"] / factor)))
+    elif step == "hole_removal":
+        # holes are filled slice by slice
+        params["max_size"] = max(1, int(round(params["max_size"] / factor ** 2)))
+    elif step == "thinning":
+        params["min_thickness"] = params["min_thickness"] / factor
+        params["thin"] = int(round(params["thin"] / factor))
+    elif step == "cleaning":
+        params["min_size"] = max(1, int(round(params["min_size"] / factor ** 3)))
+    elif step == "skeleton" and params.get("min_branch_length"):
+        params["min_branch_length"] = params["min_branch_length"] / factor
+    return params
+
+
+def coarse_pipeline(pipeline: dict, factor: int) -> dict:
+    """
+    a copy of a pipeline (see pipeline.build_pipeline) with all parameters
+    scaled to images downsampled by the given factor; the node ids are kept,
+    so each coarse result can be replaced by the full result of the same node
+    """
+    pipeline = copy.deepcopy(pipeline)
+    for node in pipeline["nodes"]:
+        node["params"] = coarse_params(node["step"], node["params"], factor)
+    return pipeline
+
+
+def downsample(image: np.ndarray, factor: int) -> np.ndarray:
+    """
+    downsample an image by the given factor along each axis, with anti-aliasing;
+    masks stay masks (see resample.resample)
+    """
+    return resample(image, 1 / factor, order=1, anti_aliasing=True)
+
+
+def coarse_transform(shape: Sequence[int], coarse_shape: Sequence[int]) -> Tuple[tuple, tuple]:
+    """
+    the scale and translation placing a downsampled image on the full image
+    (pixel centers aligned, as in resample.resample)
+    Parameters:
+    ------
+    shape: Sequence[int]
+        the shape of the full image
+    coarse_shape: Sequence[int]
+        the shape of the downsampled image
+    Returns:
+    ---------
+    tuple
+        the scale and the translation along each axis, e.g., for a napari layer
+    """
+    scale = np.asarray(shape, dtype=np.float64) / np.asarray(coarse_shape)
+    return tuple(scale), tuple((scale - 1) / 2)
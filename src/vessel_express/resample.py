@@ -0,0 +1,139 @@
+import numpy as np
+from typing import Optional, Sequence, Union
+
+from .blocks import block_shape_for, create_output, iter_blocks, run_blocks
+
+
+def _source_coordinates(n_in: int, n_out: int, start: int, stop: int) -> np.ndarray:
+    """
+    map output indices [start, stop) to (mirrored) input coordinates, pixel centers aligned
+    """
+    coords = (np.arange(start, stop, dtype=np.float64) + 0.5) * (n_in / n_out) - 0.5
+    coords = np.abs(coords)
+    coords = np.where(coords > n_in - 1, 2 * (n_in - 1) - coords, coords)
+    return np.clip(coords, 0, n_in - 1)
+
+
+def _interpolate_axis(data: np.ndarray, coords: np.ndarray, offset: int, axis: int, order: int) -> np.ndarray:
+    """
+    interpolate a block along one axis at the given input coordinates
+    """
+    coords = coords - offset
+    if order == 0:
+        return np.take(data, np.floor(coords + 0.5).astype(np.intp), axis=axis)
+    lo = np.floor(coords).astype(np.intp)
+    hi = np.minimum(lo + 1, data.shape[axis] - 1)
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    weight = (coords - lo).astype(data.dtype).reshape(shape)
+    low = np.take(data, lo, axis=axis)
+    low *= 1 - weight
+    low += np.take(data, hi, axis=axis) * weight
+    return low
+
+
+def resample(
+    image: np.ndarray,
+    zoom: Union[float, Sequence[float]],
+    order: int = 1,
+    anti_aliasing: bool = False,
+    dtype=None,
+    out=None,
+    block_shape: Optional[Sequence[int]] = None,
+    n_workers: Optional[int] = None
+) -> np.ndarray:
+    """
+    resample an image block by block in parallel threads
+    Parameters:
+    ------
+    image: np.ndarray
+        the image to be resampled (any array supporting slicing, e.g., a memmap)
+    zoom: Union[float, Sequence[float]]
+        the zoom factor along each axis, > 1 for upsampling and < 1 for downsampling
+    order: int
+        0 for nearest neighbor and 1 for (multi-)linear interpolation
+    anti_aliasing: bool
+        whether to apply a Gaussian filter before downsampling (as skimage.transform.rescale)
+    dtype:
+        the output data type. By default the input data type is kept, except
+        for float64, which is stored as float32. Computation is done in float32
+        (in float64 for float64 output).
+    out: np.ndarray or path
+        None to return a new array, a file path to stream the result into a
+        memory-mapped .npy file, or an existing array to write into
+    block_shape: Sequence[int]
+        the shape of the output blocks, about 64 MB of float32 per block by default
+    n_workers: int
+        the number of threads, all cores by default
+    Returns:
+    ---------
+    np.ndarray
+        the resampled image, in the same intensity range as the input
+    """
+    from scipy.ndimage import gaussian_filter
+
+    if order not in (0, 1):
+        raise ValueError("only order 0 (nearest) and 1 (linear) are supported")
+    zoom = np.broadcast_to(np.asarray(zoom, dtype=np.float64), (image.ndim,))
+    in_shape = np.asarray(image.shape)
+    out_shape = tuple(int(n) for n in np.maximum(np.round(in_shape * zoom), 1))
+    if dtype is None:
+        dtype = np.float32 if image.dtype == np.float64 else image.dtype
+    dtype = np.dtype(dtype)
+    compute = np.float64 if dtype == np.float64 else np.float32
+    output = create_output(out_shape, dtype, out)
+    if block_shape is None:
+        block_shape = block_shape_for(out_shape, itemsize=4)
+
+    sigma = np.zeros(image.ndim)
+    if anti_aliasing:
+        sigma = np.maximum(0, (in_shape / np.asarray(out_shape) - 1) / 2)
+    halo = np.ceil(4 * sigma).astype(int)
+
+    def process(block):
+        coords = [
+            _source_coordinates(n_in, n_out, s.start, s.stop)
+            for n_in, n_out, s in zip(in_shape, out_shape, block)
+        ]
+        starts = [max(0, int(np.floor(c.min())) - h) for c, h in zip(coords, halo)]
+        stops = [min(n, int(np.ceil(c.max())) + 1 + h) for c, h, n in zip(coords, halo, in_shape)]
+        data = np.asarray(image[tuple(slice(a, b) for a, b in zip(starts, stops))], dtype=compute)
+        if np.any(sigma > 0):
+            data = gaussian_filter(data, sigma, mode="mirror")
+        for axis, (c, start) in enumerate(zip(coords, starts)):
+            data = _interpolate_axis(data, c, start, axis, order)
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            data = np.clip(np.rint(data), info.min, info.max)
+        elif dtype == np.bool_:
+            data = data >= 0.5
+        output[block] = data
+
+    run_blocks(process, iter_blocks(out_shape, block_shape), n_workers)
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
+
+
+def isotropic_zoom(spacing: Sequence[float], target: str = "finest") -> tuple:
+    """
+    the zoom factors making voxels of the given size isotropic
+    Parameters:
+    ------
+    spacing: Sequence[float]
+        the voxel size in ZYX order
+    target: str
+        "finest" to upsample all axes to the finest voxel size, or "coarsest"
+        to downsample all axes to the coarsest voxel size
+    Returns:
+    ---------
+    tuple
+        the zoom factor along each axis
+    """
+    if target == "finest":
+        reference = min(spacing)
+    elif target == "coarsest":
+        reference = max(spacing)
+    else:
+        raise ValueError(f"unknown target {target}, use 'finest' or 'coarsest'")
+    return tuple(s / reference for s in spacing)
@@ -0,0 +1,545 @@
+"""
+Helpers of the Evaluation widget: loading the raw image and segmentation of
+a review item, and prefetching the next items in background threads so
+stepping through a directory does not wait for the disk.
+
+Cheap quality control (QC) metrics of every pair are computed in the
+background as well, so the review queue can be ordered to show the most
+suspicious segmentations first, and maximum intensity projections of every
+pair are cached as thumbnails for triaging a directory without loading the
+full images. Both are computed from one read of each pair (see compute_review).
+
+Values derived from the images (such as contrast limits) are stored in a
+sidecar index in the reviewed directory, so revisiting the directory does
+not compute them again. An entry is valid as long as the size and the
+modification time of its file are unchanged.
+"""
+import json
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+from tifffile import TiffFile, imread
+
+from .utils import histogram
+
+INDEX_NAME = ".vessel_express_index.json"
+THUMBNAIL_DIR = ".vessel_express_thumbnails"
+
+# the QC metrics: their labels, and whether high (or low) values are suspicious
+QC_METRICS = {
+    "foreground": ("foreground %", True),
+    "components": ("components", True),
+    "largest_share": ("largest component %", False),
+    "mean_inside": ("mean inside", False),
+    "mean_outside": ("mean outside", True),
+}
+
+
+def contrast_limits(
+    image: np.ndarray,
+    percentiles: Sequence[float] = (0.5, 99.5),
+    max_samples: int = 2 ** 22
+) -> list:
+    """
+    estimate percentiles of an image from the histogram (see utils.histogram)
+    of a strided subsample instead of sorting the whole image
+    Parameters:
+    ------
+    image: np.ndarray
+        the image
+    percentiles: Sequence[float]
+        the percentiles, in [0, 100]
+    max_samples: int
+        the maximal number of voxels used; images with up to this many voxels
+        give the percentiles up to one bin width (exact values for integer
+        images with up to 65536 values, no interpolation between them)
+    Returns:
+    ---------
+    list
+        the values at the percentiles
+    """
+    samples = np.ravel(image)
+    if samples.size > max_samples:
+        samples = samples[::-(-samples.size // max_samples)]
+    counts, centers = histogram(samples)
+    cumulative = np.cumsum(counts)
+    ranks = [p / 100 * (cumulative[-1] - 1) for p in percentiles]
+    return [float(centers[np.searchsorted(cumulative, rank, side="right")]) for rank in ranks]
+
+
+def file_stamp(path: str) -> list:
+    """
+    the size and modification time of a file, identifying its version
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ReviewIndex:
+    """
+    a sidecar index of values derived from the files of a directory, stored as
+    JSON in the directory; entries are keyed by file name and only valid for
+    the size and modification time the file had when they were computed
+
+    Example:
+    -------------
+    index = ReviewIndex(directory)
+    limits = index.get(path, "contrast_limits")
+    if limits is None:
+        index.set(path, "contrast_limits", contrast_limits(imread(path)))
+
+    Values set with save=False (e.g., by many background jobs) are written
+    together by the next save().
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, INDEX_NAME)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.changed = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, path: str, field: str):
+        """
+        the value of a field for a file, None if it is not known for the current version of the file
+        """
+        with self.lock:
+            entry = self.entries.get(os.path.basename(path))
+        if entry is None or entry["stamp"] != file_stamp(path):
+            return None
+        return entry.get(field)
+
+    def set(self, path: str, field: str, value, save: bool = True):
+        """
+        store the value of a field for a file, and save the index
+        """
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.entries.get(os.path.basename(path))
+            if entry is None or entry["stamp"] != stamp:
+                entry = self.entries[os.path.basename(path)] = {"stamp": stamp}
+            entry[field] = value
+            self.changed = True
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        write the index (atomically) if it changed since it was last saved;
+        read-only directories are left alone
+        """
+        # one save at a time, so an older version never replaces a newer one
+        with self.save_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                text = json.dumps(self.entries)
+                self.changed = False
+            try:
+                tmp = f"{self.path}.{threading.get_ident()}.tmp"
+                with open(tmp, "w") as f:
+                    f.write(text)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+
+def _cached(index: Optional[ReviewIndex], path: str, field: str, compute: Callable):
+    value = None if index is None else index.get(path, field)
+    if value is None:
+        value = compute()
+        if index is not None:
+            index.set(path, field, value)
+    return value
+
+
+def raw_path(bw_fn: str) -> str:
+    """
+    the raw image of a segmentation named Binary_<name>.tiff: <name>.tiff, or <name>.tif if that does not exist
+    """
+    raw_fn = os.path.join(os.path.dirname(bw_fn), os.path.basename(bw_fn)[7:])
+    if not os.path.exists(raw_fn):
+        raw_fn = raw_fn[:-1]  # .tiff --> .tif
+    return raw_fn
+
+
+def load_pair(bw_fn: str, index: Optional[ReviewIndex] = None) -> dict:
+    """
+    read a segmentation and its raw image
+    Parameters:
+    ------
+    bw_fn: str
+        the path of the segmentation, Binary_<name>.tiff
+    index: ReviewIndex
+        the index the contrast limits are looked up in (and stored in), None to always compute them
+    Returns:
+    ---------
+    dict
+        the paths ("raw_fn", "bw_fn"), the images ("original", "segmentation"),
+        and the contrast limits of both images ("original_limits", "segmentation_limits")
+    """
+    raw_fn = raw_path(bw_fn)
+    original = imread(raw_fn)
+    segmentation = imread(bw_fn)
+    return {
+        "raw_fn": raw_fn,
+        "bw_fn": bw_fn,
+        "original": original,
+        "segmentation": segmentation,
+        "original_limits": _cached(index, raw_fn, "contrast_limits", lambda: contrast_limits(original)),
+        "segmentation_limits": _cached(index, bw_fn, "contrast_limits", lambda: [0, max(1, int(segmentation.max()))]),
+    }
+
+
+class Prefetcher:
+    """
+    load items ahead of their use in background threads, keeping only the
+    items that are about to be used
+
+    Example:
+    -------------
+    prefetcher = Prefetcher(load_pair, depth=3)
+    prefetcher.prefetch(filenames[:3])
+    pair = prefetcher.get(filenames[0])
+    """
+    def __init__(self, load: Callable, depth: int = 3, n_workers: int = 1):
+        """
+        Parameters:
+        -------------
+        load: Callable
+            called as load(key) in a background thread
+        depth: int
+            the maximal number of items loaded (or being loaded) ahead
+        n_workers: int
+            the number of loading threads
+        """
+        self.load = load
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, keys: Iterable[Hashable]):
+        """
+        start loading the next items, in the given order; items that are no
+        longer among the next ones are dropped (or not loaded at all)
+        """
+        keys = list(keys)[:self.depth]
+        with self.lock:
+            for key in list(self.futures):
+                if key not in keys:
+                    self.futures.pop(key).cancel()
+            for key in keys:
+                if key not in self.futures:
+                    self.futures[key] = self.executor.submit(self.load, key)
+
+    def get(self, key: Hashable, upcoming: Optional[Iterable[Hashable]] = None):
+        """
+        the loaded item, waiting for it if it is still loading (or loading it now)
+        Parameters:
+        -------------
+        key: Hashable
+            the item
+        upcoming: Iterable
+            the items to be used after this one, prefetched while it is used
+        """
+        with self.lock:
+            future = self.futures.pop(key, None)
+        if upcoming is not None:
+            self.prefetch(upcoming)
+        if future is not None and not future.cancelled():
+            return future.result()
+        return self.load(key)
+
+    def shutdown(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+        self.executor.shutdown(wait=False)
+
+
+def qc_metrics(original: np.ndarray, segmentation: np.ndarray) -> dict:
+    """
+    cheap quality control metrics of a segmentation
+    Parameters:
+    ------
+    original: np.ndarray
+        the raw image
+    segmentation: np.ndarray
+        the segmentation of the raw image
+    Returns:
+    ---------
+    dict
+        the foreground percentage, the number of connected components (26-connected
+        in 3D), the percentage of the foreground in the largest component, and the
+        mean raw intensity inside and outside the mask (see QC_METRICS)
+    """
+    from scipy.ndimage import label
+
+    mask = segmentation > 0
+    labels, components = label(mask, structure=np.ones((3,) * mask.ndim))
+    voxels = int(np.count_nonzero(mask))
+    largest = int(np.bincount(labels.ravel())[1:].max()) if components else 0
+    return {
+        "foreground": 100 * voxels / mask.size,
+        "components": int(components),
+        "largest_share": 100 * largest / voxels if voxels else 0.0,
+        "mean_inside": float(original[mask].mean()) if voxels else float("nan"),
+        "mean_outside": float(original[~mask].mean()) if voxels < mask.size else float("nan"),
+    }
+
+
+def compute_qc(bw_fn: str, index: Optional[ReviewIndex] = None, save: bool = True) -> dict:
+    """
+    the QC metrics of a segmentation and its raw image (see qc_metrics),
+    looked up in (and stored in) the index; computing them also stores the
+    contrast limits of the raw image. With save=False, the caller saves the index.
+    """
+    raw_fn = raw_path(bw_fn)
+    metrics = _cached_qc(index, bw_fn, raw_fn)
+    if metrics is None:
+        original = imread(raw_fn)
+        metrics = qc_metrics(original, imread(bw_fn))
+        _store_qc(index, bw_fn, raw_fn, metrics, original, save)
+    return metrics
+
+
+def _cached_qc(index: Optional[ReviewIndex], bw_fn: str, raw_fn: str) -> Optional[dict]:
+    if index is None:
+        return None
+    qc = index.get(bw_fn, "qc")
+    # the metrics depend on the raw image as well
+    if qc is not None and qc["raw_stamp"] == file_stamp(raw_fn):
+        return {key: qc[key] for key in QC_METRICS}
+    return None
+
+
+def _store_qc(index: Optional[ReviewIndex], bw_fn: str, raw_fn: str, metrics: dict, original: np.ndarray, save: bool):
+    if index is None:
+        return
+    if index.get(raw_fn, "contrast_limits") is None:
+        index.set(raw_fn, "contrast_limits", contrast_limits(original), save=False)
+    index.set(bw_fn, "qc", dict(metrics, raw_stamp=file_stamp(raw_fn)), save=save)
+
+
+def qc_columns(records: Dict[str, dict]) -> dict:
+    """
+    arrange QC metrics column by column
+    Parameters:
+    ------
+    records: Dict[str, dict]
+        the QC metrics (see qc_metrics) of each file, None for files without metrics yet
+    Returns:
+    ---------
+    dict
+        the file names ("path") and one array per metric, NaN for files without metrics
+    """
+    paths = list(records)
+    columns = {"path": np.array(paths, dtype=object)}
+    for key in QC_METRICS:
+        columns[key] = np.array(
+            [np.nan if records[path] is None else records[path][key] for path in paths], dtype=np.float64
+        )
+    return columns
+
+
+def review_order(columns: dict, key: Optional[str] = None) -> List[str]:
+    """
+    the order in which to review files
+    Parameters:
+    ------
+    columns: dict
+        the QC metrics of the files, see qc_columns
+    key: str
+        the metric to order by, most suspicious values first (see QC_METRICS),
+        files without metrics last; None to order by file name
+    Returns:
+    ---------
+    list
+        the file names in review order
+    """
+    paths = columns["path"]
+    if key is None:
+        return sorted(paths)
+    values = columns[key]
+    if QC_METRICS[key][1]:
+        values = -values
+    # NaN is sorted last; a stable sort keeps the name order of ties
+    names = np.argsort(paths, kind="stable")
+    return list(paths[names][np.argsort(values[names], kind="stable")])
+
+
+def projections(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    the maximum intensity projections of a (3D) TIFF along z and along y,
+    reading it plane by plane instead of loading it as a whole
+    Parameters:
+    ------
+    path: str
+        the path of the TIFF
+    Returns:
+    ---------
+    tuple
+        the XY projection, and the XZ projection (one row per plane)
+    """
+    xy = None
+    rows = []
+    with TiffFile(path) as tif:
+        for page in tif.pages:
+            for plane in np.reshape(page.asarray(), (-1,) + tuple(page.shape[-2:])):
+                xy = plane.copy() if xy is None else np.maximum(xy, plane, out=xy)
+                rows.append(plane.max(axis=0))
+    return xy, np.stack(rows)
+
+
+def array_projections(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    the maximum intensity projections of an image already in memory, as projections(path)
+    """
+    planes = np.reshape(image, (-1,) + image.shape[-2:])
+    return planes.max(axis=0), planes.max(axis=1)
+
+
+def overlay(image: np.ndarray, mask: np.ndarray, limits: Sequence[float]) -> np.ndarray:
+    """
+    an RGB image of a grayscale image with a mask overlaid in magenta (as the segmentation layer)
+    Parameters:
+    ------
+    image: np.ndarray
+        the 2D grayscale image
+    mask: np.ndarray
+        the 2D mask
+    limits: Sequence[float]
+        the contrast limits of the image
+    Returns:
+    ---------
+    np.ndarray
+        the RGB image as uint8, of shape (height, width, 3)
+    """
+    low, high = limits
+    gray = np.clip((image.astype(np.float32) - low) / max(high - low, 1e-12), 0, 1)
+    rgb = np.repeat(gray[..., None], 3, axis=-1)
+    rgb[mask > 0] = 0.5 * rgb[mask > 0] + 0.5 * np.array([1, 0, 1], dtype=np.float32)
+    return (255 * rgb).astype(np.uint8)
+
+
+def thumbnail(raw_fn: str, bw_fn: str, size: int = 128) -> np.ndarray:
+    """
+    a thumbnail of an image pair: the XY projection above the XZ projection
+    of the raw image (see projections), with the segmentation overlaid
+    Parameters:
+    ------
+    raw_fn: str
+        the path of the raw image
+    bw_fn: str
+        the path of the segmentation
+    size: int
+        the maximal height and width of the thumbnail
+    Returns:
+    ---------
+    np.ndarray
+        the RGB thumbnail as uint8
+    """
+    return projection_thumbnail(projections(raw_fn), projections(bw_fn), size)
+
+
+def projection_thumbnail(raw: Sequence[np.ndarray], mask: Sequence[np.ndarray], size: int = 128) -> np.ndarray:
+    """
+    the thumbnail of the projections (see projections) of a raw image and of its segmentation, see thumbnail
+    """
+    from skimage.measure import block_reduce
+
+    factor = -(-max(raw[0].shape[0] + raw[1].shape[0], raw[0].shape[1]) // size)
+    raw = [block_reduce(p, (factor, factor), np.max) for p in raw]
+    mask = [block_reduce(p, (factor, factor), np.max) for p in mask]
+    limits = contrast_limits(np.concatenate([p.ravel() for p in raw]))
+    return np.concatenate([overlay(p, m, limits) for p, m in zip(raw, mask)])
+
+
+def compute_thumbnail(bw_fn: str, index: Optional[ReviewIndex] = None, size: int = 128, save: bool = True) -> np.ndarray:
+    """
+    the thumbnail of a segmentation and its raw image (see thumbnail), cached
+    in the directory of the images (see THUMBNAIL_DIR) if an index is given.
+    With save=False, the caller saves the index.
+    """
+    raw_fn = raw_path(bw_fn)
+    image = _cached_thumbnail(index, bw_fn, raw_fn, size)
+    if image is None:
+        image = thumbnail(raw_fn, bw_fn, size)
+        _store_thumbnail(index, bw_fn, raw_fn, size, image, save)
+    return image
+
+
+def _thumbnail_cache(bw_fn: str) -> str:
+    return os.path.join(os.path.dirname(bw_fn), THUMBNAIL_DIR, os.path.basename(bw_fn) + ".npy")
+
+
+def _cached_thumbnail(index: Optional[ReviewIndex], bw_fn: str, raw_fn: str, size: int) -> Optional[np.ndarray]:
+    if index is None:
+        return None
+    cache = _thumbnail_cache(bw_fn)
+    if index.get(bw_fn, "thumbnail") == {"raw_stamp": file_stamp(raw_fn), "size": size} and os.path.exists(cache):
+        try:
+            return np.load(cache)
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _store_thumbnail(index: Optional[ReviewIndex], bw_fn: str, raw_fn: str, size: int, image: np.ndarray, save: bool):
+    if index is None:
+        return
+    cache = _thumbnail_cache(bw_fn)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = f"{cache}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp, cache)
+        index.set(bw_fn, "thumbnail", {"raw_stamp": file_stamp(raw_fn), "size": size}, save=save)
+    except OSError:
+        pass
+
+
+def compute_review(bw_fn: str, index: Optional[ReviewIndex] = None, size: int = 128, save: bool = True) -> tuple:
+    """
+    the QC metrics (see compute_qc) and the thumbnail (see compute_thumbnail)
+    of a segmentation and its raw image, reading each image once for both
+    Parameters:
+    ------
+    bw_fn: str
+        the path of the segmentation, Binary_<name>.tiff
+    index: ReviewIndex
+        the index both are looked up in (and stored in), None to always compute them
+    size: int
+        the maximal height and width of the thumbnail
+    save: bool
+        whether to save the index, otherwise the caller saves it
+    Returns:
+    ---------
+    tuple
+        the QC metrics and the RGB thumbnail
+    """
+    raw_fn = raw_path(bw_fn)
+    metrics = _cached_qc(index, bw_fn, raw_fn)
+    image = _cached_thumbnail(index, bw_fn, raw_fn, size)
+    if metrics is not None and image is not None:
+        return metrics, image
+    original = imread(raw_fn)
+    segmentation = imread(bw_fn)
+    if metrics is None:
+        metrics = qc_metrics(original, segmentation)
+        _store_qc(index, bw_fn, raw_fn, metrics, original, save=False)
+    if image is None:
+        image = projection_thumbnail(array_projections(original), array_projections(segmentation), size)
+        _store_thumbnail(index, bw_fn, raw_fn, size, image, save=False)
+    if save and index is not None:
+        index.save()
+    return metrics, image
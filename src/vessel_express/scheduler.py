@@ -0,0 +1,266 @@
+"""
+Run the nodes of a pipeline (see pipeline.py) as a DAG: every node starts as
+soon as its inputs are available, so independent branches, e.g., the
+threshold and vesselness branches of a preset, run concurrently and join at
+the merge.
+
+Threads are cheap to start and share the arrays directly; NumPy and dask
+release the GIL, but ITK filters may not (depending on how ITK was built).
+Worker processes always run in parallel. Their inputs are passed through
+shared memory: each array is copied into shared memory once and every
+process maps it without copying.
+"""
+import multiprocessing
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Optional
+
+from .blocks import default_workers
+from .profiling import StepRecord, measure
+from .memory import estimate_peak
+
+
+class SharedArray:
+    """
+    a NumPy array in shared memory, pickled as a reference (name, shape, dtype)
+    """
+    def __init__(self, array: np.ndarray):
+        array = np.asarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)[...] = array
+
+    def __getstate__(self):
+        return {"name": self.memory.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape = tuple(state["shape"])
+        self.dtype = np.dtype(state["dtype"])
+        # attach without registering, only the creating process unlinks the memory
+        self.memory = _attach(state["name"])
+
+    @property
+    def array(self) -> np.ndarray:
+        return np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    def release(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching registers the memory again, with the
+        # resource tracker shared with the creating process, so this is a no-op
+        return shared_memory.SharedMemory(name=name)
+
+
+def execute(step: str, params: dict, inputs: list, persist: bool = False):
+    """
+    run one step and measure it, in a worker thread or process. A lazy result
+    is persisted if persist is set, see lazy.reduced_inputs.
+    Returns:
+    ---------
+    tuple
+        the result and its StepRecord
+    """
+    from .pipeline import STEPS
+    record = StepRecord(step, inputs, params)
+    with measure(record):
+        if any(hasattr(data, "dask") for data in inputs):
+            from .lazy import lazy_step
+            out = lazy_step(step, *inputs, **params)
+            if persist:
+                out = out.persist()
+        else:
+            out = STEPS[step](*inputs, **params)
+        record.output(out)
+    return out, record
+
+
+def _execute_shared(step: str, params: dict, inputs: list, persist: bool = False):
+    """
+    run one step in a worker process on inputs in shared memory
+    """
+    arrays = [data.array if isinstance(data, SharedArray) else data for data in inputs]
+    try:
+        return execute(step, params, arrays, persist)
+    finally:
+        del arrays
+        for data in inputs:
+            if isinstance(data, SharedArray):
+                data.memory.close()
+
+
+def process_pool(n_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    a pool of worker processes for run_dag; started with "spawn", which is
+    safe in a GUI process. Keep it to reuse the started processes.
+    """
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=n_workers or default_workers(), mp_context=context)
+
+
+def run_dag(
+    pipeline: dict,
+    results: Dict[str, np.ndarray],
+    n_workers: Optional[int] = None,
+    executor=None,
+    on_result: Optional[Callable] = None,
+    keep_intermediates: bool = True,
+    memory=None
+) -> Dict[str, np.ndarray]:
+    """
+    run the nodes of a pipeline concurrently, each as soon as its inputs are available
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline, see pipeline.build_pipeline, or a plan with several
+        "outputs", see pipeline.combine_pipelines
+    results: dict
+        the input images by id. Nodes whose id is already in here are not run,
+        neither are nodes the output does not depend on.
+    n_workers: int
+        the number of threads when no executor is given, all cores by default.
+        1 runs the nodes one after another.
+    executor: concurrent.futures.Executor
+        the executor to run the nodes in, e.g., a ThreadPoolExecutor or a
+        ProcessPoolExecutor (see process_pool). With processes, the inputs
+        are passed through shared memory.
+    on_result: Callable
+        called as on_result(node, result, record) in the calling thread,
+        for every node in the order of pipeline["nodes"]
+    keep_intermediates: bool
+        whether to keep all results, otherwise intermediates are released
+        as soon as no later node needs them
+    memory: MemoryManager
+        keeps the intermediates within a memory budget (see memory.py): a node
+        only starts when its estimated peak fits next to the running ones,
+        spilling least recently used intermediates to disk if needed
+    Returns:
+    ---------
+    dict
+        the results by node id
+    """
+    results = dict(results)
+    outputs = pipeline.get("outputs", [pipeline["output"]])
+    # only the nodes the outputs depend on, and not yet computed
+    by_id = {node["id"]: node for node in pipeline["nodes"]}
+    needed, stack = set(), list(outputs)
+    while stack:
+        node_id = stack.pop()
+        if node_id in needed or node_id in results or node_id not in by_id:
+            continue
+        needed.add(node_id)
+        stack.extend(by_id[node_id]["inputs"])
+    pending = [node for node in pipeline["nodes"] if node["id"] in needed]
+    # lazy results read by several reductions are computed once, see lazy.reduced_inputs
+    from .lazy import reduced_inputs
+    reduced = reduced_inputs(pending)
+    remaining = {}
+    for node in pending:
+        for input_id in node["inputs"]:
+            remaining[input_id] = remaining.get(input_id, 0) + 1
+
+    processes = isinstance(executor, ProcessPoolExecutor)
+    shared = {}
+    own_executor = executor is None and (n_workers or default_workers()) > 1
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=n_workers or default_workers())
+
+    finished = {}
+    reported = 0
+
+    def report():
+        nonlocal reported
+        while reported < len(pending) and pending[reported]["id"] in finished:
+            node = pending[reported]
+            out, record = finished.pop(node["id"])
+            if on_result is not None:
+                # the spilled version, if it was spilled meanwhile
+                on_result(node, results.get(node["id"], out), record)
+            reported += 1
+
+    def release(node):
+        for input_id in node["inputs"]:
+            remaining[input_id] -= 1
+            if remaining[input_id] == 0:
+                if input_id in shared:
+                    shared.pop(input_id).release()
+                # intermediates which are kept stay tracked by the memory manager
+                if not keep_intermediates and input_id not in outputs:
+                    data = results.pop(input_id)
+                    if memory is not None:
+                        memory.release(input_id, data)
+
+    def reserve(node, busy, force):
+        """
+        reserve the estimated peak of a node, False if it has to wait for memory
+        """
+        if memory is None:
+            return 0
+        inputs = [results[i] for i in node["inputs"]]
+        for input_id in node["inputs"]:
+            memory.touch(input_id)
+        nbytes = estimate_peak(node["step"], inputs, node["params"])
+        if not memory.reserve(nbytes, results, busy=set(busy) | set(node["inputs"])) and not force:
+            memory.free(nbytes)
+            return None
+        return nbytes
+
+    def finish(node, out, record, nbytes):
+        results[node["id"]] = out
+        finished[node["id"]] = (out, record)
+        if memory is not None:
+            memory.free(nbytes)
+            memory.track(node["id"], out)
+        release(node)
+
+    def argument(input_id):
+        data = results[input_id]
+        if not processes or hasattr(data, "dask"):
+            return data
+        if input_id not in shared:
+            shared[input_id] = SharedArray(data)
+        return shared[input_id]
+
+    try:
+        if executor is None:
+            for node in pending:
+                nbytes = reserve(node, (), force=True)
+                out, record = execute(node["step"], node["params"], [results[i] for i in node["inputs"]], node["id"] in reduced)
+                finish(node, out, record, nbytes)
+                report()
+            return results
+
+        waiting = list(pending)
+        running = {}
+        while waiting or running:
+            for node in [n for n in waiting if all(i in results for i in n["inputs"])]:
+                busy = [i for n, _ in running.values() for i in n["inputs"]]
+                # without running nodes, waiting frees no memory: run anyway
+                nbytes = reserve(node, busy, force=not running)
+                if nbytes is None:
+                    continue
+                waiting.remove(node)
+                run = _execute_shared if processes else execute
+                future = executor.submit(run, node["step"], node["params"], [argument(i) for i in node["inputs"]], node["id"] in reduced)
+                running[future] = (node, nbytes)
+            if not running:
+                raise ValueError("the pipeline has inputs that are neither given nor computed by a node")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, nbytes = running.pop(future)
+                out, record = future.result()
+                finish(node, out, record, nbytes)
+            report()
+        return results
+    finally:
+        for data in shared.values():
+            data.release()
+        if own_executor:
+            executor.shutdown()
@@ -0,0 +1,492 @@
+"""
+Segment a stack while it is acquired, e.g., by a lightsheet microscope
+writing one file per z-plane over many minutes, so the segmentation is done
+shortly after the acquisition instead of starting only then.
+
+A PlaneWatcher polls a directory for new plane files; a file is complete
+once its size did not change between two polls. The planes are fed to a
+StreamingPipeline, which runs the local filters (smoothing, vesselness) over
+a sliding z-window: output planes are computed as soon as the planes within
+the halo of the filter (see lazy.halo_depth) have arrived, and input planes
+no filter needs anymore are released. The filter outputs are appended to
+PlaneStores, directories holding the planes in chunks of .npy files.
+
+The pointwise steps (threshold, vesselness cutoff, merge) depend on
+statistics of the whole stack. These are accumulated while the planes
+arrive (mean and variance for the threshold, a histogram of the integer
+vesselness response for the cutoff) and applied in one pass over the stored
+planes once the acquisition ended, so the mask is the same as for the whole
+stack. Steps on connected components (closing, thinning, cleaning, ...)
+need the whole mask and are run afterwards, see split_pipeline.
+
+As with blockwise smoothing, the conductance of the smoothing is normalized
+per window, so its result differs slightly from smoothing the whole stack.
+"""
+import json
+import os
+import re
+import time
+import numpy as np
+from glob import glob
+from typing import Callable, List, Optional, Tuple
+
+from .blocks import save_npy
+from .lazy import halo_depth
+from .pipeline import PIPELINE_VERSION, STEPS
+from .utils import IntegerHistogram, RunningMoments, vesselness_response
+
+# the steps which can be streamed: filters computed plane by plane, and pointwise steps applied at the end
+FILTER_STEPS = ("smoothing", "vesselness")
+STREAM_STEPS = ("smoothing", "threshold", "vesselness", "merge")
+
+
+class PlaneStore:
+    """
+    a 3D image on disk which grows by appending planes: a directory with one
+    .npy file per chunk of planes and a JSON file with the shape and data type.
+    An existing store is opened to read (or extend) it.
+
+    Attributes:
+    -------------
+    directory: str
+        the directory of the store
+    chunk: int
+        the number of planes per file
+    dtype: np.dtype
+        the data type, None before the first plane
+    plane_shape: tuple
+        the shape of the planes, None before the first plane
+    """
+    META = "store.json"
+
+    def __init__(self, directory: str, chunk: int = 16):
+        self.directory = directory
+        self.chunk = chunk
+        self.dtype = None
+        self.plane_shape = None
+        # the planes of the complete chunks on disk, and those of the last chunk kept in memory
+        self._written = 0
+        self._pending = []
+        os.makedirs(directory, exist_ok=True)
+        meta = os.path.join(directory, self.META)
+        if os.path.exists(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            self.chunk = meta["chunk"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.plane_shape = tuple(meta["plane_shape"])
+            self._written = meta["planes"] // self.chunk * self.chunk
+            if meta["planes"] > self._written:
+                self._pending = list(np.load(self._path(self._written // self.chunk)))
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, f"chunk-{index:06d}.npy")
+
+    def _save_meta(self, planes: int):
+        meta = {"chunk": self.chunk, "dtype": self.dtype.str, "plane_shape": list(self.plane_shape), "planes": planes}
+        tmp = os.path.join(self.directory, self.META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, self.META))
+
+    def __len__(self) -> int:
+        return self._written + len(self._pending)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self),) + (self.plane_shape or ())
+
+    def append(self, planes: np.ndarray):
+        """
+        add planes at the end, of shape (number of planes, Y, X)
+        """
+        planes = np.asarray(planes)
+        if self.dtype is None:
+            self.dtype, self.plane_shape = planes.dtype, planes.shape[1:]
+        if planes.shape[1:] != self.plane_shape:
+            raise ValueError(f"planes of shape {planes.shape[1:]} do not fit a store of planes of shape {self.plane_shape}")
+        for plane in planes.astype(self.dtype, copy=False):
+            self._pending.append(plane)
+            if len(self._pending) == self.chunk:
+                save_npy(self._path(self._written // self.chunk), np.stack(self._pending))
+                self._written += self.chunk
+                self._pending = []
+                self._save_meta(self._written)
+
+    def flush(self):
+        """
+        write the last, incomplete chunk as well (it is rewritten when it grows)
+        """
+        if self._pending:
+            save_npy(self._path(self._written // self.chunk), np.stack(self._pending))
+        if self.dtype is not None:
+            self._save_meta(len(self))
+
+    def read(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        the planes start to stop (exclusive), all planes by default
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if self.dtype is None or start >= stop:
+            return np.zeros((0,) + (self.plane_shape or (0, 0)), dtype=self.dtype or np.float32)
+        parts = []
+        for index in range(start // self.chunk, (stop - 1) // self.chunk + 1):
+            offset = index * self.chunk
+            if offset >= self._written:
+                data = np.stack(self._pending)
+            else:
+                data = np.load(self._path(index), mmap_mode="r")
+            parts.append(data[max(start - offset, 0):stop - offset])
+        return np.concatenate(parts)
+
+
+class PlaneWatcher:
+    """
+    find the plane files written to a directory, in the (natural) order of their names
+
+    Attributes:
+    -------------
+    directory: str
+        the watched directory
+    pattern: str
+        the glob pattern of the plane files
+    seen: set
+        the paths of the planes returned so far
+    """
+    def __init__(self, directory: str, pattern: str = "*.tif*"):
+        self.directory = directory
+        self.pattern = pattern
+        self.seen = set()
+        self._sizes = {}
+
+    def poll(self) -> List[str]:
+        """
+        the new complete plane files: files whose size is unchanged since the
+        previous poll, up to the first file which is still being written
+        """
+        paths = [p for p in glob(os.path.join(self.directory, self.pattern)) if p not in self.seen]
+        paths.sort(key=lambda p: [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", os.path.basename(p))])
+        ready = []
+        complete = True
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            complete = complete and bool(size) and size == self._sizes.get(path)
+            self._sizes[path] = size
+            if complete:
+                ready.append(path)
+        for path in ready:
+            self.seen.add(path)
+            del self._sizes[path]
+        return ready
+
+
+class _Planes:
+    """
+    the planes of one image from start on, released once no filter needs them
+    """
+    def __init__(self):
+        self.start = 0
+        self.planes = []
+
+    @property
+    def stop(self) -> int:
+        return self.start + len(self.planes)
+
+    def append(self, planes: np.ndarray):
+        self.planes.extend(planes)
+
+    def window(self, start: int, stop: int) -> np.ndarray:
+        return np.stack(self.planes[start - self.start:stop - self.start])
+
+    def release(self, before: int):
+        before = min(max(before, self.start), self.stop)
+        del self.planes[:before - self.start]
+        self.start = before
+
+
+def split_pipeline(pipeline: dict) -> Tuple[dict, Optional[dict]]:
+    """
+    split a pipeline (see pipeline.build_pipeline) into the steps which can be
+    streamed (see STREAM_STEPS), and the later steps which need the whole image
+    Parameters:
+    ------
+    pipeline: dict
+        the pipeline, with one input
+    Returns:
+    ---------
+    tuple
+        the pipeline of the streamed steps, and the pipeline of the remaining
+        steps (whose input is the result of the first one), None if there are none
+    """
+    if len(pipeline["inputs"]) != 1:
+        raise ValueError(f"streaming needs a pipeline with one input, not {len(pipeline['inputs'])}")
+    planes = set(pipeline["inputs"])
+    masks = set()
+    head, tail = [], []
+    for node in pipeline["nodes"]:
+        step, inputs = node["step"], node["inputs"]
+        # once a step can not be streamed, all later ones are run on the whole image
+        if tail:
+            tail.append(node)
+        elif step == "smoothing" and inputs[0] in planes:
+            planes.add(node["id"])
+            head.append(node)
+        elif step in ("threshold", "vesselness") and inputs[0] in planes:
+            masks.add(node["id"])
+            head.append(node)
+        elif step == "merge" and all(i in masks for i in inputs):
+            masks.add(node["id"])
+            head.append(node)
+        else:
+            tail.append(node)
+    if not head:
+        raise ValueError("the pipeline does not start with steps which can be streamed")
+    if not tail:
+        return pipeline, None
+    streamed = planes | masks
+    needed = {i for node in tail for i in node["inputs"] if i in streamed}
+    if len(needed) != 1:
+        raise ValueError("the remaining steps of the pipeline must only depend on one result of the streamed steps")
+    output = needed.pop()
+    return (
+        {"version": PIPELINE_VERSION, "inputs": pipeline["inputs"], "output": output, "nodes": head},
+        {"version": PIPELINE_VERSION, "inputs": [output], "output": pipeline["output"], "nodes": tail},
+    )
+
+
+class StreamingPipeline:
+    """
+    run a pipeline of streamable steps (see split_pipeline) on a stack arriving plane by plane
+
+    The filter outputs which the pointwise steps need (the input of each
+    threshold and the response of each vesselness) are stored in one
+    PlaneStore per node below the directory, the final result in "output".
+
+    Attributes:
+    -------------
+    pipeline: dict
+        the pipeline
+    directory: str
+        the directory of the stores
+    n_planes: int
+        the number of planes received
+    """
+    def __init__(self, pipeline: dict, directory: str, chunk: int = 16, batch: int = 16):
+        """
+        Parameters:
+        ------
+        pipeline: dict
+            the pipeline, which must only consist of streamable steps
+        directory: str
+            the directory of the stores, must be empty (or not exist yet)
+        chunk: int
+            the number of planes per file of the stores
+        batch: int
+            the minimal number of new output planes a filter computes at once,
+            as every computation repeats the halo
+        """
+        if split_pipeline(pipeline)[1] is not None:
+            raise ValueError("the pipeline has steps which can not be streamed, see split_pipeline")
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError(f"the directory {directory} is not empty")
+        self.pipeline = pipeline
+        self.directory = directory
+        self.chunk = chunk
+        self.batch = batch
+        self.n_planes = 0
+        self.nodes = {node["id"]: node for node in pipeline["nodes"]}
+        self.filters = [node for node in pipeline["nodes"] if node["step"] in FILTER_STEPS]
+        self.halo = {node["id"]: halo_depth(node["step"], node["params"], 3)[0] for node in self.filters}
+        self.done = {node["id"]: 0 for node in self.filters}
+        self.planes = {pipeline["inputs"][0]: _Planes()}
+        self.planes.update({node["id"]: _Planes() for node in self.filters if node["step"] == "smoothing"})
+
+        thresholded = {node["inputs"][0] for node in pipeline["nodes"] if node["step"] == "threshold"}
+        responses = {node["id"] for node in pipeline["nodes"] if node["step"] == "vesselness"}
+        stored = thresholded | responses
+        if self.nodes[pipeline["output"]]["step"] == "smoothing":
+            stored.add(pipeline["output"])
+        self.stores = {key: PlaneStore(os.path.join(directory, key), chunk) for key in stored}
+        self.moments = {key: RunningMoments() for key in thresholded}
+        self.histograms = {key: IntegerHistogram() for key in responses}
+        self.ended = False
+
+    @property
+    def processed(self) -> int:
+        """
+        the number of planes all filters are done with
+        """
+        return min(self.done.values(), default=self.n_planes)
+
+    def push(self, planes: np.ndarray):
+        """
+        add the next plane(s) of the stack, of shape (Y, X) or (number of planes, Y, X)
+        """
+        if self.ended:
+            raise RuntimeError("the stack has ended already")
+        planes = np.asarray(planes)
+        planes = planes[None] if planes.ndim == 2 else planes
+        self.n_planes += len(planes)
+        self._emit(self.pipeline["inputs"][0], planes)
+        self._advance()
+
+    def _emit(self, key: str, planes: np.ndarray):
+        if key in self.planes:
+            self.planes[key].append(planes)
+        if key in self.stores:
+            self.stores[key].append(planes)
+        if key in self.moments:
+            self.moments[key].add(planes)
+        if key in self.histograms:
+            self.histograms[key].add(planes)
+
+    def _filter(self, node: dict, window: np.ndarray) -> np.ndarray:
+        params = node["params"]
+        if node["step"] == "smoothing":
+            return STEPS["smoothing"](window, **dict(params, blockwise=False))
+        spacing = params.get("spacing")
+        return vesselness_response(
+            window, params.get("dim", 3), params["sigma"], params["gamma"], None if spacing is None else tuple(spacing)
+        )
+
+    def _advance(self):
+        """
+        compute the output planes whose halo has arrived (all remaining ones once the stack ended)
+        """
+        for node in self.filters:
+            key = node["id"]
+            source, halo, done = self.planes[node["inputs"][0]], self.halo[key], self.done[key]
+            ready = source.stop if self.ended else source.stop - halo
+            if ready <= done or (not self.ended and ready - done < self.batch):
+                continue
+            start, stop = max(0, done - halo), min(source.stop, ready + halo)
+            out = np.asarray(self._filter(node, source.window(start, stop)))
+            self.done[key] = ready
+            self._emit(key, out[done - start:ready - start])
+        for key, planes in self.planes.items():
+            needed = [self.done[n["id"]] - self.halo[n["id"]] for n in self.filters if n["inputs"][0] == key]
+            planes.release(min(needed, default=planes.stop))
+
+    def _pointwise(self, key: str, start: int, stop: int) -> np.ndarray:
+        """
+        the planes start to stop of a result
+        """
+        node = self.nodes.get(key)
+        step = node["step"] if node else None
+        if step == "threshold":
+            moments = self.moments[node["inputs"][0]]
+            cutoff = moments.mean + node["params"]["scale"] * moments.std
+            return 1 * (self.stores[node["inputs"][0]].read(start, stop) > cutoff)
+        if step == "vesselness":
+            return 1 * (self.stores[key].read(start, stop) > self.cutoffs[key])
+        if step == "merge":
+            seg = self._pointwise(node["inputs"][0], start, stop) > 0
+            for other in node["inputs"][1:]:
+                seg = np.logical_or(seg, self._pointwise(other, start, stop) > 0)
+            return seg
+        return self.stores[key].read(start, stop)
+
+    def finish(self) -> PlaneStore:
+        """
+        end the stack: compute the last planes, and apply the pointwise steps
+        Returns:
+        ---------
+        PlaneStore
+            the result of the pipeline
+        """
+        if not self.n_planes:
+            raise ValueError("no planes arrived")
+        self.ended = True
+        self._advance()
+        for store in self.stores.values():
+            store.flush()
+        self.cutoffs = {
+            key: histogram.cutoff(self.nodes[key]["params"].get("cutoff_method", "threshold_li"))
+            for key, histogram in self.histograms.items()
+        }
+        output = self.pipeline["output"]
+        if output in self.stores:
+            return self.stores[output]
+        result = PlaneStore(os.path.join(self.directory, "output"), self.chunk)
+        for start in range(0, self.n_planes, self.chunk):
+            result.append(self._pointwise(output, start, start + self.chunk))
+        result.flush()
+        return result
+
+
+def read_planes(path: str) -> np.ndarray:
+    """
+    the plane(s) of a TIFF file
+    """
+    from tifffile import imread
+
+    return imread(path)
+
+
+def stream_directory(
+    directory: str,
+    pipeline: dict,
+    store: str,
+    pattern: str = "*.tif*",
+    n_planes: Optional[int] = None,
+    idle: float = 60.0,
+    interval: float = 1.0,
+    chunk: int = 16,
+    batch: int = 16,
+    read: Callable[[str], np.ndarray] = read_planes,
+    stop: Optional[Callable[[], bool]] = None,
+    on_planes: Optional[Callable[["StreamingPipeline"], None]] = None
+) -> PlaneStore:
+    """
+    run a pipeline of streamable steps (see split_pipeline) on a stack while its planes are written to a directory
+    Parameters:
+    ------
+    directory: str
+        the watched directory
+    pipeline: dict
+        the pipeline
+    store: str
+        the directory of the stores of the results, see StreamingPipeline
+    pattern: str
+        the glob pattern of the plane files, read in the natural order of their names
+    n_planes: int
+        the number of planes of the stack, if known
+    idle: float
+        the acquisition has ended once no plane arrived for that many seconds
+    interval: float
+        the seconds between two polls of the directory
+    chunk: int
+        the number of planes per file of the stores
+    batch: int
+        the minimal number of planes a filter computes at once
+    read: Callable
+        reads the plane(s) of a file
+    stop: Callable
+        returns True to end the stack early, e.g., when the user cancels
+    on_planes: Callable
+        called with the StreamingPipeline after each new file, e.g., to show the progress
+    Returns:
+    ---------
+    PlaneStore
+        the result of the pipeline
+    """
+    watcher = PlaneWatcher(directory, pattern)
+    stream = StreamingPipeline(pipeline, store, chunk, batch)
+    last = time.monotonic()
+    while True:
+        paths = watcher.poll()
+        for path in paths:
+            stream.push(read(path))
+            if on_planes is not None:
+                on_planes(stream)
+        if paths:
+            last = time.monotonic()
+        if n_planes is not None and stream.n_planes >= n_planes:
+            break
+        if (stop is not None and stop()) or time.monotonic() - last > idle:
+            break
+        time.sleep(interval)
+    return stream.finish()
@@ -0,0 +1,151 @@
+"""
+Sweep the parameters of the core segmentation steps over a grid and
+summarize each grid point in one table row, without keeping the masks.
+
+Work shared between grid points is done once: the image is smoothed once,
+the threshold step reduces the image statistics once for all scales, the
+vesselness step computes one Hessian per sigma (and one response per sigma
+and gamma), and every cutoff method is computed from one histogram of the
+response. Sigmas run in parallel threads.
+
+The masks of selected rows are obtained by running the step with the
+parameters of the row (see pipeline.STEPS); the cutoffs in the table come
+from histograms (see utils.histogram_cutoff).
+"""
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+from .blocks import default_workers
+from .pipeline import STEPS
+from .utils import histogram, histogram_cutoff, hessian_image, objectness
+
+
+def agreement(mask: np.ndarray, reference: np.ndarray) -> dict:
+    """
+    compare a mask with a reference mask
+    Parameters:
+    ------
+    mask: np.ndarray
+        the mask
+    reference: np.ndarray
+        the reference mask of the same shape
+    Returns:
+    ---------
+    dict
+        the Dice coefficient, Jaccard index, precision and recall of the mask
+    """
+    mask = mask > 0
+    reference = reference > 0
+    both = int(np.count_nonzero(mask & reference))
+    predicted = int(np.count_nonzero(mask))
+    actual = int(np.count_nonzero(reference))
+    union = predicted + actual - both
+    return {
+        "dice": 2 * both / (predicted + actual) if predicted + actual else 1.0,
+        "jaccard": both / union if union else 1.0,
+        "precision": both / predicted if predicted else 1.0,
+        "recall": both / actual if actual else 1.0,
+    }
+
+
+def mask_statistics(mask: np.ndarray) -> dict:
+    """
+    summarize a mask
+    Parameters:
+    ------
+    mask: np.ndarray
+        the mask
+    Returns:
+    ---------
+    dict
+        the number of foreground voxels, the foreground fraction and the
+        number of connected components (26-connected in 3D)
+    """
+    from scipy.ndimage import label
+
+    mask = mask > 0
+    voxels = int(np.count_nonzero(mask))
+    components = label(mask, structure=np.ones((3,) * mask.ndim))[1]
+    return {"voxels": voxels, "foreground": voxels / mask.size, "components": int(components)}
+
+
+def _row(step: str, params: dict, cutoff: float, mask: np.ndarray, reference: Optional[np.ndarray]) -> dict:
+    row = {"step": step, "params": params, "cutoff": cutoff, "foreground": float(np.count_nonzero(mask)) / mask.size}
+    if reference is not None:
+        row.update(agreement(mask, reference))
+    return row
+
+
+def sweep(
+    image: np.ndarray,
+    scales: Sequence[float] = (),
+    sigmas: Sequence[float] = (),
+    gammas: Sequence[float] = (5,),
+    cutoff_methods: Sequence[str] = ("threshold_li",),
+    spacing: Optional[Sequence[float]] = None,
+    smoothing: Optional[dict] = None,
+    reference: Optional[np.ndarray] = None,
+    n_workers: Optional[int] = None
+) -> List[dict]:
+    """
+    run the threshold and vesselness steps for every combination of parameters
+    Parameters:
+    ------
+    image: np.ndarray
+        the (smoothed) 3D image
+    scales: Sequence[float]
+        the scales of the threshold step
+    sigmas: Sequence[float]
+        the sigmas of the vesselness step
+    gammas: Sequence[float]
+        the gammas of the vesselness step, combined with each sigma
+    cutoff_methods: Sequence[str]
+        the cutoff methods of the vesselness step, combined with each sigma and gamma
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    smoothing: dict
+        the parameters of the smoothing step to apply (once) before, None if
+        the image is smoothed already
+    reference: np.ndarray
+        a reference mask to compare every result with, see agreement
+    n_workers: int
+        the number of threads, all cores by default
+    Returns:
+    ---------
+    list
+        one row per grid point: the step, its parameters (as for pipeline.STEPS),
+        the cutoff, the foreground fraction and, with a reference, the agreement
+    """
+    if smoothing is not None:
+        image = STEPS["smoothing"](image, **smoothing)
+    image = np.asarray(image)
+
+    def threshold_rows():
+        # the same statistics (and rounding) as the threshold step
+        mean, std = image.mean(), image.std()
+        rows = []
+        for scale in scales:
+            cutoff = mean + scale * std
+            rows.append(_row("threshold", {"scale": scale}, float(cutoff), image > cutoff, reference))
+        return rows
+
+    def vesselness_rows(sigma):
+        hessian = hessian_image(image, sigma, spacing)
+        rows = []
+        for gamma in gammas:
+            response = objectness(hessian, gamma)
+            hist = histogram(response)
+            for method in cutoff_methods:
+                cutoff = float(histogram_cutoff(response, method, hist))
+                params = {"sigma": sigma, "gamma": gamma, "dim": 3, "cutoff_method": method, "spacing": spacing}
+                rows.append(_row("vesselness", params, cutoff, response > cutoff, reference))
+        return rows
+
+    tasks = ([threshold_rows] if len(scales) else []) + [lambda sigma=sigma: vesselness_rows(sigma) for sigma in sigmas]
+    n_workers = min(n_workers or default_workers(), max(len(tasks), 1))
+    if n_workers == 1:
+        return list(itertools.chain.from_iterable(task() for task in tasks))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(itertools.chain.from_iterable(executor.map(lambda task: task(), tasks)))
@@ -1,15 +1,550 @@
 import itk
+import warnings
 import numpy as np
-from typing import Union
+from typing import Optional, Sequence, Union
 from importlib import import_module
 
 
+def array_fingerprint(data: np.ndarray) -> str:
+    """
+    compute a content hash of an array, used to recognize results computed from the same data
+    Parameters:
+    ------
+    data: np.ndarray
+        the array to be hashed
+    Returns:
+    ---------
+    str
+        a hex digest depending on shape, dtype and content of the array
+    """
+    import hashlib
+
+    if hasattr(data, "dask"):
+        # dask arrays are identified by their (content based) task name
+        return data.name
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((data.shape, data.dtype.str)).encode())
+    digest.update(data.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+# the compute and storage data types of continuous results (smoothing,
+# resampling) for each precision policy; float16 is not supported by ITK
+PRECISIONS = {
+    "float64": (np.float64, np.float64),
+    "float32": (np.float32, np.float32),
+    "float16": (np.float32, np.float16),
+}
+
+
+def precision_dtypes(precision: str = "float32", data: Optional[np.ndarray] = None) -> tuple:
+    """
+    the data types used to compute and to store a continuous result
+    Parameters:
+    ------
+    precision: str
+        the precision policy, a key of PRECISIONS
+    data: np.ndarray
+        the input. float16 storage falls back to float32 (with a warning) if
+        its values exceed the float16 range.
+    Returns:
+    ---------
+    tuple
+        the compute and the storage data type
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision {precision}, use one of {', '.join(PRECISIONS)}")
+    compute, storage = PRECISIONS[precision]
+    if storage == np.float16 and data is not None and data.size:
+        if max(abs(float(data.min())), abs(float(data.max()))) > float(np.finfo(np.float16).max):
+            warnings.warn("the image exceeds the float16 range, the result is stored in float32")
+            storage = np.float32
+    return compute, storage
+
+
+def normalize_spacing(spacing: Optional[Sequence[float]]) -> Optional[tuple]:
+    """
+    convert a physical voxel size into a relative spacing
+    Parameters:
+    ------
+    spacing: Sequence[float]
+        the voxel size in ZYX order (e.g., in micron), or None
+    Returns:
+    ---------
+    tuple or None
+        the spacing divided by its smallest entry, so that sizes (sigma,
+        kernel size, etc.) keep meaning "voxels along the finest axis".
+        None is returned if no (or an invalid) spacing is given.
+    """
+    if spacing is None:
+        return None
+    spacing = tuple(float(s) for s in spacing)
+    if len(spacing) == 0 or min(spacing) <= 0:
+        return None
+    finest = min(spacing)
+    return tuple(s / finest for s in spacing)
+
+
+def anisotropic_cube(width: int, spacing: Optional[Sequence[float]] = None) -> np.ndarray:
+    """
+    create a box shaped footprint covering the same physical extent along each axis
+    Parameters:
+    ------
+    width: int
+        the width of the box along the finest axis (in voxels)
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    Returns:
+    ---------
+    np.ndarray
+        the footprint, identical to skimage.morphology.cube(width) for isotropic voxels
+    """
+    if spacing is None:
+        spacing = (1, 1, 1)
+    shape = tuple(max(1, int(round(width / s))) for s in spacing)
+    return np.ones(shape, dtype=np.uint8)
+
+
+def anisotropic_ball(radius: Union[int, float], spacing: Optional[Sequence[float]] = None) -> np.ndarray:
+    """
+    create an ellipsoidal footprint which is a ball in physical space
+    Parameters:
+    ------
+    radius: Union[int, float]
+        the radius of the ball along the finest axis (in voxels)
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    Returns:
+    ---------
+    np.ndarray
+        the footprint, identical to skimage.morphology.ball(radius) for isotropic voxels
+    """
+    if spacing is None:
+        spacing = (1, 1, 1)
+    half = [int(radius / s) for s in spacing]
+    grid = np.ogrid[tuple(slice(-h, h + 1) for h in half)]
+    dist = sum((g * s) ** 2 for g, s in zip(grid, spacing))
+    return (dist <= radius ** 2).astype(np.uint8)
+
+
+def topology_preserving_thinning(
+    bw: np.ndarray,
+    min_thickness: Union[int, float] = 1,
+    thin: int = 1,
+    spacing: Optional[Sequence[float]] = None
+) -> np.ndarray:
+    """
+    thin a segmentation without breaking its topology, honoring anisotropic voxels
+    Parameters:
+    ------
+    bw: np.ndarray
+        the 3D binary image to be thinned
+    min_thickness: Union[int, float]
+        half of the minimal width (along the finest axis) to be kept from thinning
+    thin: int
+        how many voxels (along the finest axis) to remove from the outer boundary
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order. If None, aicssegmentation's
+        topology_preserving_thinning is used directly.
+    Returns:
+    ---------
+    np.ndarray
+        the thinned binary image
+    """
+    if spacing is None:
+        from aicssegmentation.core.utils import topology_preserving_thinning as _thinning
+        return _thinning(bw, min_thickness, thin)
+
+    from scipy.ndimage import distance_transform_edt
+    from skimage.morphology import medial_axis, erosion
+
+    bw = bw > 0
+    safe_zone = np.zeros_like(bw)
+    for zz in range(bw.shape[0]):
+        if np.any(bw[zz, :, :]):
+            ctl = medial_axis(bw[zz, :, :])
+            dist = distance_transform_edt(ctl == 0, sampling=spacing[1:])
+            safe_zone[zz, :, :] = dist > min_thickness + 1e-5
+
+    rm_candidate = np.logical_xor(bw, erosion(bw, anisotropic_ball(thin, spacing)))
+    bw[np.logical_and(safe_zone, rm_candidate)] = 0
+
+    return bw
+
+
+def _diffusion(
+    data: np.ndarray,
+    n_iter: int,
+    time_step: float,
+    conductance: float,
+    spacing: Optional[Sequence[float]],
+    tolerance: Optional[float],
+    n_threads: Optional[int] = None,
+    dtype=np.float32
+) -> np.ndarray:
+    """
+    run ITK gradient anisotropic diffusion in float32 (or float64), optionally one iteration at a time
+    """
+    itk_img = itk.GetImageFromArray(np.asarray(data, dtype=dtype))
+    if spacing is not None:
+        itk_img.SetSpacing([float(s) for s in spacing[::-1]])
+
+    def iterate(img, iterations):
+        diffusion = itk.GradientAnisotropicDiffusionImageFilter.New(img)
+        diffusion.SetNumberOfIterations(iterations)
+        diffusion.SetTimeStep(time_step)
+        diffusion.SetConductanceParameter(conductance)
+        if n_threads is not None:
+            diffusion.SetNumberOfWorkUnits(n_threads)
+        diffusion.Update()
+        return diffusion.GetOutput()
+
+    if tolerance is None:
+        return itk.GetArrayFromImage(iterate(itk_img, n_iter))
+
+    # stop as soon as the largest update, relative to the intensity range, is below tolerance
+    previous = itk.GetArrayFromImage(itk_img)
+    value_range = float(previous.max() - previous.min()) or 1.0
+    for _ in range(n_iter):
+        itk_img = iterate(itk_img, 1)
+        current = itk.GetArrayFromImage(itk_img)
+        change = float(np.abs(current - previous).max()) / value_range
+        previous = current
+        if change < tolerance:
+            break
+    return previous
+
+
+def edge_preserving_smoothing(
+    image: np.ndarray,
+    n_iter: int = 10,
+    time_step: float = 0.0625,
+    conductance: float = 1.2,
+    spacing: Optional[Sequence[float]] = None,
+    tolerance: Optional[float] = None,
+    blockwise: bool = False,
+    block_shape: Optional[Sequence[int]] = None,
+    n_workers: Optional[int] = None,
+    precision: str = "float32"
+) -> np.ndarray:
+    """
+    perform edge preserving smoothing (ITK gradient anisotropic diffusion)
+    Parameters:
+    ------
+    image: np.ndarray
+        the 3D image to be smoothed
+    n_iter: int
+        the number of diffusion iterations, more iterations give more smoothing
+    time_step: float
+        the time step of each iteration, at most 0.0625 for 3D images to be stable
+    conductance: float
+        the conductance parameter, smaller values preserve edges better
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    tolerance: float
+        if set, stop early once the largest update of an iteration, relative to
+        the intensity range of the input, drops below this value
+    blockwise: bool
+        whether to process the image in blocks (with a halo of n_iter voxels)
+        in parallel threads. The conductance is then normalized per block, so the
+        result differs slightly from smoothing the whole image at once.
+    block_shape: Sequence[int]
+        the shape of the blocks when processing blockwise
+    n_workers: int
+        the number of threads when processing blockwise, all cores by default
+    precision: str
+        "float32", "float64", or "float16" (computed in float32), see precision_dtypes
+    Returns:
+    ---------
+    np.ndarray
+        the smoothed image. With default parameters the result is the same as
+        aicssegmentation's edge_preserving_smoothing_3d.
+    """
+    compute, storage = precision_dtypes(precision, image)
+    if not blockwise:
+        smoothed = _diffusion(image, n_iter, time_step, conductance, spacing, tolerance, dtype=compute)
+        return smoothed.astype(storage, copy=False)
+
+    from .blocks import run_blockwise
+
+    def smooth_block(block):
+        return _diffusion(block, n_iter, time_step, conductance, spacing, tolerance, n_threads=1, dtype=compute)
+
+    return run_blockwise(smooth_block, image, depth=n_iter, block_shape=block_shape,
+                         dtype=storage, n_workers=n_workers)
+
+
+def histogram(data: np.ndarray, nbins: int = 4096) -> tuple:
+    """
+    compute the histogram of an array (NumPy or dask) in one pass over the data
+    Parameters:
+    ------
+    data: np.ndarray
+        the array
+    nbins: int
+        the number of bins for floating point data. Integer data gets one bin
+        per value (if there are not more than 65536 values).
+    Returns:
+    ---------
+    tuple
+        counts and bin centers
+    """
+    if hasattr(data, "dask"):
+        import dask
+        import dask.array as da
+        low, high = (float(v) for v in dask.compute(data.min(), data.max()))
+    else:
+        low, high = float(data.min()), float(data.max())
+    if np.issubdtype(data.dtype, np.integer) and high - low < 65536:
+        edges = np.arange(low - 0.5, high + 1.5)
+    else:
+        edges = np.linspace(low, high if high > low else low + 1, nbins + 1)
+    if hasattr(data, "dask"):
+        counts = da.histogram(data, bins=edges)[0].compute()
+    else:
+        counts = np.histogram(data, bins=edges)[0]
+    return counts, (edges[:-1] + edges[1:]) / 2
+
+
+def threshold_from_histogram(counts: np.ndarray, bin_centers: np.ndarray, method: str) -> float:
+    """
+    compute a threshold from a histogram instead of from the image itself
+    Parameters:
+    ------
+    counts: np.ndarray
+        the number of values in each bin
+    bin_centers: np.ndarray
+        the center of each bin (evenly spaced)
+    method: str
+        "threshold_otsu", "threshold_li" or "threshold_triangle", following the
+        skimage implementation of the same name
+    Returns:
+    ---------
+    float
+        the threshold, equal to the skimage result up to the bin width
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    bin_centers = np.asarray(bin_centers, dtype=np.float64)
+    nonzero = np.flatnonzero(counts)
+    if len(nonzero) == 0:
+        return 0.0
+    if nonzero[0] == nonzero[-1]:
+        return float(bin_centers[nonzero[0]])
+
+    if method == "threshold_otsu":
+        weight1 = np.cumsum(counts)
+        weight2 = np.cumsum(counts[::-1])[::-1]
+        mean1 = np.cumsum(counts * bin_centers) / np.maximum(weight1, 1e-12)
+        mean2 = (np.cumsum((counts * bin_centers)[::-1]) / np.maximum(weight2[::-1], 1e-12))[::-1]
+        variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+        return float(bin_centers[np.argmax(variance)])
+
+    if method == "threshold_li":
+        # Li's algorithm requires positive values
+        offset = bin_centers[nonzero[0]]
+        centers = bin_centers - offset
+        tolerance = (bin_centers[1] - bin_centers[0]) / 2
+        t_next = np.average(centers, weights=counts)
+        t_curr = -2 * tolerance
+        while abs(t_next - t_curr) > tolerance:
+            t_curr = t_next
+            foreground = centers > t_curr
+            background = ~foreground
+            if counts[foreground].sum() == 0 or counts[background].sum() == 0:
+                break
+            mean_fore = np.average(centers[foreground], weights=counts[foreground])
+            mean_back = np.average(centers[background], weights=counts[background])
+            if mean_back <= 0:
+                break
+            t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+        return float(t_next + offset)
+
+    if method == "threshold_triangle":
+        nbins = len(counts)
+        arg_peak_height = int(np.argmax(counts))
+        peak_height = counts[arg_peak_height]
+        arg_low_level, arg_high_level = nonzero[[0, -1]]
+        flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+        if flip:
+            counts = counts[::-1]
+            arg_low_level = nbins - arg_high_level - 1
+            arg_peak_height = nbins - arg_peak_height - 1
+        width = arg_peak_height - arg_low_level
+        x1 = np.arange(width)
+        y1 = counts[x1 + arg_low_level]
+        norm = np.sqrt(peak_height ** 2 + width ** 2)
+        length = peak_height / norm * x1 - width / norm * y1
+        arg_level = int(np.argmax(length)) + arg_low_level
+        if flip:
+            arg_level = nbins - arg_level - 1
+        return float(bin_centers[arg_level])
+
+    raise ValueError(f"{method} cannot be computed from a histogram")
+
+
+def histogram_cutoff(data: np.ndarray, cutoff_method: str, hist: Optional[tuple] = None) -> float:
+    """
+    compute a skimage-style cutoff value (see vesselness_filter) from one histogram pass
+    Parameters:
+    ------
+    data: np.ndarray
+        the array (NumPy or dask), e.g., a vesselness response
+    cutoff_method: str
+        "threshold_otsu", "threshold_li" or "threshold_triangle"
+    hist: tuple
+        the histogram of data as returned by histogram(data), to reuse it for several methods
+    Returns:
+    ---------
+    float
+        the cutoff value. For integer data it is the same as skimage's; for
+        floating point data, Otsu and triangle use skimage's 256 bins as well, and
+        Li's method is accurate up to 1/4096 of the value range.
+    """
+    counts, bin_centers = hist if hist is not None else histogram(data)
+    integer = np.issubdtype(data.dtype, np.integer)
+    if not integer and cutoff_method != "threshold_li" and len(counts) % 256 == 0:
+        group = len(counts) // 256
+        counts = counts.reshape(256, group).sum(axis=1)
+        bin_centers = bin_centers.reshape(256, group).mean(axis=1)
+    return threshold_from_histogram(counts, bin_centers, cutoff_method)
+
+
+class RunningMoments:
+    """
+    the mean and (population) variance of a stream of values, combined chunk by chunk
+    """
+    def __init__(self):
+        self.n, self.mean, self.m2 = 0, 0.0, 0.0
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        n = self.n + values.size
+        delta = mean - self.mean
+        self.mean += delta * values.size / n
+        self.m2 += m2 + delta ** 2 * self.n * values.size / n
+        self.n = n
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.m2 / self.n)) if self.n else 0.0
+
+
+class IntegerHistogram:
+    """
+    the histogram of a stream of integer values (of at most 16 bits), one bin per value
+    """
+    def __init__(self):
+        self.counts = np.zeros(2 ** 16, dtype=np.int64)
+        self.offset = None
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values)
+        if not np.issubdtype(values.dtype, np.integer) or values.dtype.itemsize > 2:
+            raise ValueError(f"expected integers of at most 16 bits, got {values.dtype}")
+        if self.offset is None:
+            self.offset = int(np.iinfo(values.dtype).min)
+        self.counts += np.bincount((values.ravel().astype(np.int64) - self.offset), minlength=len(self.counts))
+
+    def merge(self, other: "IntegerHistogram"):
+        """
+        add the counts of another histogram, e.g., of another chunk
+        """
+        if other.offset is not None:
+            self.offset = other.offset
+            self.counts += other.counts
+
+    def cutoff(self, cutoff_method: str) -> float:
+        """
+        the cutoff value, the same as histogram_cutoff of all values
+        """
+        used = np.flatnonzero(self.counts)
+        low, high = used[0], used[-1] + 1
+        return threshold_from_histogram(self.counts[low:high], np.arange(low, high, dtype=np.float64) + self.offset, cutoff_method)
+
+
+def _itk_compatible(im: np.ndarray) -> np.ndarray:
+    """
+    convert data types ITK does not support (float16, e.g., stored results) to float32
+    """
+    if im.dtype == np.float16:
+        return im.astype(np.float32)
+    return im
+
+
+def hessian_image(im: np.ndarray, sigma: Union[int, float] = 1, spacing: Optional[Sequence[float]] = None):
+    """
+    compute the scale-normalized Hessian of a 3D image with ITK, to derive
+    vesselness responses for several gammas from one Hessian (see objectness)
+    Parameters:
+    ------
+    im: np.ndarray
+        the 3D image
+    sigma: Union[float, int]
+        the scale of the Gaussian derivatives
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, None for isotropic voxels
+    Returns:
+    ---------
+    itk.Image
+        the Hessian (a symmetric matrix per voxel)
+    """
+    im_itk = itk.image_view_from_array(_itk_compatible(im))
+    if spacing is not None:
+        im_itk.SetSpacing([float(s) for s in spacing[::-1]])
+    return itk.hessian_recursive_gaussian_image_filter(im_itk, sigma=sigma, normalize_across_scale=True)
+
+
+def objectness(hessian_itk, gamma: Union[int, float] = 5) -> np.ndarray:
+    """
+    compute the vesselness (Frangi objectness) response from a Hessian, see hessian_image
+    """
+    return np.asarray(itk.hessian_to_objectness_measure_image_filter(hessian_itk, object_dimension=1, gamma=gamma))
+
+
+def vesselness_response(
+    im: np.ndarray,
+    dim: int = 3,
+    sigma: Union[int, float] = 1,
+    gamma: Union[int, float] = 5,
+    spacing: Optional[Sequence[float]] = None
+) -> np.ndarray:
+    """
+    compute the ITK 3D/2D vesselness (Frangi objectness) response, see vesselness_filter
+
+    The response is int16, the default output type of ITK's objectness filter,
+    whatever the input type; the presets' cutoffs were tuned on this quantization.
+    """
+    im = _itk_compatible(im)
+    if dim == 3:
+        vess = objectness(hessian_image(im, sigma, spacing), gamma)
+    elif dim ==2:
+        vess = None
+        for z in range(im.shape[0]):
+            im_itk = itk.image_view_from_array(np.ascontiguousarray(im[z,:,:]))
+            if spacing is not None:
+                im_itk.SetSpacing([float(s) for s in spacing[:0:-1]])
+            hessian_itk = itk.hessian_recursive_gaussian_image_filter(im_itk, sigma=sigma, normalize_across_scale=True)
+            vess_tubulness = itk.hessian_to_objectness_measure_image_filter(hessian_itk, object_dimension=1, gamma=gamma)
+            vess_2d = np.asarray(vess_tubulness)
+            if vess is None:
+                # in the data type of the response, not of the input
+                vess = np.zeros(im.shape, dtype=vess_2d.dtype)
+            vess[z, :, :] = vess_2d[:, :]
+    return vess
+
+
 def vesselness_filter(
     im: np.ndarray,
     dim: int = 3,
     sigma: Union[int, float] = 1,
     gamma: Union[int, float] = 5,
-    cutoff_method: str = "threshold_li"
+    cutoff_method: str = "threshold_li",
+    spacing: Optional[Sequence[float]] = None
 ) -> np.ndarray:
     """
     function for running ITK 3D/2D vesselness filter
@@ -25,26 +560,18 @@ def vesselness_filter(
         the gamma value in Frangi filter
     cutoff_method: str
         which method to use for determining the cutoff value, options include any
-        threshold method in skimage, such as "threshold_li", "threshold_otsu", 
+        threshold method in skimage, such as "threshold_li", "threshold_otsu",
         "threshold_triangle", etc.. See https://scikit-image.org/docs/stable/auto_examples/applications/plot_thresholding.html
+    spacing: Sequence[float]
+        the relative voxel spacing in ZYX order, passed to ITK as image spacing
+        so that sigma is measured in voxels along the finest axis. None means
+        isotropic voxels.
     Returns:
     ---------
     vess: np.ndarray
         filter output
     """
-    if dim == 3:
-        im_itk = itk.image_view_from_array(im)
-        hessian_itk = itk.hessian_recursive_gaussian_image_filter(im_itk, sigma=sigma, normalize_across_scale=True)
-        vess_tubulness = itk.hessian_to_objectness_measure_image_filter(hessian_itk, object_dimension=1, gamma=gamma)
-        vess = np.asarray(vess_tubulness)
-    elif dim ==2:
-        vess = np.zeros_like(im)
-        for z in range(im.shape[0]):
-            im_itk = itk.image_view_from_array(im[z,:,:])
-            hessian_itk = itk.hessian_recursive_gaussian_image_filter(im_itk, sigma=sigma, normalize_across_scale=True)
-            vess_tubulness = itk.hessian_to_objectness_measure_image_filter(hessian_itk, object_dimension=1, gamma=gamma)
-            vess_2d = np.asarray(vess_tubulness)
-            vess[z, :, :] = vess_2d[:, :]
+    vess = vesselness_response(im, dim, sigma, gamma, spacing)
 
     module_name = import_module("skimage.filters")
     threshold_function = getattr(module_name, cutoff_method)